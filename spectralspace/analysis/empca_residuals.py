@@ -9,10 +9,12 @@ from sklearn import linear_model
 import statsmodels.nonparametric.smoothers_lowess as sm
 import spectralspace.sample.access_spectrum as acs
 from empca import empca,MAD,meanMed
-from spectralspace.sample.mask_data import mask,maskFilter,noFilter
+from spectralspace.sample.mask_data import mask,maskFilter,noFilter,toMasked,toWeights
 from spectralspace.sample.star_sample import aspcappix
-import os
+import os,shutil
 from galpy.util import multi as ml
+from apogee.tools import toAspcapGrid
+from spectralspace.analysis.residual_covariance import residualVariance,residualCovariance
 
 font = {'family': 'serif',
         'weight': 'normal',
@@ -30,35 +32,163 @@ independentVariables = {'apogee':{'clusters':['TEFF'],
                                   'syn':['TEFF','LOGG'],
                                   'elem':['TEFF','LOGG','C_H','N_H','O_H','FE_H']}}
 
-def smoothMedian(diag,frac=None,numpix=None):
+# Number of pixels in an apStar spectrum
+apStarpix = 8575
+
+# Pixels where each detector begins on the ASPCAP grid, keyed by data release
+_detectors = {}
+
+def detectorBoundaries(dr=None):
+    """
+    Finds the pixels where each detector begins on the ASPCAP grid, from the
+    gaps between detectors in the apStar grid.
+
+    dr:   data release, defaults to the current data release
+
+    Returns an array of the first pixel of each detector, ending with the
+    total number of ASPCAP pixels.
     """
-    Uses Locally Weighted Scatterplot Smoothing to smooth an array on
-    each detector separately. Interpolates at masked pixels and concatenates
-    the result.
+    if dr not in _detectors:
+        apStarPixels = toAspcapGrid(np.arange(apStarpix,dtype=float),dr=dr)
+        gaps = np.where(np.diff(apStarPixels) != 1)[0]+1
+        _detectors[dr] = np.concatenate(([0],gaps,[len(apStarPixels)]))
+    return _detectors[dr]
+
+def runningMedian(yarray,window):
+    """
+    Finds the median of an array in a window centred on each element. The
+    window is cut short at the ends of the array.
+
+    yarray:   array to smooth
+    window:   number of elements in the window
+
+    Returns an array of running medians with the same length as yarray.
+    """
+    window = max(1,int(round(window)))
+    half = window//2
+    padded = np.concatenate((np.full(half,np.nan),yarray,
+                             np.full(window-1-half,np.nan)))
+    windows = np.lib.stride_tricks.sliding_window_view(padded,window)
+    return np.nanmedian(windows,axis=1)
+
+def _smoothDetector(diag,start,stop,frac=None,numpix=None,method='lowess',
+                    iterations=3):
+    """
+    Smooths the unmasked elements of an array on one detector and
+    interpolates at masked elements.
+
+    diag:         masked array to smooth
+    start:        first element on the detector
+    stop:         last+1 element on the detector
+    frac:         fraction of the detector to smooth over
+    numpix:       number of elements to smooth over, takes precedence over
+                  frac
+    method:       'lowess' or 'median'
+    iterations:   number of robustifying iterations of LOWESS
+
+    Returns an array with the length of diag, holding the smoothed values on
+    the detector and NaN elsewhere.
+    """
+    if method not in ('lowess','median'):
+        raise ValueError("method must be 'lowess' or 'median', not {0!r}".format(method))
+    xarray = np.arange(start,stop)
+    yarray = np.ma.getdata(diag)[start:stop]
+    array_mask = ~np.ma.getmaskarray(diag)[start:stop]
+    smoothed = np.full(len(diag),np.nan)
+    if np.sum(array_mask) < 2:
+        return smoothed
+    if numpix:
+        frac = float(numpix)/len(xarray)
+    if method == 'lowess':
+        smooth = sm.lowess(yarray[array_mask],xarray[array_mask],
+                           frac=frac,it=iterations,return_sorted=False)
+    elif method == 'median':
+        smooth = runningMedian(yarray[array_mask],frac*len(xarray))
+    smoothed[start:stop] = np.interp(xarray,xarray[array_mask],smooth,
+                                     left=np.nan,right=np.nan)
+    return smoothed
+
+# Smoothed arrays, keyed by the smoothing settings and the input array. Only
+# the most recent _smoothCacheSize arrays are kept.
+_smoothCache = {}
+_smoothCacheSize = 16
+
+def smoothMedian(diag,frac=None,numpix=None,method='lowess',iterations=3,
+                 dr=None,numcores=None):
+    """
+    Smooths an array on each detector separately, with Locally Weighted
+    Scatterplot Smoothing or a running median. Interpolates at masked pixels
+    and concatenates the result. Detectors are smoothed in parallel, and
+    results are cached for each set of smoothing parameters.
+
+    diag:         masked array to smooth, with a value for each ASPCAP pixel
+    frac:         fraction of each detector to smooth over
+    numpix:       number of pixels to smooth over, takes precedence over
+                  frac
+    method:       'lowess' for LOWESS, or 'median' for a faster running
+                  median
+    iterations:   number of robustifying iterations of LOWESS
+    dr:           data release, defaults to the current data release
+    numcores:     number of processes used, defaults to one per detector
+
+    Raises ValueError if method is not 'lowess' or 'median'.
 
     Returns the smoothed median value of the input array, with the same
     dimension.
     """
-    mask = diag.mask==False
+    if method not in ('lowess','median'):
+        raise ValueError("method must be 'lowess' or 'median', not {0!r}".format(method))
+    diag = np.ma.masked_array(diag)
+    key = (numpix,frac,method,iterations,dr,
+           np.ma.getdata(diag).tobytes(),np.ma.getmaskarray(diag).tobytes())
+    if key in _smoothCache:
+        return np.copy(_smoothCache[key])
+    detectors = detectorBoundaries(dr=dr)
+    if numcores is None:
+        numcores = len(detectors)-1
+    smoothed = ml.parallel_map(lambda i: _smoothDetector(diag,detectors[i],
+                                                         detectors[i+1],
+                                                         frac=frac,
+                                                         numpix=numpix,
+                                                         method=method,
+                                                         iterations=iterations),
+                               range(len(detectors)-1),numcores=numcores)
     smoothmedian = np.zeros(diag.shape)
-    for i in range(len(detectors)-1):
-        xarray = np.arange(detectors[i],detectors[i+1])
-        yarray = diag[detectors[i]:detectors[i+1]]
-        array_mask = mask[detectors[i]:detectors[i+1]]
-        if frac:
-            low_smooth = sm.lowess(yarray[array_mask],xarray[array_mask],
-                                   frac=frac,it=3,return_sorted=False)
-        if numpix:
-            frac = float(numpix)/len(xarray)
-            low_smooth = sm.lowess(yarray[array_mask],xarray[array_mask],
-                                   frac=frac,it=3,return_sorted=False)
-        smooth_interp = sp.interpolate.interp1d(xarray[array_mask],
-                                                low_smooth,bounds_error=False)
-        smoothmedian[detectors[i]:detectors[i+1]] = smooth_interp(xarray)
+    for i,smooth in enumerate(smoothed):
+        smoothmedian[detectors[i]:detectors[i+1]] = smooth[detectors[i]:detectors[i+1]]
     nanlocs = np.where(np.isnan(smoothmedian))
     smoothmedian[nanlocs] = 1
-    return smoothmedian
+    while len(_smoothCache) >= _smoothCacheSize:
+        # Dictionaries keep insertion order, so this drops the oldest array
+        _smoothCache.pop(next(iter(_smoothCache)))
+    _smoothCache[key] = smoothmedian
+    return np.copy(smoothmedian)
+
+
+class _mapResult(object):
+    """
+    Holds one result of parallel_map as a single object.
+
+    """
+    def __init__(self,value):
+        self.value = value
+
+def parallelMap(func,sequence,numcores=None):
+    """
+    Run a function over a sequence in parallel with galpy's parallel_map,
+    which joins results with np.concatenate. Each result is wrapped in an
+    object first, so tuples of arrays with different shapes are returned
+    unchanged.
 
+    func:       function to run
+    sequence:   sequence of arguments
+    numcores:   number of processes, defaults to the number of cores
+
+    Returns a list of the results.
+    """
+    results = ml.parallel_map(lambda x: _mapResult(func(x)),sequence,
+                              numcores=numcores)
+    return [result.value for result in results]
 
 def getsmallEMPCAarrays(model):
      """
@@ -118,7 +248,7 @@ class empca_residuals(mask):
     """
     def __init__(self,dataSource,sampleType,maskMaker,ask=True,datadict=None,
                  datadir='.',func=None,badcombpixmask=4351,minSNR=50,degree=2,
-                 nvecs=5,fibfit=False):
+                 nvecs=5,fibfit=False,precision='double',codec=None):
         """
         Fit a masked subsample.
 
@@ -134,12 +264,17 @@ class empca_residuals(mask):
         minSNR           minimum allowable signal to noise - pixels below this
                             threshold are masked
         degree:          degree of polynomial to fit
+        precision:       storage precision of spectra and bitmasks, 'double'
+                            or 'compact' (float32 spectra)
+        codec:           if set, compress the sample store with this codec
+                            ('zlib' or 'lzma')
 
 
         """
         mask.__init__(self,dataSource,sampleType,maskMaker,ask=ask,datadict=datadict,
                       minSNR=minSNR,datadir=datadir,func=func,
-                      badcombpixmask=badcombpixmask)
+                      badcombpixmask=badcombpixmask,precision=precision,
+                      codec=codec)
         self.degree = degree
         self.polynomial = PolynomialFeatures(degree=degree)
         self.fibfit=fibfit
@@ -157,52 +292,51 @@ class empca_residuals(mask):
 
         i:   index of subsample
 
-        If self.division is True, define the subsample as
-        where the randomly assigned sample numbers (self.inds) match i
-        If self.division is False, define the subsamples as
-        where the randomly assigned sample numbers (self.inds) do not match i
-
         """
         print('Working on {0}'.format(i+1))
-        # Select ith subsample and update arrays
-        # If sample is to be divided, find where assigned indices match i
-        if self.division:
-            self.matchingData = self.filterData[self.inds==i]
-            self.teff = self.originalteff[self.inds==i]
-            self.logg = self.originallogg[self.inds==i]
-            self.fe_h = self.originalfe_h[self.inds==i]
-            self.spectra = self.originalspectra[self.inds==i]
-            self.spectra_errs = self.originalspectra_errs[self.inds==i]
-            self._bitmasks = self.originalbitmasks[self.inds==i]
-            self._maskHere = self.originalmaskHere[self.inds==i]
-        # If sample is to be jackknived, find where assigned indices do not match i
-        if not self.division:
-            self.matchingData = self.filterData[self.inds!=i]
-            self.teff = self.originalteff[self.inds!=i]
-            self.logg = self.originallogg[self.inds!=i]
-            self.fe_h = self.originalfe_h[self.inds!=i]
-            self.spectra = self.originalspectra[self.inds!=i]
-            self.spectra_errs = self.originalspectra_errs[self.inds!=i]
-            self._bitmasks = self.originalbitmasks[self.inds!=i]
-            self._maskHere = self.originalmaskHere[self.inds!=i]
-        # Update mask
-        self.applyMask()
+        name = '{0}/seed{1}_{2}{3}of{4}/'.format(self.originalname,self.seed,
+                                                 self.splitname,i+1,
+                                                 self.subsamples)
+        return self.subsample_wrapper(self.subsampleWeights(i),name,i+1)
+
+    def task_wrapper(self,t):
+        """
+        A wrapper to run the distinct subsamples of a multiple seed run in
+        parallel.
+
+        t:   index of subsample in self.tasks
+
+        """
+        print('Working on task {0} of {1}'.format(t+1,len(self.tasks)))
+        weights,name,samplenum = self.tasks[t]
+        return self.subsample_wrapper(weights,name,samplenum)
+
+    def subsample_wrapper(self,weights,name,samplenum):
+        """
+        Fit a subsample and run EMPCA on it for each variance function.
+
+        weights:     subsample weight for each star
+        name:        directory in which to save results for this subsample
+        samplenum:   number of this subsample, used in labels
+
+        Returns R^2 statistics and labels for each variance function.
+        """
+        # Select subsample by weighting stars in the shared parent arrays
+        self.setSubsample(weights)
         # Update name
-        self.name = '{0}/seed{1}_subsample{2}of{3}/'.format(self.originalname,
-                                                            self.seed,i+1,
-                                                            self.subsamples)
+        self.name = name
         # Create directory and solve for polynomial  fit coefficients
         self.getDirectory()
-        self.findResiduals()
+        self.findResiduals(save=not self.inmemory)
         # Create output arrays to hold EMPCA results for each variance function
         self.R2As = np.zeros((len(self.varfuncs),self.nvecs+1))
         self.R2ns = np.zeros((len(self.varfuncs)))
         self.cvcs = np.zeros((len(self.varfuncs)))
         self.labs = np.zeros((len(self.varfuncs)),dtype='S100')
         # Store information about which sample you're on
-        self.samplenum = i+1
+        self.samplenum = samplenum
         # Call EMPCA solver for all variance functions in parallel
-        stat = ml.parallel_map(self.EMPCA_wrapper,range(len(self.varfuncs)))
+        stat = parallelMap(self.EMPCA_wrapper,range(len(self.varfuncs)))
         print('Did EMPCA')
         # Unpack results of running in parallel and store
         for s in range(len(stat)):
@@ -212,18 +346,14 @@ class empca_residuals(mask):
             self.cvcs[s] = cvc
             self.labs[s] = lab
         print('Got stats')
-        # Clear arrays from memory
-        del self.matchingData
-        del self.teff
-        del self.logg
-        del self.fe_h
-        del self.spectra
-        del self.spectra_errs
-        del self._bitmasks
-        del self._maskHere
+        # If kept in memory, only the statistics for this subsample are saved
+        if self.inmemory:
+            np.savez('{0}/R2stats.npz'.format(self.name),R2Arrays=self.R2As.T,
+                     R2noises=self.R2ns,crossvecs=self.cvcs,labels=self.labs)
         # Clean directory of all but EMPCA files (don't store residuals)
-        self.directoryClean()
-        print('Cleaned')
+        elif not self.inmemory:
+            self.directoryClean()
+            print('Cleaned')
         print('R2, R2noise, cvcs, labels'.format(self.R2As.T,self.R2ns,self.cvcs,self.labs))
         return (self.R2As.T,self.R2ns,self.cvcs,self.labs)
 
@@ -233,9 +363,12 @@ class empca_residuals(mask):
 
         v:   Index of function to calculate variance in self.varfuncs
         """
-        # run EMPCA
+        # run EMPCA, only saving the model if not kept in memory
+        savename = None
+        if not self.inmemory:
+            savename = 'eig{0}_minSNR{1}_corrNone_{2}.pkl'.format(self.nvecs,self.minSNR,self.varfuncs[v].__name__)
         self.pixelEMPCA(varfunc=self.varfuncs[v],nvecs=self.nvecs,
-                        savename='eig{0}_minSNR{1}_corrNone_{2}.pkl'.format(self.nvecs,self.minSNR,self.varfuncs[v].__name__))
+                        savename=savename)
         # Find R^2 values
         R2A = self.empcaModelWeight.R2Array
         R2n = self.empcaModelWeight.R2noise
@@ -246,7 +379,224 @@ class empca_residuals(mask):
         print('Found intersection')
         return (R2A,R2n,cvc,lab)
 
-    def samplesplit(self,division=False,seed=None,fullsamp=True,maxsamp=5,subsamples=5,varfuncs=[np.ma.var,meanMed],numcores=None,ctmnorm=None):
+    def setupSplit(self,subsamples,varfuncs,division,bootstrap,inmemory,
+                   fullsamp):
+        """
+        Store options shared by all subsamples of a split.
+
+        subsamples:   number of subsamples to divide up full samples, or
+                      number of resamplings if bootstrap is True
+        varfuncs:     list of functions to compute variance in EMPCA
+        division:     if True, split sample - if False, jackknife sample
+        bootstrap:    if True, resample stars with replacement
+        inmemory:     if True, only save R^2 statistics for each subsample
+        fullsamp:     if True, also process undivided full sample
+
+        """
+        self.subsamples = subsamples
+        self.varfuncs = varfuncs
+        self.division=division
+        self.bootstrap=bootstrap
+        self.inmemory=inmemory
+        if self.bootstrap:
+            self.splitname = 'bootstrap'
+        elif not self.bootstrap:
+            self.splitname = 'subsample'
+        if fullsamp:
+            self.sampnum = self.subsamples+1
+        elif not fullsamp:
+            self.sampnum = self.subsamples
+
+    def assignSubsamples(self):
+        """
+        Randomly assign stars to subsamples, using the current state of the
+        numpy random number generator.
+
+        """
+        # Draw each bootstrap resampling as the number of times each star
+        # is chosen, with the full sample as a final row of ones
+        if self.bootstrap:
+            self.multiplicity = np.ones((self.subsamples+1,self.numberStars()),dtype=int)
+            for i in range(self.subsamples):
+                draws = np.random.randint(0,self.numberStars(),size=self.numberStars())
+                self.multiplicity[i] = np.bincount(draws,minlength=self.numberStars())
+        # Initialize array that assigns each star to a group from 0
+        # To self.subsamples-1
+        self.inds = np.zeros((self.numberStars()))-1
+        # Number of stars in each subsample
+        subnum = self.numberStars()//self.subsamples
+        # Randomly choose stars to belong to each subsample
+        for i in range(self.subsamples):
+            group = np.random.choice(np.where(self.inds==-1)[0],size=subnum,replace=False)
+            self.inds[group] = i
+        # Distribute leftover stars one at a time to each subsample
+        leftovers = [i for i in range(self.numberStars()) if self.inds[i]==-1]
+        if leftovers != []:
+            k = 0
+            for i in leftovers:
+                self.inds[i] = k
+                k+=1
+
+    def subsampleWeights(self,i):
+        """
+        Find the weight of each star in the ith subsample.
+
+        i:   index of subsample
+
+        If self.bootstrap is True, weight each star by the number of times
+        it was drawn for the ith resampling (self.multiplicity[i])
+        If self.division is True, define the subsample as
+        where the randomly assigned sample numbers (self.inds) match i
+        If self.division is False, define the subsamples as
+        where the randomly assigned sample numbers (self.inds) do not match i
+
+        Returns an array of weights with one entry per star.
+        """
+        # If sample is bootstrapped, weight stars by how often they were drawn
+        if self.bootstrap:
+            return self.multiplicity[i]
+        # If sample is to be divided, keep stars where assigned indices match i
+        elif self.division:
+            return self.inds==i
+        # If sample is to be jackknived, keep stars where assigned indices do not match i
+        elif not self.division:
+            return self.inds!=i
+
+    def numeigvecStats(self,cvec,samplenums,percentiles=[2.5,97.5]):
+        """
+        Find the number of eigenvectors needed and its uncertainty from the
+        crossover points of each subsample for a single variance function.
+
+        cvec:          crossover point for each subsample
+        samplenums:    number of each subsample, where the full sample is
+                       number self.subsamples+1
+        percentiles:   percentiles of the bootstrap distribution of crossover
+                       points to report as a confidence interval
+
+        Returns an array holding the median number of eigenvectors and its
+        standard deviation, or the median and the bootstrap interval if
+        self.bootstrap is True.
+        """
+        # Don't use the full sample value if its in the list, so only
+        # resampled results are used for the bootstrap interval
+        cvec = np.asarray(cvec)[np.asarray(samplenums)!=self.subsamples+1]
+        # Don't use crossover values flagged as greater than the total amount found
+        cvec = cvec[cvec!=-1]
+        if self.bootstrap:
+            if cvec.size:
+                avgvec = np.median(cvec)
+                lovec,hivec = np.percentile(cvec,percentiles)
+            elif not cvec.size:
+                avgvec = -1
+                lovec = -1
+                hivec = -1
+            print('{0} ({1} - {2})'.format(avgvec,lovec,hivec))
+            return np.array([avgvec,lovec,hivec],dtype=float)
+        if cvec.size:
+            avgvec = np.median(cvec)
+            if not self.division:
+                varvec = ((len(cvec)-1.)/float(len(cvec)))*np.sum((cvec-avgvec)**2)
+            elif self.division:
+                varvec = np.var(cvec)
+            stdvec = np.sqrt(varvec)
+        # Flag the standard deviation like the number of eigenvectors
+        elif not cvec.size:
+            avgvec = -1
+            stdvec = -1
+        print('{0} +/- {1}'.format(avgvec,stdvec))
+        return np.array([avgvec,stdvec],dtype=float)
+
+    def numeigvecName(self,v,seed=None,prefix=''):
+        """
+        Find the file name for the number of eigenvectors found with the vth
+        variance function.
+
+        v:        Index of function to calculate variance in self.varfuncs
+        seed:     seed label to use in the name, defaults to self.seed
+        prefix:   string to put at the start of the file name
+
+        Returns the path to the file.
+        """
+        if seed is None:
+            seed = self.seed
+        if self.bootstrap:
+            return '{0}/{1}bootstrap{2}_{3}_seed{4}_numeigvec.npy'.format(self.name,prefix,self.subsamples,self.varfuncs[v].__name__,seed)
+        elif not self.bootstrap:
+            return '{0}/{1}subsamples{2}_{3}_seed{4}_numeigvec.npy'.format(self.name,prefix,self.subsamples,self.varfuncs[v].__name__,seed)
+
+    def splitStatistics(self,stats,percentiles=[2.5,97.5]):
+        """
+        Combine the results of all subsamples for the current seed, save the
+        number of eigenvectors for each variance function and plot R^2
+        statistics.
+
+        stats:         list with R^2 statistics and labels for each subsample,
+                       as returned by subsample_wrapper
+        percentiles:   percentiles of the bootstrap distribution of crossover
+                       points to report as a confidence interval
+
+        Returns an array with the number of eigenvectors and its uncertainty
+        for each variance function.
+        """
+        # Create arrays to hold R^2 statistics and their labels
+        R2Arrays = np.zeros((len(self.varfuncs)*(self.sampnum),
+                             self.nvecs+1))
+        R2noises = np.zeros((len(self.varfuncs)*(self.sampnum)))
+        crossvecs = np.zeros((len(self.varfuncs)*(self.sampnum)))
+        labels = np.zeros((len(self.varfuncs)*(self.sampnum)),dtype='S200')
+        # Unpack information from parallel runs into appropriate arrays
+        print('stats ',stats)
+        k = 0
+        for s in range(len(stats)):
+            R2As,R2ns,cvcs,labs = stats[s]
+            R2Arrays[k:k+len(self.varfuncs)] = R2As.T
+            R2noises[k:k+len(self.varfuncs)] = R2ns
+            crossvecs[k:k+len(self.varfuncs)] = cvcs
+            labels[k:k+len(self.varfuncs)] = labs
+            k+=len(self.varfuncs)
+        # Calculate uncertainty on number of eigenvectors.
+        sort = self.func_sort(R2Arrays,R2noises,crossvecs,labels)
+        cvecs = sort[2]
+        # Subsample numbers in the order of stats, repeated for each
+        # variance function by func_sort
+        samplenums = np.arange(1,len(stats)+1)
+        start = 0
+        numeigvecs = []
+        # Calculate for each variance function separately
+        for v in range(len(self.varfuncs)):
+            # Number of crossover values to use for this variance function
+            num = len(cvecs)//len(self.varfuncs)
+            cvec = cvecs[start:start+num]
+            start+=num
+            numeigvec_file = self.numeigvecStats(cvec,samplenums,
+                                                 percentiles=percentiles)
+            # Save results
+            self.numeigvec = numeigvec_file[0]
+            if self.bootstrap:
+                self.numeigvec_interval = numeigvec_file[1:]
+            elif not self.bootstrap:
+                self.numeigvec_std = numeigvec_file[1]
+            numeigvec_file.tofile(self.numeigvecName(v))
+            numeigvecs.append(numeigvec_file)
+        # Make plots sorting by function
+        self.R2compare(R2Arrays,R2noises,crossvecs,labels,funcsort=True)
+        self.R2compare(R2Arrays,R2noises,crossvecs,labels,funcsort=False)
+        return np.array(numeigvecs)
+
+    def moveFullSample(self,seed):
+        """
+        Move full sample analysis to parent directory.
+
+        seed:   seed used in the name of the full sample directory
+
+        """
+        fulldir = '{0}/seed{1}_{2}{3}of{4}'.format(self.name,seed,self.splitname,self.subsamples+1,self.subsamples)
+        for fname in os.listdir(fulldir):
+            shutil.move(os.path.join(fulldir,fname),
+                        os.path.join(self.name,fname))
+        os.rmdir(fulldir)
+
+    def samplesplit(self,division=False,seed=None,fullsamp=True,maxsamp=5,subsamples=5,varfuncs=[np.ma.var,meanMed],numcores=None,ctmnorm=None,bootstrap=False,percentiles=[2.5,97.5],inmemory=False):
         """
         Take self.subsamples random subsamples of the original data set and
         run EMPCA.
@@ -255,30 +605,36 @@ class empca_residuals(mask):
         seed:         seed to randomly distribute stars into subsamples
         fullsamp:     if True, also process undivided full sample
         maxsamp:      maximum number of samples to run simultaneously
-        subsamples:   number of subsamples to divide up full samples
+        subsamples:   number of subsamples to divide up full samples, or
+                      number of resamplings if bootstrap is True
         varfuncs:     list of functions to compute variance in EMPCA
         numcores:     maximum number of simultaneous parallel processes
         ctnnorm:      if set, renormalize for continuum
+        bootstrap:    if True, resample stars with replacement instead of
+                      splitting the sample, overrides division
+        percentiles:  percentiles of the bootstrap distribution of crossover
+                      points to report as a confidence interval
+        inmemory:     if True, keep fit residuals and EMPCA models in memory
+                      and only save R^2 statistics for each subsample
 
         Creates a plot comparing R^2 statistics for the subsamples.
 
         """
-        self.subsamples = subsamples
-        self.varfuncs = varfuncs
-        self.division=division
+        self.setupSplit(subsamples,varfuncs,division,bootstrap,inmemory,
+                        fullsamp)
         if numcores:
-            maxsamp = np.floor(float(numcores)/len(self.varfuncs))
+            maxsamp = int(np.floor(float(numcores)/len(self.varfuncs)))
         # If no subsamples, just run regular EMCPA
         if self.subsamples==1:
             self.continuumNormalize(source=ctmnorm)
-            self.findResiduals()
+            self.findResiduals(save=not self.inmemory)
             R2Arrays = np.zeros((len(self.varfuncs),self.nvecs+1))
             R2noises = np.zeros((len(self.varfuncs)))
             crossvecs = np.zeros((len(self.varfuncs)))
             labels = np.zeros(len(self.varfuncs),dtype='S100')
             self.samplenum=1
             # Call EMPCA solver for all variance functions in parallel
-            stat = ml.parallel_map(self.EMPCA_wrapper,range(len(self.varfuncs)))
+            stat = parallelMap(self.EMPCA_wrapper,range(len(self.varfuncs)))
             # Unpack results of running in parallel and store
             for s in range(len(stat)):
                 R2A,R2n,cvc,lab = stat[s]
@@ -286,6 +642,9 @@ class empca_residuals(mask):
                 R2noises[s] = R2n
                 crossvecs[s] = cvc
                 labels[s] = lab
+            # Make plots sorting by function
+            self.R2compare(R2Arrays,R2noises,crossvecs,labels,funcsort=True)
+            self.R2compare(R2Arrays,R2noises,crossvecs,labels,funcsort=False)
 
         # If subsamples, run EMPCA on many subsamples
         elif self.subsamples!=1:
@@ -296,132 +655,128 @@ class empca_residuals(mask):
                 self.seed=seed
             np.random.seed(self.seed)
             self.continuumNormalize(source=ctmnorm)
-            # Make copies of original data to use for slicing
-            self.filterData = np.copy(self.matchingData)
-            self.originalteff = np.ma.copy(self.teff)
-            self.originallogg = np.ma.copy(self.logg)
-            self.originalfe_h = np.ma.copy(self.fe_h)
-            self.originalspectra = np.ma.copy(self.spectra)
-            self.originalspectra_errs = np.ma.copy(self.spectra_errs)
-            self.originalbitmasks = np.copy(self._bitmasks)
-            self.originalmaskHere = np.copy(self._maskHere)
+            # Subsamples are selected by weighting stars, so only the name
+            # needs to be restored afterwards
             self.originalname = np.copy(self.name)
-            # Initialize array that assigns each star to a group from 0
-            # To self.subsamples-1
-            self.inds = np.zeros((self.numberStars()))-1
-            # Number of stars in each subsample
-            subnum = self.numberStars()/self.subsamples
-            # Randomly choose stars to belong to each subsample
-            for i in range(self.subsamples):
-                group = np.random.choice(np.where(self.inds==-1)[0],size=subnum,replace=False)
-                self.inds[group] = i
-            # Distribute leftover stars one at a time to each subsample
-            leftovers = [i for i in range(self.numberStars()) if self.inds[i]==-1]
-            if leftovers != []:
-                k = 0
-                for i in leftovers:
-                    self.inds[i] = k
-                    k+=1
-            # Create arrays to hold R^2 statistics and their labels
-            if fullsamp:
-                self.sampnum = self.subsamples+1
-            elif not fullsamp:
-                self.sampnum = self.subsamples
-            R2Arrays = np.zeros((len(self.varfuncs)*(self.sampnum),
-                                 self.nvecs+1))
-            R2noises = np.zeros((len(self.varfuncs)*(self.sampnum)))
-            crossvecs = np.zeros((len(self.varfuncs)*(self.sampnum)))
-            labels = np.zeros((len(self.varfuncs)*(self.sampnum)),dtype='S200')
+            self.assignSubsamples()
             # Run all samples in parallel but serialize if too large
             if self.sampnum <=maxsamp:
-                stats = ml.parallel_map(self.sample_wrapper, range(self.sampnum))
+                stats = parallelMap(self.sample_wrapper, range(self.sampnum))
             elif self.sampnum >maxsamp:
                 sample = 0
                 stats = []
                 # Find the number of sets of size maxsamp that need to run
-                number_sets = self.sampnum/maxsamp + int(self.sampnum % maxsamp > 0)
+                number_sets = self.sampnum//maxsamp + int(self.sampnum % maxsamp > 0)
                 # If maxsamp a factor of self.sampnum take the easy route
-                if self.sampnum/maxsamp == number_sets:
+                if self.sampnum//maxsamp == number_sets:
                     for i in range(number_sets):
-                        ss = ml.parallel_map(self.sample_wrapper, range(sample,sample+maxsamp))
+                        ss = parallelMap(self.sample_wrapper, range(sample,sample+maxsamp))
                         sample += maxsamp
                         stats.append(ss)
                 # If maxsamp not a factor of self.sampnum, run the regular sized runs then one smaller run
-                elif self.sampnum/maxsamp != number_sets:
+                elif self.sampnum//maxsamp != number_sets:
                     for i in range(number_sets):
                         if i < number_sets-1:
-                            ss = ml.parallel_map(self.sample_wrapper, range(sample,sample+maxsamp))
+                            ss = parallelMap(self.sample_wrapper, range(sample,sample+maxsamp))
                             sample += maxsamp
                             stats.append(ss)
                         if i == number_sets-1:
-                            ss = ml.parallel_map(self.sample_wrapper, range(sample,sample+self.sampnum % maxsamp))
+                            ss = parallelMap(self.sample_wrapper, range(sample,sample+self.sampnum % maxsamp))
                             sample += self.sampnum% maxsamp
                             stats.append(ss)
                 # Unpack run statistics from sublist
                 stats = [item for sublist in stats for item in sublist]
-            # Unpack information from parallel runs into appropriate arrays
-            print('stats ',stats)
-            k = 0
-            for s in range(len(stats)):
-                R2As,R2ns,cvcs,labs = stats[s]
-                R2Arrays[k:k+len(self.varfuncs)] = R2As.T
-                R2noises[k:k+len(self.varfuncs)] = R2ns
-                crossvecs[k:k+len(self.varfuncs)] = cvcs
-                labels[k:k+len(self.varfuncs)] = labs
-                k+=len(self.varfuncs)
-            # Restore original arrays
-            self.matchingData = self.filterData
-            self.teff = self.originalteff
-            self.logg = self.originallogg
-            self.fe_h = self.originalfe_h
-            self.spectra = self.originalspectra
-            self.spectra_errs = self.originalspectra_errs
-            self._bitmasks = self.originalbitmasks
-            self._maskHere = self.originalmaskHere
+            # Restore full sample and update mask
+            self.setSubsample(None)
             self.name = str(self.originalname)
-            # Update mask
-            self.applyMask()
-            # Calculate uncertainty on number of eigenvectors.
-            sort = self.func_sort(R2Arrays,R2noises,crossvecs,labels)
-            labs = sort[3]
-            cvecs = sort[2]
-            start = 0
-            # Calculate for each variance function separately
-            for v in range(len(self.varfuncs)):
-                # Number of crossover values to use for this variance function
-                num = len(cvecs)/len(self.varfuncs)
-                lab = labs[start:start+num]
-                cvec = cvecs[start:start+num]
-                start+=num
-                # Don't use the full sample value if its in hte list
-                safe = np.array([i for i in range(len(lab)) if 'subsamp{0}'.format(self.subsamples+1) not in lab[i]])
-                cvec = cvec[safe]
-                # Don't use crossover values flagged as greater than the total amount found
-                cvec = cvec[cvec!=-1]
-                if cvec.size:
-                    avgvec = np.median(cvec)
-                    if not self.division:
-                        varvec = ((len(cvec)-1.)/float(len(cvec)))*np.sum((cvec-avgvec)**2)
-                    elif self.division:
-                        varvec = np.var(cvec)
-                elif not cvec.size:
-                    avgvec = -1
-                    varvec = -1
-                print('{0} +/- {1}'.format(avgvec,np.sqrt(varvec)))
-                # Save results
-                self.numeigvec = avgvec
-                self.numeigvec_std = np.sqrt(varvec)
-                numeigvec_file = np.array([self.numeigvec,self.numeigvec_std])
-                numeigvec_file.tofile('{0}/subsamples{1}_{2}_seed{3}_numeigvec.npy'.format(self.name,self.subsamples,self.varfuncs[v].__name__,self.seed))
-        # Move full sample analysis to parent directory
-        if fullsamp:
-            os.system('mv {0}/seed{1}_subsample{2}of{3}/* {4}'.format(self.name,self.seed,self.subsamples+1,self.subsamples,self.name))
-            os.system('rmdir {0}/seed{1}_subsample{2}of{3}/'.format(self.name,self.seed,self.subsamples+1,self.subsamples))
-        # Make plots sorting by function
-        self.R2compare(R2Arrays,R2noises,crossvecs,labels,funcsort=True)
-        self.R2compare(R2Arrays,R2noises,crossvecs,labels,funcsort=False)
+            # Save number of eigenvectors and make plots
+            self.splitStatistics(stats,percentiles=percentiles)
+            # Move full sample analysis to parent directory
+            if fullsamp:
+                self.moveFullSample(self.seed)
 
+    def multiseedsplit(self,seeds,division=False,fullsamp=True,maxsamp=5,subsamples=5,varfuncs=[np.ma.var,meanMed],numcores=None,ctmnorm=None,bootstrap=False,percentiles=[2.5,97.5],inmemory=False):
+        """
+        Run samplesplit for several seeds while only preparing the sample
+        once. Subsamples of all seeds run in a single parallel pool, and
+        subsamples that are identical between seeds (such as the full
+        sample) are only run once.
 
+        seeds:        list of seeds to randomly distribute stars into
+                      subsamples
+        division:     if True, split sample - if False, jackknife sample
+        fullsamp:     if True, also process undivided full sample
+        maxsamp:      maximum number of samples to run simultaneously
+        subsamples:   number of subsamples to divide up full samples, or
+                      number of resamplings if bootstrap is True
+        varfuncs:     list of functions to compute variance in EMPCA
+        numcores:     maximum number of simultaneous parallel processes
+        ctnnorm:      if set, renormalize for continuum
+        bootstrap:    if True, resample stars with replacement instead of
+                      splitting the sample, overrides division
+        percentiles:  percentiles of the bootstrap distribution of crossover
+                      points to report as a confidence interval
+        inmemory:     if True, keep fit residuals and EMPCA models in memory
+                      and only save R^2 statistics for each subsample
+
+        Saves the number of eigenvectors for each seed and averaged over all
+        seeds, and creates plots comparing R^2 statistics for each seed.
+
+        """
+        self.setupSplit(subsamples,varfuncs,division,bootstrap,inmemory,
+                        fullsamp)
+        if numcores:
+            maxsamp = int(np.floor(float(numcores)/len(self.varfuncs)))
+        self.continuumNormalize(source=ctmnorm)
+        self.originalname = np.copy(self.name)
+        # Find subsamples for every seed, keeping only distinct ones
+        self.tasks = []
+        taskkeys = {}
+        taskinds = np.zeros((len(seeds),self.sampnum),dtype=int)
+        for s in range(len(seeds)):
+            self.seed = seeds[s]
+            np.random.seed(self.seed)
+            self.assignSubsamples()
+            for i in range(self.sampnum):
+                weights = self.subsampleWeights(i)
+                key = weights.tobytes()
+                if key not in taskkeys:
+                    taskkeys[key] = len(self.tasks)
+                    name = '{0}/seed{1}_{2}{3}of{4}/'.format(self.originalname,
+                                                             self.seed,
+                                                             self.splitname,
+                                                             i+1,
+                                                             self.subsamples)
+                    self.tasks.append((weights,name,i+1))
+                taskinds[s,i] = taskkeys[key]
+        print('Running {0} distinct subsamples for {1} seeds'.format(len(self.tasks),len(seeds)))
+        stats = parallelMap(self.task_wrapper,range(len(self.tasks)),
+                            numcores=maxsamp)
+        # Restore full sample and update mask
+        self.setSubsample(None)
+        self.name = str(self.originalname)
+        # Save number of eigenvectors and make plots for each seed
+        numeigvecs = np.zeros((len(seeds),len(self.varfuncs),
+                               2+int(self.bootstrap)))
+        for s in range(len(seeds)):
+            self.seed = seeds[s]
+            numeigvecs[s] = self.splitStatistics([stats[t] for t in taskinds[s]],
+                                                 percentiles=percentiles)
+        # Save results averaged over seeds, leaving out seeds where R^2
+        # never crossed R^2_noise
+        seedlabel = '-'.join([str(seed) for seed in seeds])
+        for v in range(len(self.varfuncs)):
+            crossed = numeigvecs[:,v,0]!=-1
+            if np.any(crossed):
+                pooled = np.mean(numeigvecs[crossed,v],axis=0)
+            elif not np.any(crossed):
+                pooled = -np.ones(numeigvecs.shape[2])
+            pooled.tofile(self.numeigvecName(v,seed=seedlabel,prefix='pooled_'))
+        self.numeigvecs = numeigvecs
+        # Move full sample analysis to parent directory, where the full
+        # sample was run under the first seed
+        if fullsamp:
+            self.moveFullSample(seeds[0])
 
     def func_sort(self,R2Arrays,R2noises,crossvecs,labels):
         """
@@ -471,6 +826,9 @@ class empca_residuals(mask):
         # accordingly
         if funcsort:
             R2Arrays,R2noises,crossvecs,labels = self.func_sort(R2Arrays,R2noises,crossvecs,labels)
+        # Labels are stored as bytes in arrays
+        labels = [label.decode() if isinstance(label,bytes) else label
+                  for label in labels]
         # Get colours for line plot
         colors = plt.get_cmap('plasma')(np.linspace(0,0.85,len(labels)))
         # If there aren't too many lines, make a 1D line plot of R2
@@ -555,7 +913,8 @@ class empca_residuals(mask):
         if matrix=='default':
             matrix=self._sampleType
         # Find the number of unmasked stars at this pixel
-        numberStars = len(self.spectra[:,pixel][self.unmasked[:,pixel]])
+        unmasked = self.unmaskedStars(pixel)
+        numberStars = np.sum(unmasked)
         # Create basic independent variable array
         if not self.fibfit:
             indeps = np.zeros((numberStars,
@@ -566,10 +925,10 @@ class empca_residuals(mask):
 
         for i in range(len(independentVariables[self._dataSource][matrix])):
             variable = independentVariables[self._dataSource][matrix][i]
-            indep = self.keywordMap[variable][self.unmasked[:,pixel]]
+            indep = self.keywordMap[variable][unmasked]
             indeps[:,i] = indep-np.ma.median(indep)
         if self.fibfit:
-            indeps[:,-1] = self.fwhms_sample[:,pixel][self.unmasked[:,pixel]]
+            indeps[:,-1] = self.fwhms_sample[:,pixel][unmasked]
         # use polynomial to produce matrix with all necessary columns
         return np.matrix(self.polynomial.fit_transform(indeps))
 
@@ -582,13 +941,16 @@ class empca_residuals(mask):
         for p in tqdm(range(aspcappix),'fibfit'):
             fullindeps = fwhms_sample[:,p]
             fullindeps -= np.ma.median(fullindeps)
-            indeps = fullindeps[self.unmasked[:,p]]
+            indeps = fullindeps[self.unmaskedStars(p)]
             indeps = np.matrix(self.polynomial.fit_transform(indeps.reshape(-1,1)))
             fullindeps = np.matrix(self.polynomial.fit_transform(fullindeps.reshape(-1,1)))
-            covInverse = np.diag(1./self.spectra_errs[:,p][self.unmasked[:,p]]**2)
-            starsAtPixel = np.matrix(self.spectra[:,p][self.unmasked[:,p]])
-            newIndeps = np.dot(indeps.T,np.dot(covInverse,indeps))
-            newStarsAtPixel = np.dot(indeps.T,np.dot(covInverse,starsAtPixel.T))
+            unmasked = self.unmaskedStars(p)
+            weights = 1./np.ma.getdata(self.spectra_errs)[unmasked,p].astype(float)**2
+            starsAtPixel = np.ma.getdata(self.spectra)[unmasked,p].astype(float)
+            newIndeps = np.matrix(np.dot(np.asarray(indeps).T*weights,
+                                         np.asarray(indeps)))
+            newStarsAtPixel = np.matrix(np.dot(np.asarray(indeps).T*weights,
+                                               starsAtPixel)).T
             invNewIndeps = np.linalg.inv(newIndeps)
             coeffs = np.dot(invNewIndeps,newStarsAtPixel)
             #coeffs = np.linalg.lstsq(newIndeps,newStarsAtPixel)[0]
@@ -619,14 +981,19 @@ class empca_residuals(mask):
         self.numparams = indeps.shape[1]
         # If no coefficients given, find them
         if givencoeffs == []:
-            # calculate inverse covariance matrix
-            covInverse = np.diag(1./self.spectra_errs[:,pixel][self.unmasked[:,pixel]]**2)
+            # find inverse variance weights, counting each star by its
+            # subsample weight (the diagonal of the inverse covariance)
+            # (compact samples are upcast here so the fit is done in double
+            # precision)
+            unmasked = self.unmaskedStars(pixel)
+            weights = self.pixelWeights(pixel)[unmasked]
             # find matrix for spectra values
-            starsAtPixel = np.matrix(self.spectra[:,pixel][self.unmasked[:,pixel]])
+            starsAtPixel = np.ma.getdata(self.spectra)[unmasked,pixel].astype(float)
 
             # transform to matrices that have been weighted by the inverse
             # covariance
-            newIndeps = np.dot(indeps.T,np.dot(covInverse,indeps))
+            newIndeps = np.matrix(np.dot(np.asarray(indeps).T*weights,
+                                         np.asarray(indeps)))
 
             # Degeneracy check
             degen = False
@@ -637,7 +1004,8 @@ class empca_residuals(mask):
                     degen = True
                     indeps = indeps.T[self.noncrossInds].T
 
-            newStarsAtPixel = np.dot(indeps.T,np.dot(covInverse,starsAtPixel.T))
+            newStarsAtPixel = np.matrix(np.dot(np.asarray(indeps).T*weights,
+                                               starsAtPixel)).T
             try:
                 invNewIndeps = np.linalg.inv(newIndeps)
                 # calculate fit coefficients
@@ -662,7 +1030,7 @@ class empca_residuals(mask):
                 except UnboundLocalError:
                     coeffs = newcoeffs.T
                     coeff_errs = newcoeff_errs
-                    bestFit = np.zeros(len(self.spectra[:,pixel][self.unmasked[:,pixel]]))
+                    bestFit = np.zeros(np.sum(unmasked))
         # If coefficients given, use those
         elif givencoeffs != []:
             coeffs,coeff_errs = givencoeffs
@@ -698,24 +1066,29 @@ class empca_residuals(mask):
                                                       self.numparams)))
         self.fitCoeffErrs = np.ma.masked_array(np.zeros((aspcappix,
                                                          self.numparams)))
-        self.fitSpectra = np.ma.masked_array(np.zeros((self.spectra.shape)),
-                                             mask = self.spectra.mask)
+        # fit values are kept in a plain array and masked when done, with
+        # rows only for stars in the current subsample
+        rows = self.subsampleRows()
+        self._residualRows = rows
+        self._residualStars = self.subsampleStars()
+        fitSpectra = np.zeros((len(self._residualStars),aspcappix))
+
+        # number of unmasked stars at each pixel
+        starCounts = self.unmaskedCount()
 
         if not coeffs:
 
             # perform fit at all pixels with enough stars
             for pixel in tqdm(range(aspcappix),desc='fit'):
-                if np.sum(self.unmasked[:,pixel].astype(int)) < self.minStarNum:
+                if starCounts[pixel] < self.minStarNum:
                     # if too many stars missing, update mask
-                    self.fitSpectra[:,pixel].mask = np.ones(self.spectra.shape[1])
                     self.fitCoeffs[pixel].mask = np.ones(self.numparams)
                     self.fitCoeffErrs[pixel].mask = np.ones(self.numparams)
-                    self.unmasked[:,pixel] = np.zeros(self.unmasked[:,pixel].shape)
-                    self.masked[:,pixel] = np.ones(self.masked[:,pixel].shape)
+                    self.maskPixel(pixel)
                 else:
                     # if fit possible update arrays
                     fitSpectrum,coefficients,coefficient_uncertainty = self.findFit(pixel,eigcheck=eigcheck,matrix=matrix)
-                    self.fitSpectra[:,pixel][self.unmasked[:,pixel]] = np.array(fitSpectrum).flatten()
+                    fitSpectra[self.unmaskedStars(pixel)[rows],pixel] = np.array(fitSpectrum).flatten()
                     self.fitCoeffs[pixel] = coefficients
                     self.fitCoeffErrs[pixel] = coefficient_uncertainty
         elif coeffs:
@@ -723,20 +1096,19 @@ class empca_residuals(mask):
             self.fitCoeffs = np.ma.masked_array(np.load(self.name+'/fitcoeffs.npy'),mask=fmask)
             self.fitCoeffErrs = np.ma.masked_array(np.load(self.name+'/fitcoefferrs.npy'),mask=fmask)
             for pixel in tqdm(range(aspcappix),desc='fit'):
-                if np.sum(self.unmasked[:,pixel].astype(int)) < self.minStarNum:
+                if starCounts[pixel] < self.minStarNum:
                     # if too many stars missing, update mask
-                    self.fitSpectra[:,pixel].mask = np.ones(self.spectra.shape[1])
                     self.fitCoeffs[pixel].mask = np.ones(self.numparams)
                     self.fitCoeffErrs[pixel].mask = np.ones(self.numparams)
-                    self.unmasked[:,pixel] = np.zeros(self.unmasked[:,pixel].shape)
-                    self.masked[:,pixel] = np.ones(self.masked[:,pixel].shape)
+                    self.maskPixel(pixel)
                 else:
                      # if fit possible update arrays
                     fitSpectrum,coefficients,coefficient_uncertainty = self.findFit(pixel,eigcheck=eigcheck,givencoeffs = [self.fitCoeffs[pixel],self.fitCoeffErrs[pixel]],matrix=matrix)
-                    self.fitSpectra[:,pixel][self.unmasked[:,pixel]] = fitSpectrum
+                    fitSpectra[self.unmaskedStars(pixel)[rows],pixel] = np.array(fitSpectrum).flatten()
 
         # update mask on input data
         self.applyMask()
+        self.fitSpectra = np.ma.masked_array(fitSpectra,mask=self.masked[rows])
 
     def plot_example_fit(self,indep=1,pixel=0,figsize=(12,8),
                          xlabel='$T_{\mathrm{eff}}$ - median($T_{\mathrm{eff}}$) (K)'):
@@ -795,7 +1167,7 @@ class empca_residuals(mask):
         # Plot residuals of the fit
         ax=plt.subplot2grid((3,1),(2,0))
         plt.axhline(0,lw=2,color='k')
-        plt.errorbar(indep,self.residuals[:,pixel][unmasked],yerr=self.spectra_errs[:,pixel][unmasked],fmt='o',color=c,ecolor='k',markersize=8,elinewidth=3,capthick=2,capsize=4,markeredgecolor='k',markeredgewidth=1.2)
+        plt.errorbar(indep,self.residuals[self.residualRows(unmasked[0]),pixel],yerr=self.spectra_errs[:,pixel][unmasked],fmt='o',color=c,ecolor='k',markersize=8,elinewidth=3,capthick=2,capsize=4,markeredgecolor='k',markeredgewidth=1.2)
         resname = 'residuals'# $\delta_{'+'{0}'.format(pixel) + '}(s)$'
         plt.ylabel(resname,fontsize=20)
         plt.xlabel(xlabel,fontsize=20)
@@ -819,7 +1191,8 @@ class empca_residuals(mask):
         Adds to fit object chi squared and reduced chi squared properties.
 
         """
-        self.fitChiSquared = np.ma.sum((self.spectra-self.fitSpectra)**2/self.spectra_errs**2,axis=0)
+        rows = self.subsampleRows()
+        self.fitChiSquared = np.ma.sum((self.spectra[rows]-self.fitSpectra)**2/self.spectra_errs[rows]**2,axis=0)
         # Calculate degrees of freedom
         if isinstance(self.fitCoeffs.mask,np.ndarray):
             dof = self.numberStars() - np.sum(self.fitCoeffs.mask==False,axis=1) - 1
@@ -827,7 +1200,7 @@ class empca_residuals(mask):
             dof = self.numberStars() - self.numparams - 1
         self.fitReducedChi = self.fitChiSquared/dof
 
-    def findResiduals(self,minStarNum='default',gen=True,coeffs=None,matrix='default',eigcheck=False):
+    def findResiduals(self,minStarNum='default',gen=True,coeffs=None,matrix='default',eigcheck=False,save=True):
         """
         Calculate residuals from polynomial fits.
 
@@ -837,26 +1210,133 @@ class empca_residuals(mask):
         gen:          if true, generate residuals from scratch rather than reading from file
         coeffs:       path to file containing fit coefficients
         matrix:       choose which independent variables to use
+        save:         if True, save fit information to file
 
         Save fit information
         """
         if gen:
             self.multiFit(minStarNum=minStarNum,coeffs=coeffs,matrix=matrix,eigcheck=eigcheck)
-            self.residuals = self.spectra - self.fitSpectra
-            np.save(self.name+'/fitcoeffs.npy',self.fitCoeffs.data)
-            np.save(self.name+'/fitcoeffmask.npy',self.fitCoeffs.mask)
-            np.save(self.name+'/fitcoefferrs.npy',self.fitCoeffErrs.data)
-            np.save(self.name+'/fitspectra.npy',self.fitSpectra.data)
-            np.save(self.name+'/residuals.npy',self.residuals.data)
-            np.save(self.name+'/mask.npy',self.masked)
+            rows = self.subsampleRows()
+            self.residuals = np.ma.masked_array(np.ma.getdata(self.spectra)[rows]-self.fitSpectra.data,
+                                                mask=np.copy(self.masked[rows]))
+        if gen and save:
+            self.saveResiduals()
         if not gen:
             self.testM = self.makeMatrix(0)
             self.minStarNum = self.testM.shape[1]+1
             fmask = np.load(self.name+'/fitcoeffmask.npy')
             self.fitCoeffs = np.ma.masked_array(np.load(self.name+'/fitcoeffs.npy'),mask=fmask)
             self.fitCoeffErrs = np.ma.masked_array(np.load(self.name+'/fitcoefferrs.npy'),mask=fmask)
-            self.fitSpectra = np.ma.masked_array(np.load(self.name+'/fitspectra.npy'),mask=self.masked)
-            self.residuals = np.ma.masked_array(np.load(self.name+'/residuals.npy'),mask=self.masked)
+            # saved arrays have rows for the subsample they were fit to
+            rows = self.subsampleRows()
+            self._residualRows = rows
+            self._residualStars = self.subsampleStars()
+            self.fitSpectra = np.ma.masked_array(np.load(self.name+'/fitspectra.npy'),mask=self.masked[rows])
+            self.residuals = np.ma.masked_array(np.load(self.name+'/residuals.npy'),mask=np.copy(self.masked[rows]))
+
+    def residualRows(self,stars):
+        """
+        Returns the rows of the fit and residual arrays that hold the given
+        stars. These arrays only have rows for the stars in the subsample
+        that was fit.
+
+        stars:   indices of stars in the full sample
+
+        """
+        # Residuals set by hand are taken to cover the full sample
+        if getattr(self,'_residualStars',None) is None:
+            return stars
+        return np.searchsorted(self._residualStars,stars)
+
+    def residualUncertainties(self):
+        """
+        Returns the uncertainties and subsample weights of the stars in the
+        rows of the residual arrays.
+
+        """
+        rows = getattr(self,'_residualRows',slice(None))
+        starWeights = self._starWeights
+        if starWeights is not None:
+            starWeights = starWeights[rows]
+        return self.spectra_errs[rows],starWeights
+
+    def saveResiduals(self):
+        """
+        Save fit coefficients, fit spectra, residuals and mask to the
+        sample directory.
+
+        """
+        np.save(self.name+'/fitcoeffs.npy',self.fitCoeffs.data)
+        np.save(self.name+'/fitcoeffmask.npy',np.ma.getmaskarray(self.fitCoeffs))
+        np.save(self.name+'/fitcoefferrs.npy',self.fitCoeffErrs.data)
+        np.save(self.name+'/fitspectra.npy',self.fitSpectra.data)
+        np.save(self.name+'/residuals.npy',self.residuals.data)
+        np.save(self.name+'/mask.npy',self.masked[getattr(self,'_residualRows',slice(None))])
+
+    def remask(self,minSNR=None,badcombpixmask=None,matrix='default',
+               eigcheck=False,save=True):
+        """
+        Change the mask thresholds and update the fit, refitting only pixels
+        where the set of unmasked stars has changed. Fits at all other pixels
+        are reused. Results are written to a new directory,
+        bm<badcombpixmask>_minSNR<minSNR>, in place of the bm<badcombpixmask>
+        directory.
+
+        minSNR:           new minimum signal to noise, defaults to the
+                          current value
+        badcombpixmask:   new sum of 2**<bits on which to mask>, defaults to
+                          the current value
+        matrix:           choose which variables to fit
+        eigcheck:         check for degeneracy between pixels
+        save:             if True, save fit information to file
+
+        Returns the number of pixels that were refit.
+        """
+        # Use the stored fit if it has not been found in this session
+        if not hasattr(self,'fitCoeffs'):
+            self.findResiduals(gen=False)
+        if minSNR is None:
+            minSNR = self.minSNR
+        if badcombpixmask is None:
+            badcombpixmask = self.badcombpixmask
+        oldbits = self.packed.bits.copy()
+        # Apply the new mask
+        self.minSNR = minSNR
+        self.badcombpixmask = badcombpixmask
+        self._maskHere = self.maskMaker(self,minstar=5,minSNR=self.minSNR,
+                                        badcombpixmask=badcombpixmask)
+        self.applyMask()
+        maskDir = '/bm{0}_minSNR{1}'.format(badcombpixmask,minSNR)
+        self.name = self.name.replace(self._maskDir,maskDir,1)
+        self._maskDir = maskDir
+        self.getDirectory()
+        # Find pixels whose unmasked stars have changed
+        changed = np.where(np.any(oldbits != self.packed.bits,axis=1))[0]
+        starCounts = self.unmaskedCount()
+        fitSpectra = np.ma.getdata(self.fitSpectra)
+        rows = self.subsampleRows()
+        for pixel in tqdm(changed,desc='refit'):
+            fitSpectra[:,pixel] = 0
+            if starCounts[pixel] < self.minStarNum:
+                # if too many stars missing, update mask
+                self.fitCoeffs[pixel] = np.ma.masked
+                self.fitCoeffErrs[pixel] = np.ma.masked
+                self.maskPixel(pixel)
+            else:
+                # if fit possible update arrays
+                fitSpectrum,coefficients,coefficient_uncertainty = self.findFit(pixel,eigcheck=eigcheck,matrix=matrix)
+                fitSpectra[self.unmaskedStars(pixel)[rows],pixel] = np.array(fitSpectrum).flatten()
+                self.fitCoeffs[pixel] = coefficients
+                self.fitCoeffErrs[pixel] = coefficient_uncertainty
+        # update mask on input data
+        self.applyMask()
+        self.fitSpectra = np.ma.masked_array(fitSpectra,mask=self.masked[rows])
+        self.residuals = np.ma.masked_array(np.ma.getdata(self.spectra)[rows]-fitSpectra,
+                                            mask=np.copy(self.masked[rows]))
+        if save:
+            self.saveResiduals()
+        print('Refit {0} of {1} pixels'.format(len(changed),aspcappix))
+        return len(changed)
 
     '''
 
@@ -905,9 +1385,9 @@ class empca_residuals(mask):
 
         # Generate data
         for pixel in range(aspcappix):
-            if np.sum(self.unmasked[:,pixel].astype(int)) > self.minStarNum:
+            if np.sum(self.unmaskedStars(pixel).astype(int)) > self.minStarNum:
                 indeps = self.makeMatrix(pixel)
-                self.spectra[:,pixel][self.unmasked[:,pixel]] = np.reshape(np.array(indeps*self.testParams),self.spectra[:,pixel][self.unmasked[:,pixel]].shape)
+                self.spectra[:,pixel][self.unmaskedStars(pixel)] = np.reshape(np.array(indeps*self.testParams),self.spectra[:,pixel][self.unmaskedStars(pixel)].shape)
 
         # If requested, added noise to the data
         if randomize:
@@ -935,33 +1415,59 @@ class empca_residuals(mask):
     '''
 
     def findCorrection(self,cov=None,median=True,numpix=10.,frac=None,
-                       savename='pickles/correction_factor.pkl',tol=0.005):
+                       savename=None,tol=0.005,fullcov=False,chunksize=1024,
+                       numcores=None,method='lowess'):
         """
         Calculates the diagonal of a square matrix and smooths it
         either over a fraction of the data or a number of elements,
         where number of elements takes precedence if both are set.
 
-        cov:      Square matrix. If unspecified, calculate from residuals and
-                  uncertainties
-        median:   If true, returns smoothed median, not raw diagonal
-        numpix:   Number of elements to smooth over
-        frac:     Fraction of data to smooth over
-        tol:      Acceptable distance from 0, if greater than this, smooth to
-                  adjacent values when median is True
+        cov:        Square matrix. If unspecified, calculate from residuals and
+                    uncertainties
+        median:     If true, returns smoothed median, not raw diagonal
+        numpix:     Number of elements to smooth over
+        frac:       Fraction of data to smooth over
+        savename:   File in which to save the correction, defaults to
+                    correction_factor.pkl in the sample directory
+        tol:        Acceptable distance from 0, if greater than this, smooth to
+                    adjacent values when median is True
+        fullcov:    If True and cov is unspecified, set up the covariance
+                    matrix of residuals divided by uncertainties as
+                    self.covariance, held in residual_covariance.dat in the
+                    sample directory. Only its diagonal tiles are computed
+                    here; self.covariance.matrix() computes the rest.
+                    Otherwise only the diagonal is calculated, in one pass
+                    over blocks of stars.
+        chunksize:  Number of stars to process at once
+        numcores:   Number of processes used to compute the full covariance
+        method:     Smoothing used when median is True, 'lowess' or the
+                    faster running 'median'
 
         Returns the diagonal of a covariance matrix
         """
+        if not savename:
+            savename = self.name+'/correction_factor.pkl'
         if isinstance(cov,(list,np.ndarray)):
             self.cov=cov
-        if not isinstance(cov,(list,np.ndarray)):
-            arr = self.residuals.T/self.spectra_errs.T
-            cov = np.ma.cov(arr)
-            self.cov=cov
-        diagonal = np.ma.diag(cov)
+            diagonal = np.ma.diag(cov)
+        elif fullcov:
+            errs,starWeights = self.residualUncertainties()
+            self.covariance = residualCovariance(self.residuals,errs,
+                                                 self.name+'/residual_covariance.dat',
+                                                 starWeights=starWeights,
+                                                 chunksize=chunksize,
+                                                 numcores=numcores)
+            diagonal = self.covariance.diagonal()
+        elif not fullcov:
+            errs,starWeights = self.residualUncertainties()
+            diagonal = residualVariance(self.residuals,errs,
+                                        starWeights=starWeights,
+                                        chunksize=chunksize)
         if median:
-            median = smoothMedian(diagonal,frac=frac,numpix=float(numpix))
+            median = smoothMedian(diagonal,frac=frac,numpix=numpix,
+                                  method=method)
             offtol = np.where(np.fabs(median)<tol)[0]
-            if offtol.shape > 0:
+            if len(offtol) > 0:
                 median[offtol] = median[offtol-1]
             acs.pklwrite(savename,median)
             return median
@@ -991,22 +1497,37 @@ class empca_residuals(mask):
             except IOError:
                 gen = True
         if gen:
-            # Apply correction measurement uncertainties
+            # Apply correction to measurement uncertainties when finding
+            # weights
             self.correctUncertainty(correction=correction)
-            # Apply new mask based on corrected uncertainties
             self.applyMask()
             self.nvecs = nvecs
             self.deltR2 = deltR2
             # Find pixels with enough stars to do EMPCA
-            self.goodPixels=([i for i in range(aspcappix) if np.sum(self.residuals[:,i].mask) < self.residuals.shape[0]-self.minStarNum],)
-            self.empcaResiduals = self.residuals.T[self.goodPixels].T
-
-            # Calculate weights that just mask missing elements
-            unmasked = (self.empcaResiduals.mask==False)
-            errorWeights = unmasked.astype(float)
+            residualMask = np.ma.getmaskarray(self.residuals)
+            self.goodPixels=np.where(np.sum(residualMask,axis=0) < self.residuals.shape[0]-self.minStarNum)
+            # Take stars in the current subsample directly from the
+            # residual array
+            stars = self.subsampleStars()
+            subsample = np.ix_(stars,self.goodPixels[0])
+            residualSubsample = np.ix_(self.residualRows(stars),
+                                       self.goodPixels[0])
+
+            # Calculate weights that are zero for missing elements, and
+            # otherwise inverse variances or just one
             if weight:
-                errorWeights[unmasked] = 1./((self.spectra_errs.T[self.goodPixels].T[unmasked])**2)
-            self.empcaModelWeight = empca(self.empcaResiduals.data,weights=errorWeights,
+                variance = self.correctedVariance(subsample)
+            elif not weight:
+                variance = None
+            empcaData,errorWeights = toWeights(self.residuals[residualSubsample],
+                                               variance=variance)
+            # Count each star by its subsample weight
+            self.empcaMultiplicity = np.ones(len(stars))
+            if self._starWeights is not None:
+                self.empcaMultiplicity = self._starWeights[stars].astype(float)
+                errorWeights *= self.empcaMultiplicity[:,np.newaxis]
+            self.empcaResiduals = toMasked(empcaData,errorWeights)
+            self.empcaModelWeight = empca(empcaData,weights=errorWeights,
                                           nvec=self.nvecs,deltR2=self.deltR2,
                                           randseed=randomSeed,varfunc=varfunc)
 
@@ -1021,13 +1542,14 @@ class empca_residuals(mask):
             self.setR2noise(self.empcaModelWeight)
             self.resizePixelEigvec(self.empcaModelWeight)
 
-            # Restore original measurement uncertainties
+            # Stop correcting measurement uncertainties
             self.uncorrectUncertainty(correction=correction)
-            self.applyMask()
             # Save only basic statistics
-            self.smallModel = smallEMPCA(self.empcaModelWeight,correction=correction,savename=self.name+'/'+savename)
             if savename:
+                self.smallModel = smallEMPCA(self.empcaModelWeight,correction=correction,savename=self.name+'/'+savename)
                 acs.pklwrite(self.name+'/'+savename,self.smallModel)
+            elif not savename:
+                self.smallModel = smallEMPCA(self.empcaModelWeight,correction=correction)
 
     def setR2(self,model):
         """
@@ -1083,7 +1605,10 @@ class empca_residuals(mask):
 
         """
         model.Vdata = model._unmasked_data_var
-        # Calculate data noise
-        model.Vnoise = np.mean(1./(model.weights[model.weights!=0]))
+        # Calculate data noise, counting each star by its subsample weight
+        nonzero = model.weights!=0
+        multiplicity = np.broadcast_to(self.empcaMultiplicity[:,np.newaxis],
+                                       model.weights.shape)[nonzero]
+        model.Vnoise = np.sum(multiplicity**2/model.weights[nonzero])/np.sum(multiplicity)
         # Calculate R2noise
         model.R2noise = 1.-(model.Vnoise/model.Vdata)
@@ -0,0 +1,267 @@
+import numpy as np
+from galpy.util import multi as ml
+
+def residualWeights(residuals,starWeights=None,rows=slice(None),
+                    pixels=slice(None)):
+    """
+    Returns the weight of each star at each pixel of a block: its subsample
+    weight, or zero where the residuals are masked.
+
+    residuals:     masked array of residuals (stars by pixels)
+    starWeights:   weight of each star (e.g. bootstrap multiplicity), or
+                   None to count every star once
+    rows:          slice of stars in the block
+    pixels:        slice of pixels in the block
+
+    """
+    weights = (~np.ma.getmaskarray(residuals[rows,pixels])).astype(float)
+    if starWeights is not None:
+        weights *= np.asarray(starWeights,dtype=float)[rows,np.newaxis]
+    return weights
+
+def _normalizedBlock(residuals,errs,starWeights,rows,pixels=slice(None)):
+    """
+    Returns residuals divided by uncertainties for a block of stars, with
+    zeros where the weight is zero, and the weights for the block.
+
+    residuals:     masked array of residuals (stars by pixels)
+    errs:          array of uncertainties with the same shape
+    starWeights:   weight of each star, or None to count every star once
+    rows:          slice of stars in the block
+    pixels:        slice of pixels in the block
+
+    """
+    w = residualWeights(residuals,starWeights=starWeights,rows=rows,
+                        pixels=pixels)
+    x = np.zeros(w.shape)
+    keep = w!=0
+    x[keep] = np.ma.getdata(residuals[rows,pixels])[keep]/np.ma.getdata(errs[rows,pixels])[keep]
+    return x,w
+
+def residualVariance(residuals,errs,starWeights=None,chunksize=1024):
+    """
+    Finds the variance of residuals divided by their uncertainties at each
+    pixel in one pass over blocks of stars. This is the diagonal of the
+    covariance matrix found by np.ma.cov, without computing the full matrix.
+    Stars are counted by their weight, with masked stars ignored.
+
+    residuals:     masked array of residuals (stars by pixels)
+    errs:          array of uncertainties with the same shape
+    starWeights:   weight of each star (e.g. bootstrap multiplicity), or
+                   None to count every star once
+    chunksize:     number of stars to process at once
+
+    Returns a masked array of the variance at each pixel, masked where there
+    are fewer than two stars.
+    """
+    npix = residuals.shape[1]
+    count = np.zeros(npix)
+    mean = np.zeros(npix)
+    M2 = np.zeros(npix)
+    for start in range(0,residuals.shape[0],chunksize):
+        x,w = _normalizedBlock(residuals,errs,starWeights,
+                               slice(start,start+chunksize))
+        blockcount = np.sum(w,axis=0)
+        good = blockcount > 0
+        blockmean = np.zeros(npix)
+        blockmean[good] = np.sum(w*x,axis=0)[good]/blockcount[good]
+        blockM2 = np.sum(w*(x-blockmean)**2,axis=0)
+        # Combine with the totals so far
+        total = count+blockcount
+        delta = blockmean-mean
+        mean[good] += delta[good]*blockcount[good]/total[good]
+        M2[good] += blockM2[good]+delta[good]**2*count[good]*blockcount[good]/total[good]
+        count = total
+    variance = np.zeros(npix)
+    enough = count > 1
+    variance[enough] = M2[enough]/(count[enough]-1)
+    return np.ma.masked_array(variance,mask=~enough)
+
+def residualMean(residuals,errs,starWeights=None,chunksize=1024):
+    """
+    Finds the mean of residuals divided by their uncertainties at each pixel,
+    counting stars by their weight and ignoring masked stars.
+
+    residuals:     masked array of residuals (stars by pixels)
+    errs:          array of uncertainties with the same shape
+    starWeights:   weight of each star (e.g. bootstrap multiplicity), or
+                   None to count every star once
+    chunksize:     number of stars to process at once
+
+    Returns arrays of the mean and the total weight at each pixel.
+    """
+    total = np.zeros(residuals.shape[1])
+    count = np.zeros(residuals.shape[1])
+    for start in range(0,residuals.shape[0],chunksize):
+        x,w = _normalizedBlock(residuals,errs,starWeights,
+                               slice(start,start+chunksize))
+        total += np.sum(w*x,axis=0)
+        count += np.sum(w,axis=0)
+    mean = np.zeros(residuals.shape[1])
+    mean[count > 0] = total[count > 0]/count[count > 0]
+    return mean,count
+
+class residualCovariance(object):
+    """
+    Covariance between pixels of residuals divided by their uncertainties,
+    held in a memory-mapped file and computed in square tiles only when they
+    are asked for. Each tile is summed over blocks of stars, using only the
+    stars unmasked at both pixels of each pair, so results match np.ma.cov.
+    Tiles are computed in parallel by separate processes.
+
+    """
+    def __init__(self,residuals,errs,fname,starWeights=None,tilesize=512,
+                 chunksize=1024,numcores=None):
+        """
+        Set up an empty covariance matrix.
+
+        residuals:     masked array of residuals (stars by pixels)
+        errs:          array of uncertainties with the same shape
+        fname:         path to the file holding the covariance matrix
+        starWeights:   weight of each star (e.g. bootstrap multiplicity), or
+                       None to count every star once
+        tilesize:      number of pixels on each side of a tile
+        chunksize:     number of stars summed over at once
+        numcores:      number of processes used to compute tiles, defaults
+                       to the number of cores
+
+        """
+        self.residuals = residuals
+        self.errs = errs
+        self.fname = fname
+        self.starWeights = starWeights
+        self.tilesize = tilesize
+        self.chunksize = chunksize
+        self.numcores = numcores
+        self.npix = residuals.shape[1]
+        self.mean,count = residualMean(residuals,errs,starWeights=starWeights,
+                                       chunksize=chunksize)
+        self.ntiles = (self.npix+tilesize-1)//tilesize
+        self._done = np.zeros((self.ntiles,self.ntiles),dtype=bool)
+        cov = np.memmap(self.fname,dtype=np.float64,mode='w+',
+                        shape=(self.npix,self.npix))
+        del cov
+
+    def _tilePixels(self,tile):
+        """
+        Returns the slice of pixels covered by a row or column of tiles.
+
+        tile:   index of the row or column of tiles
+
+        """
+        return slice(tile*self.tilesize,min((tile+1)*self.tilesize,self.npix))
+
+    def _computeTile(self,tile):
+        """
+        Sum over blocks of stars to find one tile of the covariance matrix,
+        and write it and its transpose to file.
+
+        tile:   tuple of the row and column of the tile
+
+        """
+        rows = self._tilePixels(tile[0])
+        cols = self._tilePixels(tile[1])
+        products = np.zeros((rows.stop-rows.start,cols.stop-cols.start))
+        counts = np.zeros(products.shape)
+        for start in range(0,self.residuals.shape[0],self.chunksize):
+            stars = slice(start,start+self.chunksize)
+            xrows,wrows = _normalizedBlock(self.residuals,self.errs,
+                                           self.starWeights,stars,pixels=rows)
+            xcols,wcols = _normalizedBlock(self.residuals,self.errs,
+                                           self.starWeights,stars,pixels=cols)
+            # Deviations from the mean, zero where masked
+            devrows = (xrows-self.mean[rows])*(wrows!=0)
+            present = (wcols!=0).astype(float)
+            devcols = (xcols-self.mean[cols])*present
+            products += np.dot((wrows*devrows).T,devcols)
+            counts += np.dot(wrows.T,present)
+        block = np.full(products.shape,np.nan)
+        enough = counts > 1
+        block[enough] = products[enough]/(counts[enough]-1)
+        cov = np.memmap(self.fname,dtype=np.float64,mode='r+',
+                        shape=(self.npix,self.npix))
+        cov[rows,cols] = block
+        cov[cols,rows] = block.T
+        cov.flush()
+        del cov
+        return 0
+
+    def computeTiles(self,tiles):
+        """
+        Compute tiles of the covariance matrix that have not been found yet.
+        Since the matrix is symmetric, only tiles on or above the diagonal
+        are computed.
+
+        tiles:   list of (row,column) tuples of tiles
+
+        """
+        todo = sorted(set([(min(tile),max(tile)) for tile in tiles]))
+        todo = [tile for tile in todo if not self._done[tile]]
+        if todo == []:
+            return
+        list(ml.parallel_map(lambda i: self._computeTile(todo[i]),
+                             range(len(todo)),numcores=self.numcores))
+        for tile in todo:
+            self._done[tile] = True
+            self._done[tile[::-1]] = True
+
+    def block(self,rows,cols=None):
+        """
+        Returns a block of the covariance matrix, computing only the tiles
+        that it overlaps.
+
+        rows:   tuple of the first and last+1 pixels for rows of the block
+        cols:   tuple of the first and last+1 pixels for columns of the
+                block, defaults to the same as rows
+
+        Returns a masked array, masked where fewer than two stars are
+        unmasked at both pixels.
+        """
+        if cols is None:
+            cols = rows
+        rowtiles = range(rows[0]//self.tilesize,
+                         (rows[1]+self.tilesize-1)//self.tilesize)
+        coltiles = range(cols[0]//self.tilesize,
+                         (cols[1]+self.tilesize-1)//self.tilesize)
+        self.computeTiles([(i,j) for i in rowtiles for j in coltiles])
+        cov = np.memmap(self.fname,dtype=np.float64,mode='r',
+                        shape=(self.npix,self.npix))
+        return np.ma.masked_invalid(np.array(cov[rows[0]:rows[1],
+                                                 cols[0]:cols[1]]))
+
+    def diagonalBlocks(self):
+        """
+        Returns a list of the tiles on the diagonal of the covariance matrix,
+        computing only those tiles.
+
+        """
+        return [self.block((self._tilePixels(i).start,self._tilePixels(i).stop))
+                for i in range(self.ntiles)]
+
+    def detectorBlocks(self,boundaries):
+        """
+        Returns a list of the blocks of the covariance matrix between pixels
+        on the same detector, computing only the tiles they overlap.
+
+        boundaries:   list of pixels where each detector begins, ending with
+                      the total number of pixels
+
+        """
+        return [self.block((boundaries[i],boundaries[i+1]))
+                for i in range(len(boundaries)-1)]
+
+    def diagonal(self):
+        """
+        Returns the diagonal of the covariance matrix, computing only the
+        tiles on the diagonal.
+
+        """
+        return np.ma.concatenate([np.ma.diag(block)
+                                  for block in self.diagonalBlocks()])
+
+    def matrix(self):
+        """
+        Returns the full covariance matrix, computing any missing tiles.
+
+        """
+        return self.block((0,self.npix))
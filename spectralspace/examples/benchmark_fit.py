@@ -0,0 +1,90 @@
+import numpy as np
+import time,tempfile
+from spectralspace.examples.synthetic_sample import write_sample,mask_sample
+from spectralspace.sample.mask_data import toMasked,toWeights
+
+def maskedPath(model,pixels):
+    """
+    Fit pixels and find residuals and EMPCA weights the way the analysis
+    did with masked arrays: each pixel is solved with a dense inverse
+    covariance matrix and written into a masked array of fit values.
+
+    model:    masked sample
+    pixels:   pixels to fit
+
+    Returns masked residuals and EMPCA weights.
+    """
+    fitSpectra = np.ma.masked_array(np.zeros(model.spectra.shape),
+                                    mask=np.copy(model.masked))
+    for pixel in pixels:
+        unmasked = model.unmaskedStars(pixel)
+        indeps = model.makeMatrix(pixel)
+        covInverse = np.diag(1./model.spectra_errs[:,pixel][unmasked].astype(float)**2)
+        starsAtPixel = np.matrix(model.spectra[:,pixel][unmasked].astype(float))
+        newIndeps = np.dot(indeps.T,np.dot(covInverse,indeps))
+        newStarsAtPixel = np.dot(indeps.T,np.dot(covInverse,starsAtPixel.T))
+        invNewIndeps = np.linalg.inv(newIndeps)
+        coeffs = np.dot(invNewIndeps,newStarsAtPixel)
+        coeff_errs = np.sqrt(np.diag(invNewIndeps))
+        fitSpectra[:,pixel][unmasked] = np.array(indeps*coeffs).flatten()
+    residuals = model.spectra-fitSpectra
+    unmasked = (residuals.mask==False)
+    weights = unmasked.astype(float)
+    weights[unmasked] = 1./((model.spectra_errs[unmasked])**2)
+    return residuals,weights
+
+def weightedPath(model,pixels):
+    """
+    Fit pixels and find residuals and EMPCA weights the way the analysis
+    does now: each pixel is solved from plain data and inverse-variance
+    weights, and masked arrays are only made for the results.
+
+    model:    masked sample
+    pixels:   pixels to fit
+
+    Returns masked residuals and EMPCA weights.
+    """
+    fitSpectra = np.zeros(model.spectra.shape)
+    for pixel in pixels:
+        fitSpectrum,coeffs,coeff_errs = model.findFit(pixel)
+        fitSpectra[model.unmaskedStars(pixel),pixel] = np.array(fitSpectrum).flatten()
+    residuals = np.ma.masked_array(np.ma.getdata(model.spectra)-fitSpectra,
+                                   mask=np.copy(model.masked))
+    data,weights = toWeights(residuals,variance=model.correctedVariance())
+    return toMasked(data,weights),weights
+
+def benchmark_fit(nstars=500,npixels=None,repeats=3):
+    """
+    Time the masked array and weighted paths from fitting to EMPCA weights
+    on a synthetic sample, and check that they agree.
+
+    nstars:    number of stars in the sample
+    npixels:   number of pixels to fit, defaults to all pixels with enough
+               unmasked stars
+    repeats:   number of times to run each path, the fastest is reported
+
+    Returns a dictionary of the fastest time in seconds for each path.
+    """
+    direc = tempfile.mkdtemp()
+    write_sample(direc,nstars=nstars)
+    model = mask_sample(direc)
+    pixels = np.where(model.unmaskedCount() >= 5)[0][:npixels]
+    times = {}
+    results = {}
+    for name,path in [('masked',maskedPath),('weighted',weightedPath)]:
+        times[name] = []
+        for r in range(repeats):
+            start = time.time()
+            results[name] = path(model,pixels)
+            times[name].append(time.time()-start)
+        times[name] = min(times[name])
+    masked,weighted = results['masked'],results['weighted']
+    assert np.array_equal(masked[0].mask,weighted[0].mask)
+    assert np.allclose(masked[0].filled(0),weighted[0].filled(0))
+    assert np.allclose(masked[1],weighted[1])
+    times['speedup'] = times['masked']/times['weighted']
+    return times
+
+if __name__ == '__main__':
+    for nstars in [500,2000]:
+        print(nstars,'stars',benchmark_fit(nstars=nstars))
@@ -1,6 +1,7 @@
 import numpy as np
 from scipy.interpolate import interp1d
 from spectralspace.analysis.empca_residuals import *
+from spectralspace.sample.sample_store import openStore
 
 def getarrays(model):
     """
@@ -38,8 +39,13 @@ def reconstruct_EMPCA_data(direc,model,minStarNum=5):
     skimbm = direc.split('/')
     parentdirec = '/'.join(skimbm[:-1])
     # Load in uncertainties
-    spectra_errs = np.load('{0}/spectra_errs.npy'.format(parentdirec))
-    spectra = np.load('{0}/spectra.npy'.format(parentdirec))
+    if os.path.isfile('{0}/sample.store'.format(parentdirec)):
+        store = openStore('{0}/sample.store'.format(parentdirec))
+        spectra_errs = store['spectra_errs']
+        spectra = store['spectra']
+    else:
+        spectra_errs = np.load('{0}/spectra_errs.npy'.format(parentdirec))
+        spectra = np.load('{0}/spectra.npy'.format(parentdirec))
     # Load in mask
     mask = np.load('{0}/mask.npy'.format(direc))
     # Load in fit residuals
@@ -100,7 +106,7 @@ def pessimh(n,model,N,D,cvc=None):
     if not cvc:
         crossvec = np.where(model.R2Array > model.R2noise)
         # If intersection exists, use it
-        if crossvec[0] != []:
+        if len(crossvec[0]) > 0:
             crossvec = crossvec[0][0] - 1
             if crossvec < 0:
                 crossvec = 0
@@ -129,6 +135,63 @@ def pessimh(n,model,N,D,cvc=None):
             hs = np.ones(n)*np.sqrt((N**2/D)*lamnoise2)
     return hs
 
+def cell_sizes(denom,model,N,D,scale=1,**kwargs):
+    """
+    Find the chemical space cell size for each eigenvector, constrained to
+    never be larger than the span of chemical space.
+
+    denom:      If function given, use that to calculate denominator.
+                If constant or array given, use that.
+    model:      EMPCA model object that contains eigenvalues
+    N:          Number of measurements in the data set (i.e. number of stars)
+    D:          Number of dimensions in each measurement (i.e. pixels)
+    scale:      Factor by which to scale the cell sizes
+    **kwargs:   Keyword arguments for denominator function
+
+    Returns an array of cell sizes, or None if the denominator has the wrong
+    shape.
+    """
+    numeig = len(model.eigval)
+    # Create array of denominator values
+    if isinstance(denom,(int,float)):
+        denomarr = denom*np.ones(numeig)
+    if isinstance(denom,(list,np.ndarray)):
+        denomarr = np.array(denom,dtype=float)
+    if callable(denom):
+        denomarr = denom(numeig,model,N,D,**kwargs)
+    try:
+        denomarr = scale*denomarr*np.ones(numeig)
+    except ValueError as e:
+        print('Input denominator array has invalid shape, should be {0}'.format(len(model.eigval)))
+        print(e)
+        return None
+    # Constrain that cell size is never larger than span of chemical space
+    cond = np.sqrt(N*model.eigval) < denomarr
+    denomarr[cond] = np.sqrt(N*model.eigval[cond])
+    return denomarr
+
+def log_Ncells(eigval,denom,N,D):
+    """
+    Calculate the natural log of the number of chemical space cells for the
+    space spanned by the first n eigenvectors, for every n at once. Working
+    with cumulative sums of logs avoids overflowing the products of many
+    eigenvalues.
+
+    eigval:     Array of eigenvalues
+    denom:      Array of cell sizes for each eigenvector
+    N:          Number of measurements in the data set (i.e. number of stars)
+    D:          Number of dimensions in each measurement (i.e. pixels)
+
+    Returns an array whose nth element is the log of the number of cells
+    for the first n+1 eigenvectors.
+    """
+    if D <= N:
+        span = D*np.asarray(eigval,dtype=float)
+    elif N < D:
+        span = N*np.asarray(eigval,dtype=float)
+    with np.errstate(divide='ignore'):
+        return np.cumsum(0.5*np.log(span)-np.log(denom),axis=-1)
+
 def calculate_Ncells(direc,model,modelname,N=None,D=None,denom=consth,
                      generate=False,**kwargs):
     """
@@ -160,53 +223,53 @@ def calculate_Ncells(direc,model,modelname,N=None,D=None,denom=consth,
     # Create object if generate is True or file doesn't exist
     elif not os.path.isfile('{0}/{1}'.format(direc,fname)) or generate:
         model = reconstruct_EMPCA_data(direc,model,minStarNum=5)
-        numeig = len(model.eigval)
         # Determine array size if dimensions not given
         if not N or not D:
             D = model.data.shape[1]
             N = model.data.shape[0]
-        # Create array of denominator values
-        if isinstance(denom,(int,float)):
-            denomarr = denom*np.ones(numeig)
-        if isinstance(denom,list):
-            denomarr = np.array(denom)
-        if callable(denom):
-            denomarr = denom(numeig,model,N,D,**kwargs)
-        try:
-            shapetest = denomarr*np.ones(numeig)
-        except ValueError as e:
-            print('Input denominator array has invalid shape, should be {0}'.format(len(model.eigval)))
-            print(e)
+        denom = cell_sizes(denom,model,N,D,**kwargs)
+        if denom is None:
             return None
-        denom=denomarr
-        # Constrain that cell size is never larger than span of chemical space
-        newdenom = np.copy(denom)
-        cond = np.sqrt(N*model.eigval) < denom
-        newdenom[cond] = np.sqrt(N*model.eigval[cond])
-        denom = newdenom
-
-        def calcNcells(n,denom,D,N):
-            """
-            Calculate the number of the chemical space cells for the space
-            spanned by first n eigenvectors.
-
-            n:      Index of the eigenvector to use
-            denom:  Array of denominators for all eigenvectors
-            D:      Number of dimensions in each measurement (i.e. pixels)
-            N:      Number of measurements in the data set (number of stars)
-
-            Return number of cells for a space defined by first n principal
-            components
-            """
-            if D < N:
-                return np.prod(np.sqrt(D*model.eigval[:n+1]))/np.prod(denom[:n+1])
-            elif N < D:
-                return np.prod(np.sqrt((N*model.eigval)[:n+1]))/(np.prod((denom)[:n+1]))
         # Find the number of cells for each successive principal component
-        Ncells = np.zeros(numeig)
-        for n in range(len(model.eigval)):
-            Ncells[n] = calcNcells(n,denom,D,N)
+        Ncells = np.exp(log_Ncells(model.eigval,denom,N,D))
         np.save('{0}/{1}'.format(direc,fname),Ncells)
     # Linear interpolation
     Ncells = interp1d(np.arange(len(Ncells))+1,Ncells)
     return Ncells
+
+def calculate_Ncells_table(direc,model,scales=[1],denoms=[consth],N=None,
+                           D=None,log=False,**kwargs):
+    """
+    Calculate the number of chemical space cells as a function of the number
+    of eigenvectors for several cell sizes at once, reading the model once.
+
+    direc:      Directory where model files are stored
+    model:      EMPCA model object that contains eigenvalues
+    scales:     List of factors by which to scale cell sizes
+    denoms:     List of denominators, each a function (e.g. consth or
+                pessimh), constant or array as for calculate_Ncells
+    N:          Number of measurements in the data set (i.e. number of stars)
+    D:          Number of dimensions in each measurement (i.e. pixels)
+    log:        If True, return the natural log of the number of cells
+    **kwargs:   Keyword arguments for denominator functions
+
+    Returns an array with a row for each combination of denominator and
+    scale, where row i*len(scales)+j uses denoms[i] and scales[j], and a
+    column for each number of eigenvectors.
+    """
+    model = reconstruct_EMPCA_data(direc,model,minStarNum=5)
+    # Determine array size if dimensions not given
+    if not N or not D:
+        D = model.data.shape[1]
+        N = model.data.shape[0]
+    denomtable = []
+    for denom in denoms:
+        for scale in scales:
+            denomarr = cell_sizes(denom,model,N,D,scale=scale,**kwargs)
+            if denomarr is None:
+                return None
+            denomtable.append(denomarr)
+    Ncells = log_Ncells(model.eigval,np.array(denomtable),N,D)
+    if log:
+        return Ncells
+    return np.exp(Ncells)
@@ -0,0 +1,105 @@
+import numpy as np
+import os
+from spectralspace.sample.sample_store import writeStore
+from spectralspace.sample.star_sample import subStarSample,aspcappix
+
+def sample_columns(nstars=40,npix=aspcappix,seed=1):
+    """
+    Returns a dictionary of sample store columns for a synthetic sample of
+    red giants whose spectra depend quadratically on their parameters.
+
+    nstars:   number of stars in the sample
+    npix:     number of pixels in each spectrum
+    seed:     seed for the random number generator
+
+    """
+    rng = np.random.RandomState(seed)
+    columns = {'teff':rng.uniform(4000,5000,nstars),
+               'logg':rng.uniform(1.5,3.,nstars),
+               'fe_h':rng.uniform(-0.5,0.3,nstars),
+               'c_h':rng.uniform(-0.5,0.3,nstars),
+               'n_h':rng.uniform(-0.5,0.3,nstars),
+               'o_h':rng.uniform(-0.5,0.3,nstars),
+               'fib':rng.uniform(1,300,nstars),
+               'missing':np.array([],dtype=int)}
+    dteff = (columns['teff']-4500.)/500.
+    dlogg = columns['logg']-2.25
+    coeffs = rng.normal(0,0.02,(4,npix))
+    errs = rng.uniform(0.005,0.02,(nstars,npix))
+    columns['spectra'] = 0.9+coeffs[0]+np.outer(dteff,coeffs[1])+\
+                         np.outer(dlogg,coeffs[2])+np.outer(dteff**2,coeffs[3])+\
+                         errs*rng.normal(size=(nstars,npix))
+    columns['spectra_errs'] = errs
+    columns['bitmasks'] = np.zeros((nstars,npix),dtype=np.int64)
+    columns['bitmasks'][rng.uniform(size=(nstars,npix)) < 0.02] = 2**12
+    return columns
+
+def write_sample(path,**kwargs):
+    """
+    Writes a synthetic sample to a sample store in the directory path.
+
+    path:       directory in which to write the sample store
+    **kwargs:   kwargs for sample_columns
+
+    """
+    writeStore(os.path.join(str(path),'sample.store'),sample_columns(**kwargs))
+
+def open_sample(path,precision='double',codec=None,cls=subStarSample):
+    """
+    Returns a sample that reads its arrays from the store in path, without
+    reading the APOGEE catalogs.
+
+    path:        directory holding the sample store
+    precision:   storage precision of the sample
+    codec:       compression codec of the sample store
+    cls:         class of the returned sample
+
+    """
+    sample = cls.__new__(cls)
+    sample.name = str(path)
+    sample.precision = precision
+    sample.codec = codec
+    sample.checkArrays()
+    return sample
+
+def mask_sample(path,precision='double',minSNR=50,badcombpixmask=4351):
+    """
+    Returns a red giant sample read from the store in path and masked with
+    maskFilter, ready to be fit with quadratic polynomials in TEFF, LOGG
+    and FE_H.
+
+    path:             directory holding the sample store
+    precision:        storage precision of the sample
+    minSNR:           minimum signal to noise of unmasked pixels
+    badcombpixmask:   bitmask of flags to mask
+
+    """
+    from sklearn.preprocessing import PolynomialFeatures
+    from spectralspace.analysis.empca_residuals import empca_residuals
+    from spectralspace.sample.mask_data import maskFilter
+    model = open_sample(path,precision=precision,cls=empca_residuals)
+    model._dataSource = 'apogee'
+    model._sampleType = 'red_giant'
+    model.matchingData = np.zeros(len(model.teff))
+    model._starWeights = None
+    model.fibfit = False
+    model.degree = 2
+    model.polynomial = PolynomialFeatures(degree=2)
+    model._SNR = model.spectra/model.spectra_errs
+    model._maskHere = maskFilter(model,minstar=5,minSNR=minSNR,
+                                 badcombpixmask=badcombpixmask)
+    model.applyMask()
+    return model
+
+def fit_sample(path,precision='double'):
+    """
+    Returns a sample read from the store in path at the given precision,
+    masked and fit with quadratic polynomials in TEFF, LOGG and FE_H.
+
+    path:        directory holding the sample store
+    precision:   storage precision of the sample
+
+    """
+    model = mask_sample(path,precision=precision)
+    model.findResiduals(save=False)
+    return model
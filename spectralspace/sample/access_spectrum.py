@@ -1,6 +1,16 @@
 import apogee.tools.read as apread
+from apogee.tools import path as appath
+from apogee.tools import download as apdownload
+from apogee.tools import toAspcapGrid
+from astropy.io import fits
 import numpy as np
 import pickle
+import os
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+# Row of apStar arrays that holds the combined spectrum
+_COMBINED_INDEX = 1
 
 def get_spectra_asp(data,ext = 1):
     """
@@ -49,6 +59,164 @@ def get_spectra_ap(data,ext = 1,indx = None):
     if badind != []:
         return (specs,(np.array(goodind),))
 
+def read_aspcap_star(LOC,APO,dr=None):
+    """
+    Returns the spectrum, spectrum uncertainty and bitmask of a star on the
+    ASPCAP wavelength grid, opening its aspcapStar and apStar files once each.
+
+    LOC:   LOCATION_ID of the star
+    APO:   APOGEE_ID of the star
+    dr:    data release
+    """
+    aspcapPath = appath.aspcapStarPath(LOC,APO,dr=dr)
+    if not os.path.exists(aspcapPath):
+        apdownload.aspcapStar(LOC,APO,dr=dr)
+    apPath = appath.apStarPath(LOC,APO,dr=dr)
+    if not os.path.exists(apPath):
+        apdownload.apStar(LOC,APO,dr=dr)
+    # Both files hold arrays on the apStar grid
+    with fits.open(aspcapPath) as hdulist:
+        spectrum = toAspcapGrid(np.array(hdulist[1].data),dr=dr)
+        spectrum_err = toAspcapGrid(np.array(hdulist[2].data),dr=dr)
+    with fits.open(apPath) as hdulist:
+        bitmask = hdulist[3].data
+        # Use the combined spectrum if there is more than one visit
+        if bitmask.ndim > 1:
+            bitmask = bitmask[_COMBINED_INDEX]
+        bitmask = toAspcapGrid(np.array(bitmask),dr=dr)
+    return spectrum,spectrum_err,bitmask
+
+def read_stars(data,spectra,spectra_errs,bitmasks,dr=None,numthreads=8,
+               indices=None,progress=True):
+    """
+    Reads the spectrum, spectrum uncertainty and bitmask of each star in data
+    using several threads, writing them directly into preallocated arrays.
+
+    data:           labels for a subset of the APOGEE survey
+    spectra:        array with a row for each star to hold spectra
+    spectra_errs:   array with a row for each star to hold uncertainties
+    bitmasks:       array with a row for each star to hold bitmasks
+    dr:             data release
+    numthreads:     maximum number of stars to read at once
+    indices:        if set, only read stars with these indices
+    progress:       if True, show a progress bar
+
+    Returns an array of indices of stars whose files are missing. Their rows
+    are filled with zero spectra, unit uncertainties and flagged bitmasks.
+    """
+    if indices is None:
+        indices = range(len(data))
+    def read_row(i):
+        try:
+            spectra[i],spectra_errs[i],bitmasks[i] = read_aspcap_star(data['LOCATION_ID'][i],
+                                                                      data['APOGEE_ID'][i],
+                                                                      dr=dr)
+        except IOError:
+            # Flag every pixel, with uncertainties that keep weights finite
+            spectra[i] = 0
+            spectra_errs[i] = 1
+            bitmasks[i] = 1
+            return i
+        return None
+    with ThreadPoolExecutor(max_workers=numthreads) as pool:
+        results = pool.map(read_row,indices)
+        if progress:
+            results = tqdm(results,total=len(indices),desc='read star data')
+        results = list(results)
+    return np.array([i for i in results if i is not None],dtype=int)
+
+class spectrumStream(object):
+    """
+    Iterates over the spectra of a sample in chunks of stars, so that
+    samples larger than memory can be processed one chunk at a time. While a
+    chunk is being used, the following chunks are read in the background.
+
+    Each iteration yields (indices,spectra,spectra_errs,bitmasks), where
+    indices gives the rows of data in the chunk. Rows of stars whose files
+    are missing are filled as in read_stars, and once iteration is complete their
+    indices are held in the missing attribute.
+
+    """
+    def __init__(self,data,chunksize=1000,dr=None,numthreads=8,prefetch=2,
+                 dtype=np.float32):
+        """
+        Set up the stream.
+
+        data:         labels for a subset of the APOGEE survey
+        chunksize:    number of stars in each chunk
+        dr:           data release
+        numthreads:   maximum number of stars to read at once
+        prefetch:     number of chunks to read ahead of the one in use
+        dtype:        data type of the spectra and uncertainty arrays
+
+        """
+        self.data = data
+        self.chunksize = chunksize
+        self.dr = dr
+        self.numthreads = numthreads
+        self.prefetch = max(1,prefetch)
+        self.dtype = dtype
+        self.missing = np.array([],dtype=int)
+
+    def __len__(self):
+        """
+        Returns the number of chunks.
+        """
+        return (len(self.data)+self.chunksize-1)//self.chunksize
+
+    def _readChunk(self,start):
+        """
+        Read the chunk of stars beginning at row start.
+
+        start:   index of the first star in the chunk
+
+        Returns indices, spectra, uncertainties, bitmasks and the indices of
+        missing stars.
+        """
+        indices = np.arange(start,min(start+self.chunksize,len(self.data)))
+        chunk = self.data[indices]
+        spectra = np.zeros((len(indices),7214),dtype=self.dtype)
+        spectra_errs = np.zeros((len(indices),7214),dtype=self.dtype)
+        bitmasks = np.zeros((len(indices),7214),dtype=np.int64)
+        missing = read_stars(chunk,spectra,spectra_errs,bitmasks,dr=self.dr,
+                             numthreads=self.numthreads,progress=False)
+        return indices,spectra,spectra_errs,bitmasks,indices[missing]
+
+    def __iter__(self):
+        missing = []
+        starts = list(range(0,len(self.data),self.chunksize))
+        with ThreadPoolExecutor(max_workers=self.prefetch) as pool:
+            pending = [pool.submit(self._readChunk,start)
+                       for start in starts[:self.prefetch]]
+            nextchunk = len(pending)
+            for i in tqdm(range(len(starts)),desc='read star chunks'):
+                indices,spectra,spectra_errs,bitmasks,chunkmissing = pending.pop(0).result()
+                # Start reading the next chunk before handing this one on
+                if nextchunk < len(starts):
+                    pending.append(pool.submit(self._readChunk,starts[nextchunk]))
+                    nextchunk += 1
+                missing.append(chunkmissing)
+                yield indices,spectra,spectra_errs,bitmasks
+        self.missing = np.concatenate(missing) if missing != [] else np.array([],dtype=int)
+        if len(self.missing) > 0:
+            print('{0} of {1} stars missing'.format(len(self.missing),
+                                                   len(self.data)))
+
+def cache_dir(*parts):
+    """
+    Returns a path in the directory used to cache data shared between
+    samples, creating it if necessary. The directory is set by the
+    SPECTRALSPACE_CACHE environment variable, and defaults to ~/.spectralspace
+
+    *parts:   subdirectories of the cache directory
+    """
+    path = os.path.join(os.environ.get('SPECTRALSPACE_CACHE',
+                                       os.path.join(os.path.expanduser('~'),
+                                                    '.spectralspace')),
+                        *parts)
+    os.makedirs(path,exist_ok=True)
+    return path
+
 def pklread(fname):
     """
     Opens a pickled file with name fname.
@@ -0,0 +1,152 @@
+import numpy as np
+import os
+import apogee.tools.read as apread
+from apogee.tools import path as appath
+import spectralspace.sample.access_spectrum as acs
+
+# Functions that read and locate each catalog
+catalogReaders = {'allStar':(apread.allStar,appath.allStarPath),
+                  'allVisit':(apread.allVisit,appath.allVisitPath)}
+
+def _sourceStamp(source):
+    """
+    Returns the size and modification time of a catalog file, or None if
+    the file does not exist.
+
+    source:   path to the catalog file
+    """
+    if not os.path.isfile(source):
+        return None
+    stat = os.stat(source)
+    return (stat.st_size,stat.st_mtime)
+
+def cached_catalog(catalog,columns,dr=None):
+    """
+    Returns columns of an APOGEE catalog read from a local cache of
+    memory-mapped arrays. Columns not yet in the cache are read from the raw
+    catalog and saved. The cache is kept separately for each data release
+    and RESULTS_VERS, and is cleared if the size or modification time of the
+    catalog file changes.
+
+    catalog:   name of the catalog, 'allStar' or 'allVisit'
+    columns:   list of column names to return
+    dr:        data release, defaults to the current data release
+
+    Returns a dictionary of arrays keyed by column name.
+    """
+    if dr is None:
+        dr = appath._default_dr()
+    reader,pathfn = catalogReaders[catalog]
+    source = pathfn(dr=dr)
+    cachedir = acs.cache_dir('catalogs','{0}_DR{1}_{2}'.format(catalog,dr,
+                                                              os.environ.get('RESULTS_VERS','')))
+    stampname = os.path.join(cachedir,'source.pkl')
+    stamp = _sourceStamp(source)
+    # Clear the cache if the catalog file has changed
+    if stamp is None or not os.path.isfile(stampname) or acs.pklread(stampname) != stamp:
+        for fname in os.listdir(cachedir):
+            os.remove(os.path.join(cachedir,fname))
+    fnames = dict([(column,os.path.join(cachedir,'{0}.npy'.format(column)))
+                   for column in columns])
+    missing = [column for column in columns if not os.path.isfile(fnames[column])]
+    if missing != []:
+        data = reader(raw=True,dr=dr)
+        for column in missing:
+            np.save(fnames[column],np.ascontiguousarray(data[column]))
+        # Record the catalog file that columns were read from
+        acs.pklwrite(stampname,_sourceStamp(source))
+    return dict([(column,np.load(fnames[column],mmap_mode='r'))
+                 for column in columns])
+
+# Fiber information for DR12 stars, which is not in the DR12 allStar file
+fiberinfoPath = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..',
+                             'data','DR12_supplement','fiberinfo.npy')
+
+def _sortedFibers(ids,meanfib,sigfib):
+    """
+    Returns unique stripped APOGEE_IDs in sorted order with their mean and
+    spread of fiber numbers. Where a star appears more than once, the last
+    entry is kept.
+
+    ids:       APOGEE_IDs, as bytes or strings
+    meanfib:   mean fiber number of each entry
+    sigfib:    spread in fiber number of each entry
+    """
+    ids = np.asarray(ids)
+    if ids.dtype.kind == 'S':
+        ids = np.char.decode(ids,'ascii')
+    ids = np.char.strip(ids.astype('U'))
+    order = np.argsort(ids,kind='mergesort')
+    ids = ids[order]
+    # Keep the last entry in each run of identical IDs
+    last = np.ones(len(ids),dtype=bool)
+    last[:-1] = ids[1:] != ids[:-1]
+    order = order[last]
+    return {'APOGEE_ID':ids[last],
+            'MEANFIB':np.asarray(meanfib)[order],
+            'SIGFIB':np.asarray(sigfib)[order]}
+
+def fiber_index(dr=None):
+    """
+    Returns mean and spread of fiber numbers for stars, sorted by APOGEE_ID
+    so they can be matched with np.searchsorted. DR12 uses fiberinfo.npy;
+    other data releases use the MEANFIB and SIGFIB columns of allStar. The
+    sorted index is built once and cached next to the catalog cache.
+
+    dr:   data release, defaults to the current data release
+
+    Returns a dictionary of arrays keyed by APOGEE_ID, MEANFIB and SIGFIB.
+    """
+    if dr is None:
+        dr = appath._default_dr()
+    fields = ['APOGEE_ID','MEANFIB','SIGFIB']
+    if str(dr) == '12':
+        source = fiberinfoPath
+        cachedir = acs.cache_dir('catalogs','fiberinfo_DR12')
+    elif str(dr) != '12':
+        source = appath.allStarPath(dr=dr)
+        cachedir = acs.cache_dir('catalogs','fiberinfo_DR{0}_{1}'.format(dr,
+                                                                         os.environ.get('RESULTS_VERS','')))
+    stampname = os.path.join(cachedir,'source.pkl')
+    fnames = dict([(field,os.path.join(cachedir,'{0}.npy'.format(field)))
+                   for field in fields])
+    stamp = _sourceStamp(source)
+    if stamp is None or not os.path.isfile(stampname) or \
+       acs.pklread(stampname) != stamp or \
+       not all([os.path.isfile(fnames[field]) for field in fields]):
+        if str(dr) == '12':
+            fib = np.load(source)
+        elif str(dr) != '12':
+            fib = cached_catalog('allStar',fields,dr=dr)
+        index = _sortedFibers(fib['APOGEE_ID'],fib['MEANFIB'],fib['SIGFIB'])
+        for field in fields:
+            np.save(fnames[field],index[field])
+        acs.pklwrite(stampname,stamp)
+    return dict([(field,np.load(fnames[field],mmap_mode='r'))
+                 for field in fields])
+
+def join_fibers(ids,dr=None):
+    """
+    Look up the mean and spread of fiber numbers for a list of stars.
+
+    ids:   APOGEE_IDs of the stars
+    dr:    data release, defaults to the current data release
+
+    Returns arrays of MEANFIB and SIGFIB (zero for stars without fiber
+    information) and a boolean array that is True for stars that were found.
+    """
+    index = fiber_index(dr=dr)
+    ids = np.asarray(ids)
+    if ids.dtype.kind == 'S':
+        ids = np.char.decode(ids,'ascii')
+    ids = np.char.strip(ids.astype('U'))
+    meanfib = np.zeros(len(ids),dtype='f4')
+    sigfib = np.zeros(len(ids),dtype='f4')
+    if len(index['APOGEE_ID']) == 0:
+        return meanfib,sigfib,np.zeros(len(ids),dtype=bool)
+    pos = np.searchsorted(index['APOGEE_ID'],ids)
+    pos[pos == len(index['APOGEE_ID'])] = 0
+    found = index['APOGEE_ID'][pos] == ids
+    meanfib[found] = index['MEANFIB'][pos[found]]
+    sigfib[found] = index['SIGFIB'][pos[found]]
+    return meanfib,sigfib,found
@@ -1,6 +1,7 @@
 import numpy as np
 from apogee.tools import bitmask as bm
 from apogee.spec.continuum import fit
+from galpy.util import multi as ml
 from spectralspace.sample.star_sample import subStarSample
 
 # For reference, the APOGEE_PIXMASK
@@ -24,6 +25,18 @@ APOGEE_PIXMASK={0:"BADPIX", # Pixel marked as BAD in bad pixel mask
                 16:"FAILFIT" # Fitting for stellar parameters failed on pixel  
                 }
 
+def combinedBits(maskbits,dtype=np.int64):
+    """
+    Returns the integer with all of maskbits set, limited to the bits that
+    fit in a bitmask of type dtype.
+
+    maskbits:  bits to combine
+    dtype:     data type of the bitmask the result will be compared with
+
+    """
+    combined = int(np.sum([2**int(m) for m in maskbits]))
+    return np.array(combined & int(np.iinfo(dtype).max),dtype=dtype)
+
 def bitsNotSet(bitmask,maskbits):
     """
     Given a bitmask, returns True where any of maskbits are set 
@@ -33,39 +46,119 @@ def bitsNotSet(bitmask,maskbits):
     maskbits:  bits to check if set in the bitmask
     
     """
-    goodLocs_bool = np.zeros(bitmask.shape).astype(bool)
-    for m in maskbits:
-        bitind = bm.bit_set(m,bitmask)
-        goodLocs_bool[bitind] = True
-    return goodLocs_bool
+    return (bitmask & combinedBits(maskbits,bitmask.dtype)) != 0
 
 # Example mask filter function for APOGEE
 badcombpixmask = bm.badpixmask()
 badcombpixmask += 2**bm.apogee_pixmask_int("SIG_SKYLINE")
 
-def maskFilter(sample,minstar=5,badcombpixmask=4351,minSNR=50.):
+def maskFilter(sample,minstar=5,badcombpixmask=4351,minSNR=50.,
+               chunksize=1024):
     """
     Returns True where sample properties match conditions
+
+    The mask is built in one pass over blocks of stars, so no temporary
+    arrays the size of the sample are made. The number of flagged stars at
+    each pixel is kept as sample._flaggedStars.
     
-    sample:   an object of mask class
-    minstar:  minimum number of unmasked stars required at a pixel for that 
-              pixel to remain unmasked
-
-    """
-    # Artificially reduce SNR by increasing uncertainty where SNR is high
-    sample.spectra_errs[sample._SNR>200] = sample.spectra[sample._SNR>200]/200.
-    sample._SNR = sample.spectra/sample.spectra_errs
-    # Breakdown badcombpixmask (from data.py) into each individual bit flag
-    maskbits = bm.bits_set(badcombpixmask)
-    # Mask where SNR low or where something flagged in bitmask
-    mask = (sample._SNR < minSNR) | bitsNotSet(sample._bitmasks,maskbits)
-    # Calculate the number of masked stars at each pixel
-    flaggedstars = np.sum(mask,axis=0)
-    # Flag pixels where there aren't enough stars to do the fit
-    flaggedpix = flaggedstars > (sample.numberStars()-minstar)
-    mask.T[flaggedpix]=True
+    sample:      an object of mask class
+    minstar:     minimum number of unmasked stars required at a pixel for
+                 that pixel to remain unmasked
+    chunksize:   number of stars to process at once
+
+    """
+    spectra = np.ma.getdata(sample.spectra)
+    spectra_errs = np.ma.getdata(sample.spectra_errs)
+    SNR = np.ma.getdata(sample._SNR)
+    bits = combinedBits(bm.bits_set(badcombpixmask),sample._bitmasks.dtype)
+    mask = np.zeros(spectra.shape,dtype=bool)
+    flaggedstars = np.zeros(spectra.shape[1],dtype=int)
+    for start in range(0,spectra.shape[0],chunksize):
+        rows = slice(start,start+chunksize)
+        snr = spectra[rows]/spectra_errs[rows]
+        # Artificially reduce SNR by increasing uncertainty where SNR is high
+        high = snr > 200
+        spectra_errs[rows][high] = spectra[rows][high]/200.
+        snr[high] = spectra[rows][high]/spectra_errs[rows][high]
+        SNR[rows] = snr
+        # Mask where SNR low or where something flagged in bitmask
+        np.less(snr,minSNR,out=mask[rows])
+        mask[rows] |= (sample._bitmasks[rows] & bits) != 0
+        flaggedstars += np.sum(mask[rows],axis=0)
+    sample._flaggedStars = flaggedstars
+    # Flag pixels where there aren't enough stars to do the fit, counting
+    # all stars since the mask is made for the full sample
+    flaggedpix = flaggedstars > (spectra.shape[0]-minstar)
+    mask[:,flaggedpix]=True
     return mask
 
+def maskSweep(sample,minSNRs,badcombpixmasks,minstar=5,minStarNum=None,
+              chunksize=1024):
+    """
+    Find the number of stars that maskFilter would leave unmasked at each
+    pixel for every combination of SNR threshold and bitmask, reading the
+    spectra once. For each bitmask, stars are counted in a histogram of SNR
+    at each pixel, and the counts above each threshold are read from its
+    cumulative sum.
+
+    sample:            an object of mask class
+    minSNRs:           list of minimum signal to noise thresholds
+    badcombpixmasks:   list of sums of 2**<bits on which to mask>
+    minstar:           minimum number of unmasked stars required at a pixel
+                       for that pixel to remain unmasked, as in maskFilter
+    minStarNum:        number of stars needed to fit a pixel, defaults to
+                       the sample's minStarNum if set, or minstar
+    chunksize:         number of stars to process at once
+
+    Returns a structured array with a row for each configuration, holding
+    the bitmask, SNR threshold, number of pixels with at least minStarNum
+    unmasked stars, and the number of unmasked stars at each pixel.
+    """
+    if minStarNum is None:
+        minStarNum = getattr(sample,'minStarNum',minstar)
+    minSNRs = np.sort(np.asarray(minSNRs,dtype=float))
+    spectra = np.ma.getdata(sample.spectra)
+    spectra_errs = np.ma.getdata(sample.spectra_errs)
+    nstars,npix = spectra.shape
+    nbins = len(minSNRs)+1
+    bits = [combinedBits(bm.bits_set(b),sample._bitmasks.dtype)
+            for b in badcombpixmasks]
+    # Only count stars in the current subsample
+    instars = np.ones(nstars,dtype=bool)
+    if sample._starWeights is not None:
+        instars = sample._starWeights!=0
+    hist = np.zeros((len(bits),npix*nbins),dtype=int)
+    pixoffset = np.arange(npix)*nbins
+    for start in range(0,nstars,chunksize):
+        rows = slice(start,start+chunksize)
+        snr = spectra[rows]/spectra_errs[rows]
+        # Reduce high SNR as maskFilter does, without changing the sample
+        high = snr > 200
+        snr[high] = 200.
+        # Index of the SNR bin of each star at each pixel
+        snrbin = np.searchsorted(minSNRs,snr,side='right')+pixoffset
+        snrbin[~instars[rows]] = -1
+        for b in range(len(bits)):
+            keep = ((sample._bitmasks[rows] & bits[b]) == 0) & (snrbin >= 0)
+            hist[b] += np.bincount(snrbin[keep],minlength=npix*nbins)
+    # Stars above each threshold are those in higher SNR bins
+    hist = hist.reshape(len(bits),npix,nbins)
+    counts = np.cumsum(hist[:,:,::-1],axis=2)[:,:,::-1][:,:,1:]
+    # Mask pixels where there aren't enough stars, as maskFilter does
+    counts[counts < minstar] = 0
+    table = np.zeros(len(bits)*len(minSNRs),
+                     dtype=[('badcombpixmask',int),('minSNR',float),
+                            ('fittable',int),('starcount',np.int32,(npix,))])
+    i = 0
+    for b in range(len(bits)):
+        for t in range(len(minSNRs)):
+            table[i]['badcombpixmask'] = badcombpixmasks[b]
+            table[i]['minSNR'] = minSNRs[t]
+            table[i]['fittable'] = np.sum(counts[b,:,t] >= minStarNum)
+            table[i]['starcount'] = counts[b,:,t]
+            i += 1
+    return table
+
 def noFilter(sample,minstar=5,badcombpixmask=4351,minSNR=50.):
     """                                                                                     
     Returns True where sample properties match conditions                                   
@@ -73,6 +166,116 @@ def noFilter(sample,minstar=5,badcombpixmask=4351,minSNR=50.):
     """
     return np.zeros((sample.spectra.shape[0],sample.spectra.shape[1])).astype('bool')
 
+def toMasked(data,weights):
+    """
+    Returns data as a masked array, masked where weights are zero.
+
+    data:      array of values
+    weights:   array of weights with the same shape as data
+
+    """
+    return np.ma.masked_array(data,mask=(weights==0))
+
+def toWeights(marray,variance=None):
+    """
+    Returns the data of a masked array and weights that are zero where it
+    is masked. Unmasked weights are 1/variance if variance is given, or 1.
+
+    marray:     masked array
+    variance:   variance of the values of marray
+
+    """
+    weights = (~np.ma.getmaskarray(marray)).astype(float)
+    if variance is not None:
+        unmasked = weights!=0
+        weights[unmasked] = 1./np.asarray(variance)[unmasked]
+    return np.ma.getdata(marray),weights
+
+# Number of set bits in each possible byte
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)],dtype=np.int64)
+
+class packedMask(object):
+    """
+    Boolean mask over stars and pixels held as a bitset, with the stars at
+    each pixel packed eight to a byte (np.packbits along the star axis).
+
+    """
+    def __init__(self,mask=None,shape=None,bits=None):
+        """
+        Pack a boolean mask.
+
+        mask:    boolean array with shape (number of stars, number of pixels)
+        shape:   if mask is not given, shape of the mask held in bits
+        bits:    if mask is not given, packed bits with shape (number of
+                 pixels, number of stars/8 rounded up)
+
+        """
+        if mask is not None:
+            mask = np.asarray(mask,dtype=bool)
+            shape = mask.shape
+            bits = np.packbits(mask.T,axis=1)
+        self.shape = tuple(shape)
+        self.bits = bits
+
+    def column(self,pixel):
+        """
+        Returns a boolean array that is True for masked stars at a pixel.
+
+        pixel:   pixel to extract
+
+        """
+        return np.unpackbits(self.bits[pixel],count=self.shape[0]).astype(bool)
+
+    def row(self,star):
+        """
+        Returns a boolean array that is True for masked pixels of a star.
+
+        star:   index of the star to extract
+
+        """
+        return ((self.bits[:,star//8] >> (7-star%8)) & 1).astype(bool)
+
+    def count(self):
+        """
+        Returns the number of masked stars at each pixel.
+        """
+        return np.sum(_POPCOUNT[self.bits],axis=1)
+
+    def setColumn(self,pixel,value=True):
+        """
+        Set the mask for all stars at a pixel.
+
+        pixel:   pixel to change
+        value:   True to mask all stars, False to unmask them
+
+        """
+        self.bits[pixel] = np.packbits(np.full(self.shape[0],value,dtype=bool))
+
+    def maskStars(self,stars):
+        """
+        Returns a new packedMask with the given stars masked at every pixel.
+
+        stars:   boolean array that is True for stars to mask
+
+        """
+        return packedMask(shape=self.shape,
+                          bits=self.bits | np.packbits(stars)[np.newaxis,:])
+
+    def unpack(self,out=None,pixblock=512):
+        """
+        Returns the mask as a boolean array of shape (stars, pixels).
+
+        out:        if set, array to write the mask into
+        pixblock:   number of pixels to unpack at once
+
+        """
+        if out is None:
+            out = np.empty(self.shape,dtype=bool)
+        for start in range(0,self.shape[1],pixblock):
+            out[:,start:start+pixblock] = np.unpackbits(self.bits[start:start+pixblock],
+                                                        axis=1,count=self.shape[0]).T
+        return out
+
 class mask(subStarSample):
     """
     Define and apply a mask given a set of conditions in the form of the
@@ -80,7 +283,8 @@ class mask(subStarSample):
     
     """
     def __init__(self,dataSource,sampleType,maskMaker,ask=True,datadict=None,datadir='.',
-                 func=None,badcombpixmask=4351,minSNR=50):
+                 func=None,badcombpixmask=4351,minSNR=50,precision='double',
+                 codec=None):
         """
         Mask a subsample according to a maskFilter function
         
@@ -92,7 +296,8 @@ class mask(subStarSample):
                       filter_function.py
         
         """
-        subStarSample.__init__(self,dataSource,sampleType,ask=ask,datadict=datadict,datadir=datadir,func=func)
+        subStarSample.__init__(self,dataSource,sampleType,ask=ask,datadict=datadict,datadir=datadir,func=func,
+                               precision=precision,codec=codec)
         if isinstance(badcombpixmask,list):
             badcombpixmask=np.array(badcombpixmask)
         if isinstance(badcombpixmask,np.ndarray):
@@ -102,10 +307,13 @@ class mask(subStarSample):
                     badcombpixmask = np.sum(2**bitmask.apogee_pixmask_int(b))
             elif isinstance(badcombpixmask[0],int):
                 badcombpixmask = np.sum(2**badcombpixmask)
-        self.name+='/bm{0}'.format(badcombpixmask)
+        self._maskDir = '/bm{0}'.format(badcombpixmask)
+        self.name+=self._maskDir
         self.getDirectory()
         self._SNR = self.spectra/self.spectra_errs
         self.minSNR = minSNR
+        self.maskMaker = maskMaker
+        self.badcombpixmask = badcombpixmask
         # find indices that should be masked
         self._maskHere = maskMaker(self,minstar=5,minSNR=self.minSNR,
                                    badcombpixmask=badcombpixmask)
@@ -115,17 +323,37 @@ class mask(subStarSample):
         """
         Mask all arrays according to maskConditions
 
+        The mask is held as a packedMask in self.packed. The masked arrays of
+        spectra and uncertainties share one boolean mask, self.masked, and
+        self.unmasked is only created if it is used.
+
         """
-        # create default mask arrays (mask nothing)
-        self.masked = np.zeros(self.spectra.shape).astype(bool)
-        self.unmasked = np.ones(self.spectra.shape).astype(bool)
-        # update mask arrays
-        self.masked[self._maskHere]= True
-        self.unmasked[self._maskHere] = False
+        # pack the mask from maskConditions once
+        if getattr(self,'_basePackedSource',None) is not self._maskHere:
+            base = np.zeros(self.spectra.shape,dtype=bool)
+            base[self._maskHere] = True
+            self._basePacked = packedMask(base)
+            self._basePackedSource = self._maskHere
+        # mask stars excluded from the current subsample
+        if self._starWeights is not None:
+            self.packed = self._basePacked.maskStars(self._starWeights==0)
+        elif self._starWeights is None:
+            self.packed = packedMask(shape=self._basePacked.shape,
+                                     bits=self._basePacked.bits.copy())
+        # update the mask shared by spectra and uncertainties in place
+        if not isinstance(getattr(self,'_masked',None),np.ndarray) or \
+           self._masked.shape != self.spectra.shape:
+            self._masked = np.empty(self.spectra.shape,dtype=bool)
+        self.packed.unpack(out=self._masked)
+        self._unmasked = None
         # apply mask arrays to data
         # spectral information
-        self.spectra.mask = self.masked
-        self.spectra_errs.mask = self.masked
+        if self.spectra._mask is not self._masked:
+            self.spectra = np.ma.masked_array(np.ma.getdata(self.spectra),
+                                              mask=self._masked,copy=False)
+        if self.spectra_errs._mask is not self._masked:
+            self.spectra_errs = np.ma.masked_array(np.ma.getdata(self.spectra_errs),
+                                                   mask=self._masked,copy=False)
 
         # create dictionary tracing the independent variables to keywords
         self.keywordMap = {'TEFF':self.teff,
@@ -137,13 +365,149 @@ class mask(subStarSample):
                            'MEANFIB':self.fib
                        }
 
-    def continuumNormalize(self,source='cannon'):
-        if source:
-            newspecs = np.ma.masked_array(np.zeros((self.numberStars(),7214)))
-            for i in tqdm(range(self.numberStars()),'continuum normalization'):
-                newspecs[i] = self.spectra[i]/fit(self.spectra[i],
-                                                  self.spectra_errs[i],
-                                                  type=source)
-            newspecs.mask=self.spectra.mask
-            self.spectra = newspecs
-            self.name = self.name+'/ctmnorm-{0}/'.format(source)
+    @property
+    def masked(self):
+        """
+        Boolean array that is True for masked stars at each pixel.
+        """
+        return self._masked
+
+    @property
+    def unmasked(self):
+        """
+        Boolean array that is True for unmasked stars at each pixel, created
+        when first used.
+        """
+        if self._unmasked is None:
+            self._unmasked = ~self._masked
+        return self._unmasked
+
+    def unmaskedStars(self,pixel):
+        """
+        Returns a boolean array that is True for unmasked stars at a pixel.
+
+        pixel:   pixel at which to find stars
+
+        """
+        return ~self.packed.column(pixel)
+
+    def unmaskedCount(self):
+        """
+        Returns the number of unmasked stars at each pixel.
+
+        """
+        return self.packed.shape[0]-self.packed.count()
+
+    def maskPixel(self,pixel):
+        """
+        Mask all stars at a pixel until the mask is next applied.
+
+        pixel:   pixel to mask
+
+        """
+        self.packed.setColumn(pixel,True)
+        self._masked[:,pixel] = True
+        if self._unmasked is not None:
+            self._unmasked[:,pixel] = False
+
+    def setSubsample(self,weights=None):
+        """
+        Select a subsample of stars without copying the sample arrays.
+
+        weights:   array with one entry per star in the full sample, stars
+                   with zero weight are masked at every pixel. If None,
+                   restore the full sample.
+
+        """
+        if weights is not None:
+            weights = np.asarray(weights)
+        self._starWeights = weights
+        self.applyMask()
+
+    def subsampleStars(self):
+        """
+        Returns indices of stars in the current subsample.
+
+        """
+        if self._starWeights is None:
+            return np.arange(len(self.matchingData))
+        return np.where(self._starWeights!=0)[0]
+
+    def subsampleRows(self):
+        """
+        Returns an index of the rows of the sample arrays in the current
+        subsample. Without a subsample this is a slice over all stars, so
+        that indexing with it gives views rather than copies.
+
+        """
+        if self._starWeights is None:
+            return slice(None)
+        return self.subsampleStars()
+
+    def pixelWeights(self,pixel):
+        """
+        Returns the weight of every star at a pixel: its subsample weight
+        divided by its squared uncertainty, or zero where it is masked.
+
+        pixel:   pixel at which to find weights
+
+        """
+        weights = self.unmaskedStars(pixel).astype(float)
+        if self._starWeights is not None:
+            weights *= self._starWeights
+        unmasked = weights!=0
+        weights[unmasked] /= self.correctedVariance((unmasked,pixel))
+        return weights
+
+    def continuumNormalize(self,source='cannon',numcores=None,blockstars=100):
+        """
+        Continuum normalize the spectra, fitting blocks of stars in parallel.
+        Spectra are always normalized from the spectra as they were before
+        any normalization, so switching sources does not normalize twice.
+        Normalized spectra are saved in the sample store for each source, and
+        read from there on later runs.
+
+        source:       type of continuum normalization, passed to
+                      apogee.spec.continuum.fit; if None, do nothing
+        numcores:     number of processes to use, defaults to all cores
+        blockstars:   number of stars fit by each process at once
+
+        """
+        # Do nothing if spectra are already normalized this way
+        if not source or getattr(self,'_ctmnorm',None) == source:
+            return
+        # Keep the unnormalized spectra and directory the first time
+        if getattr(self,'_ctmnorm',None) is None:
+            self._rawSpectra = np.ma.getdata(self.spectra)
+            self._rawName = self.name
+        column = 'ctmnorm-{0}'.format(source)
+        store = getattr(self,'store',None)
+        if store is not None and column in store:
+            newspecs = store[column]
+        else:
+            spectra = self._rawSpectra
+            spectra_errs = np.ma.getdata(self.spectra_errs)
+            starts = range(0,spectra.shape[0],blockstars)
+            def normalize(b):
+                rows = range(starts[b],min(starts[b]+blockstars,
+                                           spectra.shape[0]))
+                # Blocks are all the same size so parallel_map can join them
+                block = np.zeros((blockstars,spectra.shape[1]),
+                                 dtype=spectra.dtype)
+                for i in range(len(rows)):
+                    block[i] = spectra[rows[i]]/fit(spectra[rows[i]],
+                                                    spectra_errs[rows[i]],
+                                                    type=source)
+                return block
+            # parallel_map returns a map object for a single block
+            newspecs = np.concatenate(list(ml.parallel_map(normalize,
+                                                           range(len(starts)),
+                                                           numcores=numcores)))
+            newspecs = newspecs[:spectra.shape[0]]
+            if store is not None:
+                store.write(column,newspecs)
+        self.spectra = np.ma.masked_array(newspecs,mask=self.spectra.mask,
+                                          copy=False)
+        self._ctmnorm = source
+        self.name = self._rawName+'/ctmnorm-{0}/'.format(source)
+        self.getDirectory()
@@ -1,19 +1,141 @@
 ###############################################################################
 # read_clusterdata.py: module to read APOGEE data on globular clusters
 ###############################################################################
-import sys
 import numpy
+import multiprocessing
 import apogee.tools.read as apread
 from apogee.tools import bitmask
+from apogee.tools import path as appath
+from apogee.tools import download as apdownload
+from apogee.tools import toAspcapGrid
+from astropy.io import fits
+from galpy.util import multi as ml
 import os
 try:
     from apogee.spec import continuum
 except RuntimeError:
     print('Failed to load continuum')
 import astropy.io.ascii
+from spectralspace.sample.catalog_cache import cached_catalog
+import spectralspace.sample.access_spectrum as acs
 _COMBINED_INDEX=1
 _GCS= ['M15','M92','M53','N5466','M13','M2','M3','M5','M107','M71']
-_ERASESTR= "                                                                               "
+# allStar columns needed to match cluster members
+_ALLSTAR_COLUMNS= ['APOGEE_ID','LOCATION_ID','H','NVISITS','VISIT_PK']
+_ELEMENTS= ['C','N','O','NA','MG','AL','SI','S','K','CA','TI','V','MN','NI']
+def _as_str(ids):
+    """
+    NAME:
+       _as_str
+    PURPOSE:
+       convert an array of IDs to stripped unicode strings
+    INPUT:
+       ids - array of IDs, as bytes or strings
+    OUTPUT:
+       array of strings
+    """
+    ids= numpy.asarray(ids)
+    if ids.dtype.kind == 'S':
+        ids= numpy.char.decode(ids,'ascii')
+    return numpy.char.strip(ids.astype('U'))
+class idIndex(object):
+    """Sorted index over an array of IDs for vectorized matching"""
+    def __init__(self,ids):
+        """
+        NAME:
+           __init__
+        PURPOSE:
+           sort the IDs once so that many IDs can be matched at once
+        INPUT:
+           ids - array of IDs in the catalog (e.g., allStar APOGEE_ID)
+        OUTPUT:
+           (none)
+        """
+        ids= _as_str(ids)
+        self.order= numpy.argsort(ids,kind='mergesort')
+        self.sorted= ids[self.order]
+        return None
+    def match(self,query):
+        """
+        NAME:
+           match
+        PURPOSE:
+           find IDs in the catalog
+        INPUT:
+           query - array of IDs to find
+        OUTPUT:
+           (first,count) - index in the catalog of the first match of each
+                           ID (-1 if not found) and the number of matches
+        """
+        query= _as_str(query)
+        lo= numpy.searchsorted(self.sorted,query,side='left')
+        hi= numpy.searchsorted(self.sorted,query,side='right')
+        count= hi-lo
+        first= numpy.zeros(len(query),dtype='int')-1
+        first[count > 0]= self.order[lo[count > 0]]
+        return (first,count)
+    def varies(self,values,query):
+        """
+        NAME:
+           varies
+        PURPOSE:
+           check whether a catalog column takes more than one value among
+           the matches of each ID
+        INPUT:
+           values - catalog column (e.g., LOCATION_ID)
+           query - array of IDs to find
+        OUTPUT:
+           boolean array, True where the matches of an ID have different values
+        """
+        query= _as_str(query)
+        lo= numpy.searchsorted(self.sorted,query,side='left')
+        hi= numpy.searchsorted(self.sorted,query,side='right')
+        svalues= numpy.asarray(values)[self.order]
+        # Count changes of value within runs of the same ID
+        change= numpy.zeros(len(svalues),dtype='int')
+        change[1:]= (self.sorted[1:] == self.sorted[:-1])\
+            *(svalues[1:] != svalues[:-1])
+        change= numpy.cumsum(change)
+        out= numpy.zeros(len(query),dtype='bool')
+        multi= (hi-lo) > 1
+        out[multi]= change[hi[multi]-1] > change[lo[multi]]
+        return out
+def _match_allstar(data,alldata,allvdata,nvisits):
+    """
+    NAME:
+       _match_allstar
+    PURPOSE:
+       match cluster members to allStar and find the fibers of their visits
+    INPUT:
+       data - cluster data with CLUSTER and ID columns
+       alldata - allStar columns
+       allvdata - allVisit columns
+       nvisits - maximum number of visits to record
+    OUTPUT:
+       (good,first,count,fibers) - stars that were matched, index of the
+       first allStar match, number of matches and fiber of each visit
+       (-1 where there is no visit)
+    """
+    good= numpy.array(['Pleiades' not in c for c in data['CLUSTER']],
+                      dtype='bool')
+    index= idIndex(alldata['APOGEE_ID'])
+    first,count= index.match(data['ID'])
+    notfound= good*(count == 0)
+    if numpy.any(notfound):
+        raise ValueError('allStar match for %s not found ...' % (data['ID'][numpy.where(notfound)[0][0]]))
+    multiple= good*index.varies(alldata['LOCATION_ID'],data['ID'])
+    if numpy.any(multiple):
+        raise ValueError('Multiple matches found for for %s ...' % (data['ID'][numpy.where(multiple)[0][0]]))
+    fibers= numpy.zeros((len(data),nvisits),dtype='int')-1
+    matched= first[good]
+    visit_pks= numpy.asarray(alldata['VISIT_PK'][matched])[:,:nvisits]
+    hasvisit= numpy.arange(visit_pks.shape[1])\
+        < numpy.asarray(alldata['NVISITS'][matched])[:,None]
+    goodfibers= fibers[good]
+    goodfibers[:,:visit_pks.shape[1]][hasvisit]=\
+        allvdata['FIBERID'][visit_pks[hasvisit]]
+    fibers[good]= goodfibers
+    return (good,first,count,fibers)
 def read_meszarosgcdata(filename=os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','data','clusterdata','aj509073t2_mrt.txt')):
     """
     NAME:
@@ -35,24 +157,15 @@ def read_meszarosgcdata(filename=os.path.join(os.path.dirname(os.path.realpath(_
     data.rename_column('[Fe/H]','FEH')
     data.rename_column('2MASS','ID')
     # Now match to allStar to get the location_ids and H magnitudes
-    alldata= apread.allStar(raw=True)
+    alldata= cached_catalog('allStar',_ALLSTAR_COLUMNS)
     locids= numpy.zeros(len(data),dtype='int')-1
     hmags= numpy.zeros(len(data),dtype='float')-1
     # and match to allVisit for the fibers that each star was observed in
-    allvdata= apread.allVisit(raw=True)
-    fibers= numpy.zeros((len(data),numpy.nanmax(alldata['NVISITS'])),
-                        dtype='int')-1
-    for ii in range(len(data)):
-        if 'Pleiades' in data['CLUSTER'][ii]: continue
-        indx= alldata['APOGEE_ID'] == data['ID'][ii]
-        if numpy.sum(indx) == 0:
-            raise ValueError('allStar match for %s not found ...' % (data['ID'][ii]))
-        if len(list(set(alldata['LOCATION_ID'][indx]))) > 1:
-            raise ValueError('Multiple matches found for for %s ...' % (data['ID'][ii]))
-        locids[ii]= alldata['LOCATION_ID'][indx][0]
-        hmags[ii]= alldata['H'][indx][0]
-        for jj in range(alldata['NVISITS'][indx][0]):
-            fibers[ii,jj]= allvdata[alldata['VISIT_PK'][indx][0,jj]]['FIBERID']
+    allvdata= cached_catalog('allVisit',['FIBERID'])
+    good,first,count,fibers= _match_allstar(data,alldata,allvdata,
+                                            numpy.nanmax(alldata['NVISITS']))
+    locids[good]= alldata['LOCATION_ID'][first[good]]
+    hmags[good]= alldata['H'][first[good]]
     data['LOCATION_ID']= locids
     data['H']= hmags
     data['FIBERID']= fibers
@@ -83,39 +196,28 @@ def read_caldata(filename=os.path.join(os.path.dirname(os.path.realpath(__file__
     data.rename_column('[M/H]C','FEH')
     data.rename_column('2MASS','ID')
     # Now match to allStar to get the location_ids
-    alldata= apread.allStar(raw=True)
+    if dr == '13':
+        rel = 'FE'
+    if dr != '13':
+        rel = 'H'
+    alldata= cached_catalog('allStar',_ALLSTAR_COLUMNS+['SNR','RA','DEC','FE_H']
+                            +['%s_%s' % (elem,rel) for elem in _ELEMENTS])
     locids= numpy.zeros(len(data),dtype='int')-1
     hmags= numpy.zeros(len(data),dtype='float')-1
     snrs = numpy.zeros(len(data),dtype='float')-1
     ras= numpy.zeros(len(data),dtype='float')-1
     decs= numpy.zeros(len(data),dtype='float')-1
     # and match to allVisit for the fibers that each star was observed in
-    allvdata= apread.allVisit(raw=True)
-    fibers= numpy.zeros((len(data),numpy.nanmax(alldata['NVISITS'])),
-                        dtype='int')-1
-    inds = []
-    for ii in range(len(data)):
-        if 'Pleiades' in data['CLUSTER'][ii]:
-            inds.append(0)
-            continue
-        indx= alldata['APOGEE_ID'] == data['ID'][ii]
-        success = numpy.where(indx==True)[0]
-        if success.size==0 or success.size>1:
-            inds.append(0)
-        elif success.size==1:
-            inds.append(success[0])
-        if numpy.sum(indx) == 0:
-            raise ValueError('allStar match for %s not found ...' % (data['ID'][ii]))
-        if len(list(set(alldata['LOCATION_ID'][indx]))) > 1:
-            raise ValueError('Multiple matches found for for %s ...' % (data['ID'][ii]))
-        locids[ii]= alldata['LOCATION_ID'][indx][0]
-        hmags[ii]= alldata['H'][indx][0]
-        snrs[ii] = alldata['SNR'][indx][0]
-        ras[ii] = alldata['RA'][indx][0]
-        decs[ii] = alldata['DEC'][indx][0]
-        for jj in range(alldata['NVISITS'][indx][0]):
-            fibers[ii,jj]= allvdata[alldata['VISIT_PK'][indx][0,jj]]['FIBERID']
-    inds = (numpy.array(inds),)
+    allvdata= cached_catalog('allVisit',['FIBERID'])
+    good,first,count,fibers= _match_allstar(data,alldata,allvdata,
+                                            numpy.nanmax(alldata['NVISITS']))
+    locids[good]= alldata['LOCATION_ID'][first[good]]
+    hmags[good]= alldata['H'][first[good]]
+    snrs[good] = alldata['SNR'][first[good]]
+    ras[good] = alldata['RA'][first[good]]
+    decs[good] = alldata['DEC'][first[good]]
+    # Only keep abundances of stars with a single allStar entry
+    inds = (numpy.where(good*(count == 1),first,0),)
     data['LOCATION_ID']= locids
     data['H']= hmags
     data['FIBERID']= fibers
@@ -126,10 +228,6 @@ def read_caldata(filename=os.path.join(os.path.dirname(os.path.realpath(__file__
     data['index'] = inds[0]
     data['M_H'] = data['FEH']
     data['FE_H'] = alldata['FE_H'][inds]
-    if dr == '13':
-        rel = 'FE'
-    if dr != '13':
-        rel = 'H'
     data['C_{0}'.format(rel)] = alldata['C_{0}'.format(rel)][inds]
     data['N_{0}'.format(rel)] = alldata['N_{0}'.format(rel)][inds]
     data['O_{0}'.format(rel)] = alldata['O_{0}'.format(rel)][inds]
@@ -146,23 +244,18 @@ def read_caldata(filename=os.path.join(os.path.dirname(os.path.realpath(__file__
     data['NI_{0}'.format(rel)] = alldata['NI_{0}'.format(rel)][inds]
     return numpy.array(data)
 
-def read_spectra(cluster,teffmin=4000.,teffmax=5000.,cont_type='cannon',
-                 cont_deg=4):
+def _select_cluster(cluster,teffmin,teffmax):
     """
     NAME:
-       read_spectra
+       _select_cluster
     PURPOSE:
-       Read the APOGEE spectra and their errors for stars in a given cluster
+       select the members of a cluster in a temperature range
     INPUT:
        cluster - Name of the cluster (name in one of the data files)
-       teffmin= (4000.) minimum temperature
-       teffmax= (5000.) maximum temperature
-       cont_type = ('cannon') type of continuum normalization to perform
-       cont_deg= (4) degree polynomial to fit for continuum normalization
+       teffmin - minimum temperature
+       teffmax - maximum temperature
     OUTPUT:
-       (data, spec, specerr) - (full data structure, spectra [nspec,nlam], spectral uncertainties [nspec,nlam]) nlam=7214 on ASPCAP grid
-    HISTORY:
-       2015-08-13 - Written based on some older code - Bovy (UofT)
+       data for the selected members
     """
     if cluster.upper() in _GCS:
         data= read_meszarosgcdata()
@@ -182,46 +275,154 @@ def read_spectra(cluster,teffmin=4000.,teffmax=5000.,cont_type='cannon',
         g4CN= good4CN(cluster,data)
         g4CN[10]= False # another one, by hand!
         if rc:
-            data= data[True-g4CN] # Just those!
+            data= data[~g4CN] # Just those!
         else:
             data= data[g4CN] # Just those!
-    # Load all the spectra
-    nspec= len(data)
-    spec= numpy.zeros((nspec,7214))
-    specerr= numpy.zeros((nspec,7214))
+    return data
+def _read_apstar(locid,apogeeid):
+    """
+    NAME:
+       _read_apstar
+    PURPOSE:
+       read the combined spectrum, uncertainties and bitmask of a star,
+       opening its apStar file once
+    INPUT:
+       locid - LOCATION_ID of the star
+       apogeeid - APOGEE_ID of the star
+    OUTPUT:
+       (spec,specerr,mask) on the ASPCAP grid
+    """
+    path= appath.apStarPath(locid,apogeeid)
+    if not os.path.exists(path):
+        apdownload.apStar(locid,apogeeid)
+    out= []
+    with fits.open(path) as hdulist:
+        for ext in [1,2,3]:
+            arr= hdulist[ext].data
+            # Use the combined spectrum if there is more than one visit
+            if arr.ndim > 1:
+                arr= arr[_COMBINED_INDEX]
+            out.append(toAspcapGrid(numpy.array(arr)))
+    return tuple(out)
+def _normalize_star(locid,apogeeid,cont_type,cont_deg):
+    """
+    NAME:
+       _normalize_star
+    PURPOSE:
+       read a star's spectrum, inflate the uncertainties of bad pixels and
+       continuum-normalize it
+    INPUT:
+       locid - LOCATION_ID of the star
+       apogeeid - APOGEE_ID of the star
+       cont_type - type of continuum normalization to perform
+       cont_deg - degree polynomial to fit for continuum normalization
+    OUTPUT:
+       (spec,specerr) continuum-normalized
+    """
+    spec,specerr,mask= _read_apstar(locid,apogeeid)
+    spec= spec.astype('float')
+    specerr= specerr.astype('float')
     # Setup bad pixel mask
     badcombpixmask= bitmask.badpixmask()\
         +2**bitmask.apogee_pixmask_int("SIG_SKYLINE")
-    for ii in range(nspec):
-        sys.stdout.write('\r'+"Loading spectrum %i / %i ...\r" % (ii+1,nspec))
-        sys.stdout.flush()
-        spec[ii]= apread.apStar(data['LOCATION_ID'][ii],
-                                data['ID'][ii],
-                                ext=1,header=False,
-                                aspcapWavegrid=True)[_COMBINED_INDEX]
-        specerr[ii]= apread.apStar(data['LOCATION_ID'][ii],
-                                   data['ID'][ii],
-                                   ext=2,header=False,
-                                   aspcapWavegrid=True)[_COMBINED_INDEX]
-        # Inflate uncertainties for bad pixels
-        mask= apread.apStar(data['LOCATION_ID'][ii],
-                            data['ID'][ii],
-                            ext=3,header=False,
-                            aspcapWavegrid=True)[_COMBINED_INDEX]
-        specerr[ii,(mask & (badcombpixmask)) != 0]+=\
-            100.*numpy.mean(spec[ii,True-numpy.isnan(spec[ii])])
-        # Also inflate pixels with high SNR to 0.5%
-        highsnr= spec[ii]/specerr[ii] > 200.
-        specerr[ii,highsnr]= 0.005*numpy.fabs(spec[ii,highsnr])
-        # Continuum-normalize
-        cont= continuum.fit(spec[ii],specerr[ii],type=cont_type,deg=cont_deg)
-        spec[ii]/= cont
-        specerr[ii]/= cont
-        specerr[ii,highsnr]= 0.005 # like standard APOGEE reduction
-    sys.stdout.write('\r'+_ERASESTR+'\r')
-    sys.stdout.flush()
-    return (data,spec,specerr)
-
+    # Inflate uncertainties for bad pixels
+    specerr[(mask & (badcombpixmask)) != 0]+=\
+        100.*numpy.mean(spec[~numpy.isnan(spec)])
+    # Also inflate pixels with high SNR to 0.5%
+    highsnr= spec/specerr > 200.
+    specerr[highsnr]= 0.005*numpy.fabs(spec[highsnr])
+    # Continuum-normalize
+    cont= continuum.fit(spec,specerr,type=cont_type,deg=cont_deg)
+    spec/= cont
+    specerr/= cont
+    specerr[highsnr]= 0.005 # like standard APOGEE reduction
+    return (spec,specerr)
+def _spectra_cachename(cluster,teffmin,teffmax,cont_type,cont_deg):
+    """
+    NAME:
+       _spectra_cachename
+    PURPOSE:
+       return the file in which continuum-normalized spectra of a cluster
+       are cached
+    INPUT:
+       cluster, teffmin, teffmax, cont_type, cont_deg - as for read_spectra
+    OUTPUT:
+       path to the cache file
+    """
+    cachedir= acs.cache_dir('clusters','DR{0}_{1}'.format(appath._default_dr(),
+                                                          os.environ.get('RESULTS_VERS','')))
+    return os.path.join(cachedir,'{0}_teff{1}-{2}_{3}{4}.npz'.format(cluster.upper(),
+                                                                     teffmin,teffmax,
+                                                                     cont_type,cont_deg))
+def read_spectra(cluster,teffmin=4000.,teffmax=5000.,cont_type='cannon',
+                 cont_deg=4,numcores=None,cache=True):
+    """
+    NAME:
+       read_spectra
+    PURPOSE:
+       Read the APOGEE spectra and their errors for stars in a given cluster
+    INPUT:
+       cluster - Name of the cluster (name in one of the data files), or a
+                 list of names to read several clusters in one pass
+       teffmin= (4000.) minimum temperature
+       teffmax= (5000.) maximum temperature
+       cont_type = ('cannon') type of continuum normalization to perform
+       cont_deg= (4) degree polynomial to fit for continuum normalization
+       numcores= (None) number of processes used to read and normalize
+                 spectra, defaults to all cores
+       cache= (True) if True, read spectra from and save them to the cache
+              in acs.cache_dir('clusters')
+    OUTPUT:
+       (data, spec, specerr) - (full data structure, spectra [nspec,nlam], spectral uncertainties [nspec,nlam]) nlam=7214 on ASPCAP grid
+       or a list of these for each cluster if cluster is a list
+    HISTORY:
+       2015-08-13 - Written based on some older code - Bovy (UofT)
+    """
+    single= isinstance(cluster,str)
+    if single:
+        clusters= [cluster]
+    else:
+        clusters= list(cluster)
+    results= {}
+    todo= []
+    for name in clusters:
+        cachename= _spectra_cachename(name,teffmin,teffmax,cont_type,cont_deg)
+        if cache and os.path.isfile(cachename):
+            cached= numpy.load(cachename,allow_pickle=True)
+            results[name]= (cached['data'],cached['spec'],cached['specerr'])
+        else:
+            todo.append((name,_select_cluster(name,teffmin,teffmax)))
+    if todo != []:
+        # Gather stars of all clusters, ordered by field
+        locids= numpy.concatenate([data['LOCATION_ID'] for name,data in todo])
+        apogeeids= numpy.concatenate([data['ID'] for name,data in todo])
+        order= numpy.argsort(locids,kind='mergesort')
+        if numcores is None:
+            numcores= multiprocessing.cpu_count()
+        # parallel_map returns a map object for a single star
+        normalized= list(ml.parallel_map(lambda ii: _normalize_star(locids[order[ii]],
+                                                                    apogeeids[order[ii]],
+                                                                    cont_type,cont_deg),
+                                         range(len(order)),
+                                         numcores=max(1,min(numcores,len(order)))))
+        spec= numpy.zeros((len(order),7214))
+        specerr= numpy.zeros((len(order),7214))
+        for ii in range(len(order)):
+            spec[order[ii]],specerr[order[ii]]= normalized[ii]
+        # Split the spectra back into clusters
+        start= 0
+        for name,data in todo:
+            end= start+len(data)
+            results[name]= (data,spec[start:end],specerr[start:end])
+            if cache:
+                numpy.savez(_spectra_cachename(name,teffmin,teffmax,
+                                               cont_type,cont_deg),
+                            data=data,spec=results[name][1],
+                            specerr=results[name][2])
+            start= end
+    if single:
+        return results[cluster]
+    return [results[name] for name in clusters]
 def good4CN(cluster,data):
     """
     NAME:
@@ -241,16 +442,9 @@ def good4CN(cluster,data):
             *(numpy.fabs(data['TEFF']-4600.)>3.)
     elif cluster.lower() == 'n6819':
         apokasc= apread.apokasc()
-        ma= numpy.zeros(len(data),dtype='int')-1
-        for ii in range(len(data)):
-            try:
-                ma[ii]= (numpy.arange(len(apokasc))[apokasc['APOGEE_ID'] == data['ID'][ii]])[0]
-            except IndexError: pass
+        ma= idIndex(apokasc['APOGEE_ID']).match(data['ID'])[0]
         indx= numpy.ones(len(data),dtype='bool')
-        for ii in range(len(data)):
-            if ma[ii] >= 0 \
-                    and apokasc[ma[ii]]['SEISMO EVOL'] == 'CLUMP          ':
-                indx[ii]= False
+        indx[(ma >= 0)*(_as_str(apokasc['SEISMO EVOL'][ma]) == 'CLUMP')]= False
         # Also the clump stars' friends, they are all suspicious
         indx[numpy.fabs(data['TEFF']-4765.) < 60.]= False
     else:
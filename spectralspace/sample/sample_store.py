@@ -0,0 +1,357 @@
+import numpy as np
+import os
+import mmap
+import json
+import struct
+import zlib
+import lzma
+from concurrent.futures import ThreadPoolExecutor
+
+# Layout of a sample store file:
+#   header:   8 byte magic string, then the offset and length in bytes of
+#             the column index (two little-endian unsigned 64 bit integers)
+#   blocks:   raw array data for each column, each starting on a multiple
+#             of _ALIGN bytes
+#   index:    JSON dictionary giving the dtype, shape and offset of each
+#             column, written after the last block
+_MAGIC = b'SSSTORE1'
+_HEADER = struct.Struct('<QQ')
+_HEADERSIZE = len(_MAGIC)+_HEADER.size
+_ALIGN = 64
+
+def _align(offset):
+    """
+    Returns the first multiple of _ALIGN at or after offset.
+    """
+    return ((offset+_ALIGN-1)//_ALIGN)*_ALIGN
+
+class sampleStore(object):
+    """
+    A single file holding all arrays for a sample, read through a memory map
+    so that columns are only loaded from disk when they are used.
+
+    """
+    def __init__(self,fname):
+        """
+        Open an existing sample store, or create an empty one.
+
+        fname:   path to the store file
+
+        """
+        self.fname = fname
+        try:
+            f = open(self.fname,'rb')
+        except IOError:
+            f = open(self.fname,'wb')
+            f.write(_MAGIC+_HEADER.pack(_HEADERSIZE,0))
+            f.close()
+            f = open(self.fname,'rb')
+        magic = f.read(len(_MAGIC))
+        if magic != _MAGIC:
+            f.close()
+            raise IOError('{0} is not a sample store'.format(self.fname))
+        self._indexOffset,indexLength = _HEADER.unpack(f.read(_HEADER.size))
+        self.index = {}
+        if indexLength:
+            f.seek(self._indexOffset)
+            self.index = json.loads(f.read(indexLength).decode())
+        f.close()
+        self._remap()
+
+    def _remap(self):
+        """
+        Memory map the store file. The map is copy-on-write, so arrays read
+        from it may be changed in memory without altering the file.
+
+        """
+        f = open(self.fname,'rb')
+        self._map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_COPY)
+        f.close()
+
+    def columns(self):
+        """
+        Returns a list of column names in the store.
+        """
+        return list(self.index.keys())
+
+    def __contains__(self,name):
+        return name in self.index
+
+    def __getitem__(self,name):
+        """
+        Returns the named column as an array that views the memory map
+        without copying.
+
+        name:   name of the column
+
+        """
+        info = self.index[name]
+        shape = tuple(info['shape'])
+        dtype = np.dtype(info['dtype'])
+        if np.prod(shape)==0:
+            return np.zeros(shape,dtype=dtype)
+        return np.ndarray(shape,dtype=dtype,buffer=self._map,
+                          offset=info['offset'])
+
+    def write(self,name,array):
+        """
+        Append an array to the store as a new column. If the column already
+        exists, the index is updated to point at the new data.
+
+        name:    name of the column
+        array:   array to write
+
+        """
+        array = np.ascontiguousarray(np.ma.getdata(array))
+        offset = _align(self._indexOffset)
+        f = open(self.fname,'r+b')
+        f.seek(offset)
+        array.tofile(f)
+        self.index[name] = {'dtype':array.dtype.str,
+                            'shape':list(array.shape),
+                            'offset':offset}
+        self._indexOffset = offset+array.nbytes
+        indexbytes = json.dumps(self.index).encode()
+        f.seek(self._indexOffset)
+        f.write(indexbytes)
+        f.truncate()
+        f.seek(len(_MAGIC))
+        f.write(_HEADER.pack(self._indexOffset,len(indexbytes)))
+        f.close()
+        self._remap()
+
+# Layout of a compressed sample store file matches the sample store, but each
+# column is split into blocks of stars (rows) that are compressed separately.
+# The index gives the offset and length in bytes of each compressed block.
+_ARCHIVEMAGIC = b'SSARCH01'
+
+# Compression functions for each codec
+codecs = {'zlib':(zlib.compress,zlib.decompress),
+          'lzma':(lzma.compress,lzma.decompress)}
+
+class compressedStore(object):
+    """
+    A single file holding all arrays for a sample, with each column split
+    into blocks of stars that are compressed separately. Any block can be
+    read alone, and whole columns are decompressed on several threads.
+
+    """
+    def __init__(self,fname,codec=None,blockstars=None,numthreads=8):
+        """
+        Open an existing compressed store, or create an empty one.
+
+        fname:        path to the store file
+        codec:        compression for new columns, a key of codecs; defaults
+                      to the codec already used in the store, or zlib
+        blockstars:   number of stars in each compressed block of new
+                      columns; defaults to the value already used in the
+                      store, or 256
+        numthreads:   number of threads used to compress and decompress
+                      columns
+
+        """
+        self.fname = fname
+        self.numthreads = numthreads
+        try:
+            f = open(self.fname,'rb')
+        except IOError:
+            f = open(self.fname,'wb')
+            f.write(_ARCHIVEMAGIC+_HEADER.pack(_HEADERSIZE,0))
+            f.close()
+            f = open(self.fname,'rb')
+        magic = f.read(len(_ARCHIVEMAGIC))
+        if magic != _ARCHIVEMAGIC:
+            f.close()
+            raise IOError('{0} is not a compressed sample store'.format(self.fname))
+        self._indexOffset,indexLength = _HEADER.unpack(f.read(_HEADER.size))
+        self.index = {}
+        if indexLength:
+            f.seek(self._indexOffset)
+            self.index = json.loads(f.read(indexLength).decode())
+        f.close()
+        # Compress new columns like existing ones unless told otherwise
+        existing = list(self.index.values())
+        if codec is None:
+            codec = existing[0]['codec'] if existing != [] else 'zlib'
+        if blockstars is None:
+            blockstars = existing[0]['blockstars'] if existing != [] else 256
+        self.codec = codec
+        self.blockstars = blockstars
+        self._remap()
+
+    def _remap(self):
+        """
+        Memory map the store file read-only.
+
+        """
+        f = open(self.fname,'rb')
+        self._map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        f.close()
+
+    def columns(self):
+        """
+        Returns a list of column names in the store.
+        """
+        return list(self.index.keys())
+
+    def __contains__(self,name):
+        return name in self.index
+
+    def numberBlocks(self,name):
+        """
+        Returns the number of compressed blocks in a column.
+
+        name:   name of the column
+
+        """
+        return len(self.index[name]['blocks'])
+
+    def readBlock(self,name,block,out=None):
+        """
+        Decompress one block of stars from a column.
+
+        name:    name of the column
+        block:   index of the block
+        out:     if set, array to write the block into
+
+        Returns the array of stars in the block.
+        """
+        info = self.index[name]
+        shape = tuple(info['shape'])
+        dtype = np.dtype(info['dtype'])
+        start = block*info['blockstars']
+        stop = min(start+info['blockstars'],shape[0]) if shape else 1
+        offset,length = info['blocks'][block]
+        data = codecs[info['codec']][1](self._map[offset:offset+length])
+        array = np.frombuffer(data,dtype=dtype).reshape((stop-start,)+shape[1:])
+        if out is None:
+            return array.copy()
+        out[...] = array
+        return out
+
+    def readRows(self,name,start,stop):
+        """
+        Returns stars start to stop of a column, decompressing only the
+        blocks that hold them.
+
+        name:    name of the column
+        start:   index of the first star
+        stop:    index after the last star
+
+        """
+        blockstars = self.index[name]['blockstars']
+        blocks = range(start//blockstars,(stop+blockstars-1)//blockstars)
+        if len(blocks) == 0:
+            return self[name][start:stop]
+        rows = np.concatenate([self.readBlock(name,block) for block in blocks])
+        return rows[start-blocks[0]*blockstars:stop-blocks[0]*blockstars]
+
+    def __getitem__(self,name):
+        """
+        Returns the named column, decompressing its blocks in parallel.
+
+        name:   name of the column
+
+        """
+        info = self.index[name]
+        shape = tuple(info['shape'])
+        out = np.empty(shape,dtype=np.dtype(info['dtype']))
+        if out.size == 0:
+            return out
+        if shape == ():
+            return self.readBlock(name,0).reshape(())
+        blockstars = info['blockstars']
+        def decode(block):
+            self.readBlock(name,block,
+                           out=out[block*blockstars:(block+1)*blockstars])
+        with ThreadPoolExecutor(max_workers=self.numthreads) as pool:
+            list(pool.map(decode,range(self.numberBlocks(name))))
+        return out
+
+    def write(self,name,array):
+        """
+        Append an array to the store as a new column, compressing it in
+        blocks of stars. If the column already exists, the index is updated
+        to point at the new data.
+
+        name:    name of the column
+        array:   array to write
+
+        """
+        array = np.ascontiguousarray(np.ma.getdata(array))
+        compress = codecs[self.codec][0]
+        if array.ndim == 0:
+            pieces = [array.reshape(1)]
+        elif array.ndim > 0:
+            pieces = [array[i:i+self.blockstars]
+                      for i in range(0,array.shape[0],self.blockstars)]
+        # Compress blocks in parallel, then write them in order
+        with ThreadPoolExecutor(max_workers=self.numthreads) as pool:
+            compressed = list(pool.map(lambda piece: compress(piece.tobytes()),
+                                       pieces))
+        offset = _align(self._indexOffset)
+        f = open(self.fname,'r+b')
+        f.seek(offset)
+        blocks = []
+        for data in compressed:
+            f.write(data)
+            blocks.append([offset,len(data)])
+            offset += len(data)
+        self.index[name] = {'dtype':array.dtype.str,
+                            'shape':list(array.shape),
+                            'codec':self.codec,
+                            'blockstars':self.blockstars,
+                            'blocks':blocks}
+        self._indexOffset = offset
+        indexbytes = json.dumps(self.index).encode()
+        f.seek(self._indexOffset)
+        f.write(indexbytes)
+        f.truncate()
+        f.seek(len(_ARCHIVEMAGIC))
+        f.write(_HEADER.pack(self._indexOffset,len(indexbytes)))
+        f.close()
+        self._remap()
+
+def openStore(fname):
+    """
+    Open a sample store, compressed or not, according to its magic string.
+
+    fname:   path to the store file
+
+    Returns a sampleStore or compressedStore object.
+    """
+    f = open(fname,'rb')
+    magic = f.read(len(_MAGIC))
+    f.close()
+    if magic == _ARCHIVEMAGIC:
+        return compressedStore(fname)
+    return sampleStore(fname)
+
+def writeStore(fname,columns,codec=None,blockstars=256):
+    """
+    Create a new sample store, replacing any existing file. The store is
+    written to a temporary file that then replaces fname, so arrays that
+    are still mapped from an existing store at fname stay readable.
+
+    fname:        path to the store file
+    columns:      dictionary of arrays to write, keyed by column name
+    codec:        if set, compress columns with this codec (a key of codecs)
+    blockstars:   number of stars in each compressed block
+
+    Returns the sampleStore or compressedStore object.
+    """
+    tmpname = fname+'.tmp'
+    f = open(tmpname,'wb')
+    if codec:
+        f.write(_ARCHIVEMAGIC+_HEADER.pack(_HEADERSIZE,0))
+        f.close()
+        store = compressedStore(tmpname,codec=codec,blockstars=blockstars)
+    elif not codec:
+        f.write(_MAGIC+_HEADER.pack(_HEADERSIZE,0))
+        f.close()
+        store = sampleStore(tmpname)
+    for name in columns:
+        store.write(name,columns[name])
+    os.replace(tmpname,fname)
+    store.fname = fname
+    return store
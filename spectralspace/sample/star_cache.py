@@ -0,0 +1,179 @@
+import numpy as np
+import os
+import fcntl
+import spectralspace.sample.access_spectrum as acs
+
+aspcappix = 7214
+
+# Arrays held for each star and the data type used to store them. Both types
+# hold the values read from the FITS files without loss.
+cacheArrays = [('spectra',np.float32),
+               ('spectra_errs',np.float32),
+               ('bitmasks',np.int32)]
+
+def starKey(dr,LOC,APO):
+    """
+    Returns the key used to find a star in the cache.
+
+    dr:    data release
+    LOC:   LOCATION_ID of the star
+    APO:   APOGEE_ID of the star
+    """
+    if isinstance(APO,bytes):
+        APO = APO.decode()
+    return '{0}/{1}/{2}'.format(dr,LOC,APO.strip())
+
+class starCache(object):
+    """
+    Cache of spectra, uncertainties and bitmasks for individual stars, shared
+    by all samples. Stars are appended to fixed size rows in one file per
+    array and found through an index. Once the cache holds maxstars stars,
+    rows of the least recently used stars are overwritten.
+
+    """
+    def __init__(self,cachedir=None,maxstars=50000):
+        """
+        Open the cache, creating it if necessary.
+
+        cachedir:   directory holding the cache, defaults to the stars
+                    directory in acs.cache_dir()
+        maxstars:   maximum number of stars to keep
+
+        """
+        if not cachedir:
+            cachedir = acs.cache_dir('stars')
+        self.cachedir = cachedir
+        self.maxstars = maxstars
+        self.indexname = os.path.join(self.cachedir,'index.pkl')
+        self._loadIndex()
+
+    def _loadIndex(self):
+        """
+        Read the index from file. The index stores the row of each star, the
+        last time each star was used and a clock that counts cache accesses.
+
+        """
+        if os.path.isfile(self.indexname):
+            self.rows,self.lastused,self.clock = acs.pklread(self.indexname)
+        else:
+            self.rows = {}
+            self.lastused = {}
+            self.clock = 0
+
+    def _saveIndex(self):
+        """
+        Write the index to file.
+
+        """
+        acs.pklwrite(self.indexname+'.tmp',(self.rows,self.lastused,self.clock))
+        os.rename(self.indexname+'.tmp',self.indexname)
+
+    def _lock(self):
+        """
+        Returns an open lock file, holding an exclusive lock on the cache.
+
+        """
+        lockfile = open(os.path.join(self.cachedir,'lock'),'w')
+        fcntl.flock(lockfile,fcntl.LOCK_EX)
+        return lockfile
+
+    def _arrays(self,nrows,mode='r'):
+        """
+        Returns a dictionary of memory maps for each array in the cache.
+
+        nrows:   number of rows to map
+        mode:    mode in which to open the memory maps
+
+        """
+        arrays = {}
+        for name,dtype in cacheArrays:
+            fname = os.path.join(self.cachedir,'{0}.dat'.format(name))
+            if mode != 'r':
+                # Extend file to hold all rows
+                f = open(fname,'ab')
+                f.truncate(max(os.path.getsize(fname),
+                               nrows*aspcappix*np.dtype(dtype).itemsize))
+                f.close()
+            arrays[name] = np.memmap(fname,dtype=dtype,mode=mode,
+                                     shape=(nrows,aspcappix))
+        return arrays
+
+    def __len__(self):
+        return len(self.rows)
+
+    def read(self,keys,spectra,spectra_errs,bitmasks):
+        """
+        Fill rows of sample arrays with cached stars.
+
+        keys:           list of star keys (see starKey) for each row
+        spectra:        array with a row for each key to hold spectra
+        spectra_errs:   array with a row for each key to hold uncertainties
+        bitmasks:       array with a row for each key to hold bitmasks
+
+        Returns a boolean array that is True for stars found in the cache.
+        """
+        lockfile = self._lock()
+        self._loadIndex()
+        found = np.array([key in self.rows for key in keys],dtype=bool)
+        if np.any(found):
+            inds = np.where(found)[0]
+            rows = np.array([self.rows[keys[i]] for i in inds])
+            arrays = self._arrays(max(self.rows.values())+1)
+            spectra[inds] = arrays['spectra'][rows]
+            spectra_errs[inds] = arrays['spectra_errs'][rows]
+            bitmasks[inds] = arrays['bitmasks'][rows]
+            # Mark stars as used
+            self.clock += 1
+            for i in inds:
+                self.lastused[keys[i]] = self.clock
+            self._saveIndex()
+        lockfile.close()
+        return found
+
+    def write(self,keys,spectra,spectra_errs,bitmasks):
+        """
+        Add stars to the cache, evicting the least recently used stars if
+        the cache is full.
+
+        keys:           list of star keys (see starKey) for each row
+        spectra:        array with a row of spectra for each key
+        spectra_errs:   array with a row of uncertainties for each key
+        bitmasks:       array with a row of bitmasks for each key
+
+        """
+        keys = list(keys)
+        if keys == []:
+            return
+        lockfile = self._lock()
+        self._loadIndex()
+        self.clock += 1
+        new = [key for key in keys if key not in self.rows]
+        # Only keep as many stars as fit in the cache
+        new = new[:self.maxstars]
+        # Find free rows, then rows of the least recently used stars
+        nfree = self.maxstars-len(self.rows)
+        used = set(self.rows.values())
+        nrows = len(self.rows)
+        free = [r for r in range(nrows+max(0,min(nfree,len(new)))) if r not in used]
+        if len(free) < len(new):
+            keyset = set(keys)
+            lru = sorted([key for key in self.rows if key not in keyset],
+                         key=lambda key: self.lastused[key])
+            for key in lru[:len(new)-len(free)]:
+                free.append(self.rows.pop(key))
+                del self.lastused[key]
+        for key,row in zip(new,free):
+            self.rows[key] = row
+        # Write all given stars, refreshing any that were already cached
+        arrays = self._arrays(max(self.rows.values())+1,mode='r+')
+        for i in range(len(keys)):
+            if keys[i] in self.rows:
+                row = self.rows[keys[i]]
+                arrays['spectra'][row] = spectra[i]
+                arrays['spectra_errs'][row] = spectra_errs[i]
+                arrays['bitmasks'][row] = bitmasks[i]
+                self.lastused[keys[i]] = self.clock
+        for name in arrays:
+            arrays[name].flush()
+        self._saveIndex()
+        lockfile.close()
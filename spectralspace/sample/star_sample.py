@@ -1,5 +1,5 @@
 import numpy as np
-import os,inspect
+import os,inspect,glob,shutil
 from tqdm import tqdm
 import matplotlib
 matplotlib.use('Agg')
@@ -9,6 +9,9 @@ import apogee.samples.rc as rcmodel
 import apogee.tools.read as apread
 from apogee.tools.path import change_dr
 from spectralspace.sample.read_clusterdata import read_caldata
+from spectralspace.sample.catalog_cache import join_fibers
+from spectralspace.sample.sample_store import openStore,writeStore,compressedStore
+from spectralspace.sample.star_cache import starCache,starKey
 from importlib import reload
 import isodist
 
@@ -96,6 +99,37 @@ keyList = ['RA','DEC','GLON','GLAT','TEFF','LOGG','TEFF_ERR','LOGG_ERR',
             'N_H','O_H','SI_H','S_H','TI_H','V_H','CLUSTER','MEANFIB','SIGFIB']
 keyList.sort()
 
+# Columns of a sample store and the sample attributes that hold them
+storeColumns = {'teff':'teff',
+                'logg':'logg',
+                'fe_h':'fe_h',
+                'c_h':'c_h',
+                'n_h':'n_h',
+                'o_h':'o_h',
+                'fib':'fib',
+                'spectra':'spectra',
+                'spectra_errs':'spectra_errs',
+                'bitmasks':'_bitmasks',
+                'missing':'missingStars'}
+
+# Data types of spectra and bitmask arrays at each storage precision. Compact
+# bitmasks are read as int32 and reduced to the smallest unsigned type that
+# holds every flag set (see compactBitmasks)
+storagePrecision = {'double':(np.float64,np.int64),
+                    'compact':(np.float32,np.int32)}
+
+def compactBitmasks(bitmasks):
+    """
+    Returns bitmasks as uint16 if all flags set fit in 16 bits, or as uint32
+    otherwise.
+
+    bitmasks:   array of bitmasks
+
+    """
+    if bitmasks.size and np.max(bitmasks) >= 2**16:
+        return bitmasks.astype(np.uint32)
+    return bitmasks.astype(np.uint16)
+
 # List of accepted keys for upper and lower limits
 _upperKeys = ['max','m','Max','Maximum','maximum','']
 _lowerKeys = ['min','m','Min','Minimum','minimum','']
@@ -150,18 +184,12 @@ class starSample(object):
         """
         if self.DR:
             self.data = readfn[self._dataSource][self._sampleType]()
-            if self.DR=='12':
-                fib = np.load(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','data','DR12_supplement','fiberinfo.npy'))
-                if self._sampleType=='clusters':
-                    notmissing = (np.array([i for i in range(len(self.data['APOGEE_ID'])) if self.data['APOGEE_ID'][i] in fib['APOGEE_ID']]),)
-                else:
-                    notmissing = (np.arange(0,len(self.data)),)
+            # Add fiber information to samples that do not have it
+            if 'MEANFIB' not in self.data.dtype.names:
                 import numpy.lib.recfunctions as rfunc
-                self.data = rfunc.append_fields(self.data,('MEANFIB','SIGFIB'),data=(np.zeros(len(self.data)),np.zeros(len(self.data))),dtypes=('f4','f4'),usemask=False)
-                meanfib =  dict(zip(fib['APOGEE_ID'],fib['MEANFIB']))
-                sigfib = dict(zip(fib['APOGEE_ID'],fib['SIGFIB']))
-                self.data['MEANFIB'][notmissing] = np.array([meanfib[apoid] for apoid in self.data['APOGEE_ID'][notmissing]])
-                self.data['SIGFIB'][notmissing] = np.array([sigfib[apoid] for apoid in self.data['APOGEE_ID'][notmissing]])
+                meanfib,sigfib,found = join_fibers(self.data['APOGEE_ID'],
+                                                   dr=self.DR)
+                self.data = rfunc.append_fields(self.data,('MEANFIB','SIGFIB'),data=(meanfib,sigfib),dtypes=('f4','f4'),usemask=False)
         print('properties ',dir(self))
 
     def initArrays(self,stardata):
@@ -184,75 +212,76 @@ class starSample(object):
         self.fib = np.ma.masked_array(np.zeros((len(stardata)),
                                                 dtype=float))
         # Create spectra arrays
+        specdtype,bitdtype = storagePrecision[self.precision]
         self.spectra = np.ma.masked_array(np.zeros((len(stardata),aspcappix),
-                                                   dtype=float))
+                                                   dtype=specdtype))
         self.spectra_errs = np.ma.masked_array(np.zeros((len(stardata),
                                                          aspcappix),
-                                                        dtype=float))
-        self._bitmasks = np.zeros((len(stardata),aspcappix),dtype=np.int64)
+                                                        dtype=specdtype))
+        self._bitmasks = np.zeros((len(stardata),aspcappix),dtype=bitdtype)
 
-    def makeArrays(self,stardata):
+    def makeArrays(self,stardata,numthreads=8,cache=True,maxcache=50000):
         """
         Create arrays across all stars in the sample with shape number of
         stars by aspcappix.
 
-        stardata:   array whose columns contain information about stars in
-                    sample
+        stardata:     array whose columns contain information about stars in
+                      sample
+        numthreads:   maximum number of stars to read at once
+        cache:        if True, take stars from the star cache shared by all
+                      samples where possible, and add newly read stars to it
+        maxcache:     maximum number of stars to keep in the star cache
 
         """
 
         self.initArrays(stardata)
-        missing = 0
-        # Fill arrays for each star
         print(stardata.dtype)
-        for star in tqdm(range(len(stardata)),desc='read star data'):
-            LOC = stardata[star]['LOCATION_ID']
-            APO = stardata[star]['APOGEE_ID']
-            TEFF = stardata[star]['TEFF']
-            LOGG = stardata[star]['LOGG']
-            FE_H = stardata[star]['FE_H']
-            if self.DR=='12':
-                C_H = stardata[star]['C_H']
-                N_H = stardata[star]['N_H']
-                O_H = stardata[star]['O_H']
-            elif self.DR=='13':
-                C_H = stardata[star]['C_FE']
-                N_H = stardata[star]['N_FE']
-                O_H = stardata[star]['O_FE']
-            FIB = stardata[star]['MEANFIB']
-
-            # Fit variables
-            self.teff[star] = np.ma.masked_array(TEFF)
-            self.logg[star] = np.ma.masked_array(LOGG)
-            self.fe_h[star] = np.ma.masked_array(FE_H)
-            self.c_h[star] = np.ma.masked_array(C_H)
-            self.n_h[star] = np.ma.masked_array(N_H)
-            self.o_h[star] = np.ma.masked_array(O_H)
-            self.fib[star] = np.ma.masked_array(FIB)
-
-            # Spectral data
-            try:
-                self.spectra[star] = apread.aspcapStar(LOC,APO,ext=1,
-                                                       header=False,dr=self.DR,
-                                                       aspcapWavegrid=True)
-                self.spectra_errs[star] = apread.aspcapStar(LOC,APO,ext=2,
-                                                            header=False,
-                                                            dr=self.DR,
-                                                            aspcapWavegrid=True)
-                self._bitmasks[star] = apread.apStar(LOC,APO,ext=3,
-                                                     header=False,dr=self.DR,
-                                                     aspcapWavegrid=True)[1]
-            except IOError:
-                print('Star {0} missing '.format(star))
-                self.spectra[star] = np.zeros(aspcappix)
-                self.spectra_errs[star] = np.ones(aspcappix)
-                self._bitmasks[star] = np.ones(aspcappix).astype(np.int16)
-                missing +=1
-
-            if LOGG<-1000 or TEFF<-1000 or FE_H<-1000 or self.data[star]['SIGFIB'] < 0 or self.data[star]['MEANFIB'] < 0:
-                self._bitmasks[star] = np.ones(aspcappix).astype(np.int16)
-
-        print('Total {0} of {1} stars missing'.format(missing,len(stardata)))
+        # Fit variables
+        self.teff[:] = stardata['TEFF']
+        self.logg[:] = stardata['LOGG']
+        self.fe_h[:] = stardata['FE_H']
+        if self.DR=='12':
+            self.c_h[:] = stardata['C_H']
+            self.n_h[:] = stardata['N_H']
+            self.o_h[:] = stardata['O_H']
+        elif self.DR=='13':
+            self.c_h[:] = stardata['C_FE']
+            self.n_h[:] = stardata['N_FE']
+            self.o_h[:] = stardata['O_FE']
+        self.fib[:] = stardata['MEANFIB']
+
+        # Spectral data, taken from the star cache if possible
+        toread = np.arange(len(stardata))
+        if cache:
+            starcache = starCache(maxstars=maxcache)
+            keys = np.array([starKey(self.DR,stardata['LOCATION_ID'][i],
+                                     stardata['APOGEE_ID'][i])
+                             for i in range(len(stardata))])
+            incache = starcache.read(keys,self.spectra.data,
+                                     self.spectra_errs.data,self._bitmasks)
+            toread = np.where(incache==False)[0]
+            print('Found {0} of {1} stars in cache'.format(np.sum(incache),len(stardata)))
+        # Read remaining stars directly into the sample arrays
+        self.missingStars = acs.read_stars(stardata,self.spectra.data,
+                                           self.spectra_errs.data,
+                                           self._bitmasks,dr=self.DR,
+                                           numthreads=numthreads,
+                                           indices=toread)
+        if cache:
+            newstars = np.setdiff1d(toread,self.missingStars)
+            starcache.write(keys[newstars],self.spectra.data[newstars],
+                            self.spectra_errs.data[newstars],
+                            self._bitmasks[newstars])
+        # Flag missing stars and stars with bad labels at every pixel
+        badlabels = (stardata['LOGG']<-1000) | (stardata['TEFF']<-1000) | \
+                    (stardata['FE_H']<-1000) | (stardata['SIGFIB'] < 0) | \
+                    (stardata['MEANFIB'] < 0)
+        self._bitmasks[self.missingStars] = 1
+        self._bitmasks[badlabels] = 1
+        if self.precision == 'compact':
+            self._bitmasks = compactBitmasks(self._bitmasks)
+
+        print('Total {0} of {1} stars missing'.format(len(self.missingStars),len(stardata)))
 
 
     def show_sample_coverage(self,coords=True,phi_ind='RC_GALPHI',r_ind='RC_GALR',z_ind='RC_GALZ'):
@@ -532,29 +561,30 @@ class makeFilter(starSample):
         Create directory to store results for given filter.
 
         """
-        if not os.path.isdir(self.name):
-            os.system('mkdir -p {0}/'.format(self.name))
+        os.makedirs(self.name,exist_ok=True)
         return
 
     def directoryClean(self):
         """
-        Removes all files from a specified directory.
+        Removes all .npy files from a specified directory.
 
         """
-        os.system('rm -rf {0}/*.npy'.format(self.name))
+        for fname in glob.glob(os.path.join(self.name,'*.npy')):
+            os.remove(fname)
 
     def filterCopy(self):
         """
         Copies filter function to data directory.
         """
-        os.system('cp filter_function.py {0}/'.format(self.name))
+        shutil.copy('filter_function.py',self.name)
 
 class subStarSample(makeFilter):
     """
     Given a filter function, defines a subsample of the total sample of stars.
 
     """
-    def __init__(self,dataSource,sampleType,ask=True,datadict=None,datadir='.',func=None):
+    def __init__(self,dataSource,sampleType,ask=True,datadict=None,datadir='.',func=None,
+                 precision='double',codec=None):
         """
         Create a subsample according to a starFilter function
 
@@ -563,8 +593,15 @@ class subStarSample(makeFilter):
         ask:          if True, function asks for user input to make
                       filter_function.py, if False, uses existing
                       filter_function.py
+        precision:    storage precision of spectra and bitmasks, a key of
+                      storagePrecision. 'compact' holds spectra as float32
+                      and bitmasks as uint16, halving memory and disk use
+        codec:        if set, write the sample store compressed in blocks of
+                      stars with this codec ('zlib' or 'lzma')
 
         """
+        self.precision = precision
+        self.codec = codec
         # Create starFilter
         makeFilter.__init__(self,dataSource,sampleType,ask=ask,datadict=datadict,datadir=datadir,func=func)
         import filter_function
@@ -574,12 +611,25 @@ class subStarSample(makeFilter):
         change_dr(self.DR)
         self._matchingStars = starFilter(self.data)
         self.matchingData = self.data[self._matchingStars]
+        # Weight for each star when selecting subsamples (None uses all stars)
+        self._starWeights = None
+        # Factor multiplying squared uncertainties when finding weights, and
+        # corrections already read from file
+        self._correction = 1.
+        self._correctionCache = {}
         #self.numberStars = len(self.matchingData)
         if self._sampleType != 'syn':
             self.checkArrays()
 
     def numberStars(self):
-        return len(self.matchingData)
+        """
+        Returns the number of stars in the sample, counting only stars with
+        nonzero weight if a subsample has been selected.
+
+        """
+        if self._starWeights is None:
+            return len(self.matchingData)
+        return int(np.sum(self._starWeights!=0))
 
 
 
@@ -589,85 +639,147 @@ class subStarSample(makeFilter):
         If not, create them.
 
         """
-
-        fnames = np.array([self.name+'/teff.npy',
-                           self.name+'/logg.npy',
-                           self.name+'/fe_h.npy',
-                           self.name+'/c_h.npy',
-                           self.name+'/n_h.npy',
-                           self.name+'/o_h.npy',
-                           self.name+'/fib.npy',
-                           self.name+'/spectra.npy',
-                           self.name+'/spectra_errs.npy',
-                           self.name+'/bitmasks.npy'])
+        storename = self.name+'/sample.store'
+        fnames = [self.name+'/{0}.npy'.format(column) for column in storeColumns
+                  if column != 'missing']
         fexist = True
         for f in fnames:
             fexist *= os.path.isfile(f)
-        # If all files exist, read data from file for increased initialization speed
-        if fexist:
-            self.teff = np.load(self.name+'/teff.npy')
-            self.logg = np.load(self.name+'/logg.npy')
-            self.fe_h = np.load(self.name+'/fe_h.npy')
-            self.c_h = np.load(self.name+'/c_h.npy')
-            self.n_h = np.load(self.name+'/n_h.npy')
-            self.o_h = np.load(self.name+'/o_h.npy')
-            self.fib = np.load(self.name+'/fib.npy')
-            self.spectra = np.ma.masked_array(np.load(self.name+'/spectra.npy'))
-            self.spectra_errs = np.ma.masked_array(np.load(self.name+'/spectra_errs.npy'))
-            self._bitmasks = np.load(self.name+'/bitmasks.npy')
-        # If any file is missing, generate arrays and write to file
+        # If the sample store exists, map its arrays for increased initialization speed
+        if os.path.isfile(storename):
+            self.readStore(storename)
+            # Rewrite the store if it was saved at another precision or
+            # with different compression
+            compressed = isinstance(self.store,compressedStore)
+            if self.setPrecision() or compressed != bool(self.codec) or \
+               (compressed and self.store.codec != self.codec):
+                self.writeStore(storename)
+        # If arrays were saved as separate files, read them and write them to a store
+        elif fexist:
+            for column in storeColumns:
+                if os.path.isfile(self.name+'/{0}.npy'.format(column)):
+                    setattr(self,storeColumns[column],
+                            np.load(self.name+'/{0}.npy'.format(column)))
+                elif column == 'missing':
+                    self.missingStars = np.array([],dtype=int)
+            self.spectra = np.ma.masked_array(self.spectra)
+            self.spectra_errs = np.ma.masked_array(self.spectra_errs)
+            self.setPrecision()
+            self.writeStore(storename)
+        # If no arrays are saved, generate them and write them to a store
         elif not fexist:
             self.makeArrays(self.matchingData)
-            np.save(self.name+'/teff.npy',self.teff.data)
-            np.save(self.name+'/logg.npy',self.logg.data)
-            np.save(self.name+'/fe_h.npy',self.fe_h.data)
-            np.save(self.name+'/c_h.npy',self.c_h.data)
-            np.save(self.name+'/n_h.npy',self.n_h.data)
-            np.save(self.name+'/o_h.npy',self.o_h.data)
-            np.save(self.name+'/fib.npy',self.fib.data)
-            np.save(self.name+'/spectra.npy',self.spectra.data)
-            np.save(self.name+'/spectra_errs.npy',self.spectra_errs.data)
-            np.save(self.name+'/bitmasks.npy',self._bitmasks)
+            self.writeStore(storename)
+
+    def setPrecision(self):
+        """
+        Convert spectra and bitmasks to the data types for the sample's
+        storage precision, if they are not already stored that way.
 
+        Returns True if any array was converted.
+        """
+        specdtype,bitdtype = storagePrecision[self.precision]
+        converted = False
+        for name in ['spectra','spectra_errs']:
+            array = getattr(self,name)
+            if array.dtype != specdtype:
+                setattr(self,name,np.ma.masked_array(array.astype(specdtype)))
+                converted = True
+        if self.precision == 'compact':
+            if self._bitmasks.dtype not in [np.uint16,np.uint32]:
+                self._bitmasks = compactBitmasks(self._bitmasks)
+                converted = True
+        elif self._bitmasks.dtype != bitdtype:
+            self._bitmasks = self._bitmasks.astype(bitdtype)
+            converted = True
+        return converted
+
+    def readStore(self,storename):
+        """
+        Read sample arrays as views of a sample store.
+
+        storename:   path to the sample store
+
+        """
+        self.store = openStore(storename)
+        for column in storeColumns:
+            setattr(self,storeColumns[column],self.store[column])
+        self.spectra = np.ma.masked_array(self.spectra,copy=False)
+        self.spectra_errs = np.ma.masked_array(self.spectra_errs,copy=False)
+
+    def writeStore(self,storename):
+        """
+        Write sample arrays to a sample store, then read them back as views
+        of the new store so that none are left mapped from a replaced file.
+
+        storename:   path to the sample store
 
-    def correctUncertainty(self,correction=None):
         """
-        Performs a correction on measurement uncertainty.
+        writeStore(storename,
+                   dict([(column,getattr(self,storeColumns[column]))
+                         for column in storeColumns]),
+                   codec=self.codec)
+        self.readStore(storename)
+
+
+    def loadCorrection(self,correction=None):
+        """
+        Returns the factor by which squared measurement uncertainties are
+        multiplied, as a float or an array that broadcasts against
+        spectra_errs. Pickled corrections are read once and cached until the
+        file changes.
 
         correction:   Information on how to perform the correction.
                       May be a path to a pickled file, a float, or
-                      list of values.
+                      list of values. If None, no correction is made.
 
         """
+        if correction is None:
+            return 1.
         if isinstance(correction,(str)):
-            correction = acs.pklread(correction)
+            key = (correction,os.path.getmtime(correction))
+            if key not in self._correctionCache:
+                self._correctionCache[key] = self.loadCorrection(acs.pklread(correction))
+            return self._correctionCache[key]
         if isinstance(correction,(float,int)):
-            self.spectra_errs *= np.sqrt(correction)
-        elif isinstance(correction,(list)):
-            correction = np.array(correction)
-        if isinstance(correction,(np.ndarray)):
-            if correction.shape != self.spectra_errs.shape:
-                correction = np.tile(correction,(self.spectra_errs.shape[0],1))
-            self.spectra_errs = np.sqrt(correction*self.spectra_errs**2)
+            return float(correction)
+        return np.ma.getdata(correction).astype(float)
 
-    def uncorrectUncertainty(self,correction=None):
+    def correctUncertainty(self,correction=None):
         """
-        Undoes correction on measurement uncertainty.
+        Performs a correction on measurement uncertainty. The uncertainties
+        in spectra_errs are left unchanged; the correction is applied when
+        weights are found from them (see correctedVariance).
 
         correction:   Information on how to perform the correction.
                       May be a path to a pickled file, a float, or
                       list of values.
+
         """
-        if isinstance(correction,(str)):
-            correction = acs.pklread(correction)
-        if isinstance(correction,(float,int)):
-            self.spectra_errs /= np.sqrt(correction)
-        elif isinstance(correction,(list)):
-            correction = np.array(correction)
-        if isinstance(correction,(np.ndarray)):
-            if correction.shape != self.spectra_errs.shape:
-                correction = np.tile(correction,(self.spectra_errs.shape[0],1))
-            self.spectra_errs = np.sqrt(self.spectra_errs**2/correction)
+        self._correction = self.loadCorrection(correction)
+
+    def uncorrectUncertainty(self,correction=None):
+        """
+        Undoes correction on measurement uncertainty.
+
+        correction:   Unused, kept so calls match correctUncertainty
+        """
+        self._correction = 1.
+
+    def correctedVariance(self,index=None):
+        """
+        Returns squared measurement uncertainties multiplied by the current
+        correction, without changing spectra_errs.
+
+        index:   index into the stars by pixels array of uncertainties,
+                 defaults to the whole array
+
+        """
+        if index is None:
+            index = Ellipsis
+        errs = np.ma.getdata(self.spectra_errs)
+        correction = np.broadcast_to(getattr(self,'_correction',1.),errs.shape)
+        return errs[index].astype(float)**2*correction[index]
 
     def imshow(self,plotData,saveName=None,title = '',xlabel='pixels',ylabel='stars',zlabel='',**kwargs):
         """
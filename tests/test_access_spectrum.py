@@ -0,0 +1,102 @@
+import os
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+from astropy.io import fits
+from spectralspace.sample import access_spectrum as acs
+from spectralspace.sample.star_sample import aspcappix
+from apogee.tools import toAspcapGrid
+
+apStarpix = 8575
+
+def write_star(path,apogee,seed):
+    """
+    Writes mock aspcapStar and apStar files for a star, with arrays on the
+    apStar grid, and returns the spectrum, uncertainty and combined bitmask.
+    """
+    rng = np.random.RandomState(seed)
+    spectrum = rng.uniform(0.5,1.2,apStarpix).astype(np.float32)
+    spectrum_err = rng.uniform(0.005,0.02,apStarpix).astype(np.float32)
+    bitmasks = rng.randint(0,2**14,(3,apStarpix)).astype(np.int32)
+    fits.HDUList([fits.PrimaryHDU(),fits.ImageHDU(spectrum),
+                  fits.ImageHDU(spectrum_err)]).writeto(os.path.join(path,'aspcapStar-{0}.fits'.format(apogee)))
+    fits.HDUList([fits.PrimaryHDU(),fits.ImageHDU(),fits.ImageHDU(),
+                  fits.ImageHDU(bitmasks)]).writeto(os.path.join(path,'apStar-{0}.fits'.format(apogee)))
+    return spectrum,spectrum_err,bitmasks[1]
+
+@pytest.fixture
+def mock_stars(tmp_path,monkeypatch):
+    """
+    Returns labels for three stars, the second of which has no files, and
+    the arrays written for the others.
+    """
+    monkeypatch.setattr(acs.appath,'aspcapStarPath',
+                        lambda loc,apo,dr=None: str(tmp_path/'aspcapStar-{0}.fits'.format(apo)),
+                        raising=False)
+    monkeypatch.setattr(acs.appath,'apStarPath',
+                        lambda loc,apo,dr=None: str(tmp_path/'apStar-{0}.fits'.format(apo)),
+                        raising=False)
+    monkeypatch.setattr(acs.apdownload,'aspcapStar',lambda *args,**kwargs: None,
+                        raising=False)
+    monkeypatch.setattr(acs.apdownload,'apStar',lambda *args,**kwargs: None,
+                        raising=False)
+    data = np.zeros(3,dtype=[('LOCATION_ID',int),('APOGEE_ID','U18')])
+    data['APOGEE_ID'] = ['2M0001','2M0002','2M0003']
+    written = {0:write_star(str(tmp_path),'2M0001',1),
+               2:write_star(str(tmp_path),'2M0003',2)}
+    return data,written
+
+def check_rows(written,spectra,spectra_errs,bitmasks):
+    for i,(spectrum,spectrum_err,bitmask) in written.items():
+        assert np.array_equal(spectra[i],toAspcapGrid(spectrum))
+        assert np.array_equal(spectra_errs[i],toAspcapGrid(spectrum_err))
+        assert np.array_equal(bitmasks[i],toAspcapGrid(bitmask))
+    # The missing star is flagged with unit uncertainties
+    assert np.all(spectra[1] == 0)
+    assert np.all(spectra_errs[1] == 1)
+    assert np.all(bitmasks[1] == 1)
+
+def test_read_stars_on_aspcap_grid(mock_stars):
+    data,written = mock_stars
+    spectra = np.zeros((len(data),aspcappix),dtype=np.float32)
+    spectra_errs = np.zeros((len(data),aspcappix),dtype=np.float32)
+    bitmasks = np.zeros((len(data),aspcappix),dtype=np.int64)
+    missing = acs.read_stars(data,spectra,spectra_errs,bitmasks,numthreads=2,
+                             progress=False)
+    assert np.array_equal(missing,[1])
+    check_rows(written,spectra,spectra_errs,bitmasks)
+
+def test_spectrum_stream_on_aspcap_grid(mock_stars):
+    data,written = mock_stars
+    stream = acs.spectrumStream(data,chunksize=2,numthreads=2)
+    chunks = list(stream)
+    assert [list(chunk[0]) for chunk in chunks] == [[0,1],[2]]
+    spectra,spectra_errs,bitmasks = [np.concatenate([chunk[i] for chunk in chunks])
+                                     for i in range(1,4)]
+    assert np.array_equal(stream.missing,[1])
+    check_rows(written,spectra,spectra_errs,bitmasks)
+
+def test_spectrum_stream_prefetch(monkeypatch):
+    data = np.zeros(10,dtype=[('LOCATION_ID',int),('APOGEE_ID','U18')])
+    requested = []
+    def readChunk(self,start):
+        requested.append(start)
+        # Later chunks finish first, but must still come out in order
+        time.sleep(0.02*(10-start)/3.)
+        indices = np.arange(start,min(start+self.chunksize,len(self.data)))
+        spectra = np.repeat(indices[:,np.newaxis],aspcappix,axis=1).astype(self.dtype)
+        return indices,spectra,spectra,spectra.astype(int),indices[indices % 4 == 1]
+    monkeypatch.setattr(acs.spectrumStream,'_readChunk',readChunk)
+    stream = acs.spectrumStream(data,chunksize=3,prefetch=2)
+    assert len(stream) == 4
+    seen = []
+    for indices,spectra,spectra_errs,bitmasks in stream:
+        # Only prefetch chunks are read ahead of the one in use
+        assert len(requested) <= len(seen)+1+stream.prefetch
+        assert np.array_equal(spectra[:,0],indices)
+        seen.append(list(indices))
+    assert seen == [[0,1,2],[3,4,5],[6,7,8],[9]]
+    assert sorted(requested) == [0,3,6,9]
+    assert np.array_equal(stream.missing,[1,5,9])
@@ -0,0 +1,10 @@
+import pytest
+
+pytest.importorskip('apogee')
+pytest.importorskip('empca')
+from spectralspace.examples.benchmark_fit import benchmark_fit
+
+def test_masked_and_weighted_paths_agree():
+    # benchmark_fit checks that both paths give the same residuals and weights
+    times = benchmark_fit(nstars=30,npixels=100,repeats=1)
+    assert times['masked'] > 0 and times['weighted'] > 0
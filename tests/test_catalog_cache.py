@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pytest
+pytest.importorskip('apogee')
+import spectralspace.sample.catalog_cache as cc
+
+@pytest.fixture
+def catalog(tmp_path,monkeypatch):
+    """
+    Replaces the allStar reader with one that counts reads of a small
+    catalog file, and returns the path to the file and the list of reads.
+    """
+    monkeypatch.setenv('SPECTRALSPACE_CACHE',str(tmp_path/'cache'))
+    source = str(tmp_path/'allStar.fits')
+    with open(source,'w') as f:
+        f.write('first')
+    reads = []
+    def reader(raw=True,dr=None):
+        reads.append(dr)
+        scale = 2. if open(source).read().startswith('second') else 1.
+        return {'TEFF':scale*np.arange(4.),'LOGG':scale*np.ones(4)}
+    monkeypatch.setitem(cc.catalogReaders,'allStar',
+                        (reader,lambda dr=None: source))
+    return source,reads
+
+def test_columns_read_once(catalog):
+    source,reads = catalog
+    data = cc.cached_catalog('allStar',['TEFF'],dr='13')
+    assert np.array_equal(data['TEFF'],np.arange(4.))
+    assert isinstance(data['TEFF'],np.memmap)
+    data = cc.cached_catalog('allStar',['TEFF'],dr='13')
+    assert len(reads) == 1
+    # Only a new column needs another read
+    data = cc.cached_catalog('allStar',['TEFF','LOGG'],dr='13')
+    assert len(reads) == 2
+    assert np.array_equal(data['LOGG'],np.ones(4))
+    # Each data release keeps its own cache
+    cc.cached_catalog('allStar',['TEFF'],dr='14')
+    assert reads == ['13','13','14']
+
+def test_changed_catalog_clears_cache(catalog):
+    source,reads = catalog
+    cc.cached_catalog('allStar',['TEFF','LOGG'],dr='13')
+    with open(source,'w') as f:
+        f.write('second, which is longer')
+    data = cc.cached_catalog('allStar',['TEFF'],dr='13')
+    assert len(reads) == 2
+    assert np.array_equal(data['TEFF'],2*np.arange(4.))
+    # Columns from the old catalog were removed with the rest of the cache
+    cachedir = os.path.dirname(data['TEFF'].filename)
+    assert not os.path.isfile(os.path.join(cachedir,'LOGG.npy'))
+    # Same size, different modification time
+    with open(source,'w') as f:
+        f.write('second, which is longer')
+    os.utime(source,(0,0))
+    cc.cached_catalog('allStar',['TEFF'],dr='13')
+    assert len(reads) == 3
+
+def fiberinfo(nstars=200,seed=3):
+    """
+    Returns a fiber table with repeated and padded byte IDs, as in
+    fiberinfo.npy.
+    """
+    rng = np.random.RandomState(seed)
+    ids = np.array(['2M{0:04d}  '.format(i).encode()
+                    for i in rng.randint(0,nstars,nstars)])
+    fib = np.zeros(nstars,dtype=[('APOGEE_ID','S18'),('MEANFIB','f4'),
+                                 ('SIGFIB','f4')])
+    fib['APOGEE_ID'] = ids
+    fib['MEANFIB'] = rng.uniform(1,300,nstars)
+    fib['SIGFIB'] = rng.uniform(0,50,nstars)
+    return fib
+
+def test_join_fibers(tmp_path,monkeypatch):
+    monkeypatch.setenv('SPECTRALSPACE_CACHE',str(tmp_path/'cache'))
+    fib = fiberinfo()
+    source = str(tmp_path/'fiberinfo.npy')
+    np.save(source,fib)
+    monkeypatch.setattr(cc,'fiberinfoPath',source)
+    # Look up stars the way the dictionaries used before did, where the
+    # last entry for a star wins
+    meanfib = dict(zip(np.char.strip(fib['APOGEE_ID']),fib['MEANFIB']))
+    sigfib = dict(zip(np.char.strip(fib['APOGEE_ID']),fib['SIGFIB']))
+    ids = np.array(['2M{0:04d}'.format(i).encode() for i in range(250)])
+    found = np.array([i in meanfib for i in ids])
+    for _ in range(2):
+        joinmean,joinsig,joinfound = cc.join_fibers(ids,dr='12')
+        assert np.array_equal(joinfound,found)
+        assert np.array_equal(joinmean[found],[meanfib[i] for i in ids[found]])
+        assert np.array_equal(joinsig[found],[sigfib[i] for i in ids[found]])
+        assert np.all(joinmean[~found] == 0) and np.all(joinsig[~found] == 0)
+    # String IDs match the same stars
+    joinmean,joinsig,joinfound = cc.join_fibers(np.char.decode(ids),dr='12')
+    assert np.array_equal(joinfound,found)
+    # A changed fiber table rebuilds the index
+    fib['MEANFIB'] += 1
+    np.save(source,fib)
+    os.utime(source,(0,0))
+    joinmean,joinsig,joinfound = cc.join_fibers(ids,dr='12')
+    assert np.array_equal(joinmean[found],[meanfib[i]+1 for i in ids[found]])
+
+def test_join_fibers_from_allstar(catalog,monkeypatch):
+    source,reads = catalog
+    fib = fiberinfo(nstars=20)
+    monkeypatch.setitem(cc.catalogReaders,'allStar',
+                        (lambda raw=True,dr=None: fib,lambda dr=None: source))
+    monkeypatch.setattr(cc.appath,'allStarPath',lambda dr=None: source)
+    ids = np.array(['2M{0:04d}'.format(i) for i in range(25)])
+    joinmean,joinsig,joinfound = cc.join_fibers(ids,dr='13')
+    index = cc._sortedFibers(fib['APOGEE_ID'],fib['MEANFIB'],fib['SIGFIB'])
+    assert np.array_equal(joinfound,np.isin(ids,index['APOGEE_ID']))
+    pos = np.searchsorted(index['APOGEE_ID'],ids[joinfound])
+    assert np.array_equal(joinmean[joinfound],index['MEANFIB'][pos])
+
+def test_sorted_fibers_keep_last_entry():
+    index = cc._sortedFibers([b'2M02 ',b'2M01',b'2M02'],[1.,2.,3.],[4.,5.,6.])
+    assert np.array_equal(index['APOGEE_ID'],['2M01','2M02'])
+    assert np.array_equal(index['MEANFIB'],[2.,3.])
+    assert np.array_equal(index['SIGFIB'],[5.,6.])
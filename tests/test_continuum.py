@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+import spectralspace.sample.mask_data as mask_data
+from spectralspace.sample.sample_store import writeStore,openStore
+
+# Continuum level returned by the stand-in for apogee's continuum fit
+continua = {'cannon':2.,'aspcap':4.}
+
+def fit(spec,err,type='cannon'):
+    return continua[type]*np.ones(len(spec))
+
+def open_sample(path):
+    """
+    Returns a masked sample whose arrays are read from the sample store in
+    path.
+    """
+    sample = mask_data.mask.__new__(mask_data.mask)
+    sample.name = str(path)
+    sample.store = openStore(os.path.join(str(path),'sample.store'))
+    sample.spectra = np.ma.masked_array(sample.store['spectra'])
+    sample.spectra_errs = np.ma.masked_array(sample.store['spectra_errs'])
+    return sample
+
+def test_switching_continuum_source(tmp_path,monkeypatch):
+    monkeypatch.setattr(mask_data,'fit',fit)
+    raw = np.random.RandomState(3).uniform(1,2,(250,30))
+    writeStore(os.path.join(str(tmp_path),'sample.store'),
+               {'spectra':raw,'spectra_errs':0.01*raw})
+    sample = open_sample(tmp_path)
+    sample.continuumNormalize(source='cannon',numcores=2,blockstars=100)
+    assert np.allclose(sample.spectra,raw/2.)
+    # A second source normalizes the original spectra, not the normalized ones
+    sample.continuumNormalize(source='aspcap',numcores=2,blockstars=100)
+    assert np.allclose(sample.spectra,raw/4.)
+    assert sample.name == str(tmp_path)+'/ctmnorm-aspcap/'
+    assert np.allclose(sample.store['ctmnorm-aspcap'],raw/4.)
+    sample.continuumNormalize(source='cannon')
+    assert np.allclose(sample.spectra,raw/2.)
+    # A later run reads the cached normalization for each source
+    monkeypatch.setattr(mask_data,'fit',None)
+    again = open_sample(tmp_path)
+    again.continuumNormalize(source='aspcap')
+    assert np.allclose(again.spectra,raw/4.)
+
+def test_sample_in_one_block(tmp_path,monkeypatch):
+    monkeypatch.setattr(mask_data,'fit',fit)
+    raw = np.random.RandomState(4).uniform(1,2,(40,30))
+    writeStore(os.path.join(str(tmp_path),'sample.store'),
+               {'spectra':raw,'spectra_errs':0.01*raw})
+    sample = open_sample(tmp_path)
+    sample.continuumNormalize(source='cannon',numcores=2,blockstars=100)
+    assert sample.spectra.shape == raw.shape
+    assert np.allclose(sample.spectra,raw/2.)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+pytest.importorskip('empca')
+import spectralspace.analysis.empca_residuals as er
+from spectralspace.examples.synthetic_sample import write_sample,fit_sample
+
+class stopEMPCA(Exception):
+    pass
+
+def test_empca_weights(tmp_path,monkeypatch):
+    write_sample(tmp_path,nstars=30,npix=er.aspcappix)
+    model = fit_sample(tmp_path)
+    weights = np.random.RandomState(6).randint(0,3,30)
+    model.setSubsample(weights)
+    model.minStarNum = 5
+    given = {}
+    def empca(data,weights=None,**kwargs):
+        given['data'],given['weights'] = data,weights
+        raise stopEMPCA()
+    monkeypatch.setattr(er,'empca',empca)
+    with pytest.raises(stopEMPCA):
+        model.pixelEMPCA(correction=2.)
+    stars = np.where(weights!=0)[0]
+    subsample = np.ix_(stars,model.goodPixels[0])
+    residuals = model.residuals[subsample]
+    expected = (~residuals.mask)*weights[stars][:,np.newaxis]/\
+               (2.*np.ma.getdata(model.spectra_errs)[subsample]**2)
+    assert np.array_equal(given['data'],residuals.data)
+    assert np.allclose(given['weights'],expected)
+    assert np.array_equal(model.empcaResiduals.mask,residuals.mask)
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+from spectralspace.sample.mask_data import toMasked,toWeights
+
+def test_weights_round_trip():
+    rng = np.random.RandomState(5)
+    marray = np.ma.masked_array(rng.normal(size=(20,30)),
+                                mask=rng.uniform(size=(20,30)) < 0.2)
+    variance = rng.uniform(0.5,2.,marray.shape)
+    data,weights = toWeights(marray,variance=variance)
+    assert np.array_equal(weights[~marray.mask],1./variance[~marray.mask])
+    assert np.all(weights[marray.mask] == 0)
+    again = toMasked(data,weights)
+    assert np.array_equal(again.mask,marray.mask)
+    assert np.array_equal(again.data,marray.data)
+    data,weights = toWeights(marray)
+    assert np.array_equal(weights,~marray.mask)
+
+def test_mask_filter_ignores_subsample(tmp_path):
+    pytest.importorskip('empca')
+    from spectralspace.sample.sample_store import writeStore
+    from spectralspace.sample.mask_data import maskFilter
+    from spectralspace.examples.synthetic_sample import sample_columns,mask_sample
+    columns = sample_columns(nstars=40,npix=50)
+    # Flag most, but not too many, stars at one pixel
+    columns['bitmasks'][:30,10] = 2**12
+    writeStore(str(tmp_path/'sample.store'),columns)
+    model = mask_sample(tmp_path)
+    full = maskFilter(model)
+    assert not np.all(full[:,10])
+    weights = np.zeros(40,dtype=int)
+    weights[::2] = 1
+    model.setSubsample(weights)
+    assert np.array_equal(maskFilter(model),full)
+
+def test_mask_sweep_matches_mask_filter(tmp_path):
+    pytest.importorskip('empca')
+    from spectralspace.sample.sample_store import writeStore
+    from spectralspace.sample.mask_data import maskFilter,maskSweep
+    from spectralspace.examples.synthetic_sample import sample_columns,mask_sample
+    columns = sample_columns(nstars=40,npix=50)
+    rng = np.random.RandomState(8)
+    # Spread SNR over the thresholds, with some above the cap of 200
+    columns['spectra_errs'] = columns['spectra']/rng.uniform(20,300,(40,50))
+    columns['bitmasks'][rng.uniform(size=(40,50)) < 0.1] = 2**1
+    columns['bitmasks'][:37,10] = 2**12
+    writeStore(str(tmp_path/'sample.store'),columns)
+    model = mask_sample(tmp_path)
+    minSNRs = [30.,50.,100.,250.]
+    badcombpixmasks = [2**12,2**12+2**1]
+    table = maskSweep(model,minSNRs,badcombpixmasks,minstar=5,minStarNum=8)
+    assert len(table) == len(minSNRs)*len(badcombpixmasks)
+    for row in table:
+        mask = maskFilter(model,minstar=5,minSNR=row['minSNR'],
+                          badcombpixmask=row['badcombpixmask'])
+        counts = np.sum(~mask,axis=0)
+        assert np.array_equal(row['starcount'],counts)
+        assert row['fittable'] == np.sum(counts >= 8)
+
+def test_packed_mask_round_trip():
+    from spectralspace.sample.mask_data import packedMask
+    rng = np.random.RandomState(9)
+    # A number of stars that does not fill the last byte
+    mask = rng.uniform(size=(21,13)) < 0.3
+    packed = packedMask(mask)
+    assert packed.bits.shape == (13,3)
+    assert np.array_equal(packed.unpack(pixblock=4),mask)
+    assert np.array_equal(packed.count(),np.sum(mask,axis=0))
+    for pixel in range(13):
+        assert np.array_equal(packed.column(pixel),mask[:,pixel])
+    for star in range(21):
+        assert np.array_equal(packed.row(star),mask[star])
+    stars = rng.uniform(size=21) < 0.5
+    assert np.array_equal(packed.maskStars(stars).unpack(),
+                          mask | stars[:,np.newaxis])
+    packed.setColumn(4)
+    mask[:,4] = True
+    assert np.array_equal(packed.unpack(),mask)
+    assert packed.count()[4] == 21
+
+def test_apply_mask_unpacks_mask(tmp_path):
+    pytest.importorskip('empca')
+    from spectralspace.sample.sample_store import writeStore
+    from spectralspace.examples.synthetic_sample import sample_columns,mask_sample
+    columns = sample_columns(nstars=37,npix=50)
+    writeStore(str(tmp_path/'sample.store'),columns)
+    model = mask_sample(tmp_path)
+    base = np.zeros(model.spectra.shape,dtype=bool)
+    base[model._maskHere] = True
+    assert np.any(base) and not np.all(base)
+    assert np.array_equal(model.masked,base)
+    assert model.spectra._mask is model.masked
+    assert model.spectra_errs._mask is model.masked
+    assert np.array_equal(model.unmasked,~base)
+    assert np.array_equal(model.unmaskedCount(),np.sum(~base,axis=0))
+    assert np.array_equal(model.unmaskedStars(3),~base[:,3])
+    # Stars left out of a subsample are masked at every pixel
+    weights = np.ones(37,dtype=int)
+    weights[[0,8,36]] = 0
+    model.setSubsample(weights)
+    expected = base | (weights==0)[:,np.newaxis]
+    assert np.array_equal(model.masked,expected)
+    assert np.array_equal(model.unmaskedCount(),np.sum(~expected,axis=0))
+    model.maskPixel(5)
+    assert np.all(model.masked[:,5]) and not np.any(model.unmasked[:,5])
+    assert model.unmaskedCount()[5] == 0
+    model.setSubsample()
+    assert np.array_equal(model.masked,base)
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+pytest.importorskip('empca')
+from spectralspace.sample.sample_store import writeStore
+from spectralspace.examples import ncells_calculation as nc
+
+class eigModel(object):
+    """
+    Holds the EMPCA results used to count cells.
+    """
+    def __init__(self,eigval):
+        self.savename = None
+        self.eigval = eigval
+        self.R2Array = np.linspace(0,1,len(eigval)+1)
+        self.R2noise = 0.5
+
+def old_Ncells(model,denom,N,D,**kwargs):
+    """
+    Returns the number of cells for each number of eigenvectors, found as
+    calculate_Ncells did before working in log space.
+    """
+    numeig = len(model.eigval)
+    if isinstance(denom,(int,float)):
+        denomarr = denom*np.ones(numeig)
+    if isinstance(denom,list):
+        denomarr = np.array(denom)
+    if callable(denom):
+        denomarr = denom(numeig,model,N,D,**kwargs)
+    denom = np.copy(denomarr)
+    cond = np.sqrt(N*model.eigval) < denomarr
+    denom[cond] = np.sqrt(N*model.eigval[cond])
+    Ncells = np.zeros(numeig)
+    for n in range(numeig):
+        if D < N:
+            Ncells[n] = np.prod(np.sqrt(D*model.eigval[:n+1]))/np.prod(denom[:n+1])
+        elif N < D:
+            Ncells[n] = np.prod(np.sqrt((N*model.eigval)[:n+1]))/(np.prod((denom)[:n+1]))
+    return Ncells
+
+@pytest.fixture
+def modeldir(tmp_path):
+    """
+    Writes the files read by reconstruct_EMPCA_data for a small sample and
+    returns the model directory.
+    """
+    rng = np.random.RandomState(4)
+    nstars = 30
+    spectra = rng.normal(1,0.01,(nstars,nc.aspcappix))
+    writeStore(str(tmp_path/'sample.store'),
+               {'spectra':spectra,
+                'spectra_errs':rng.uniform(0.005,0.02,spectra.shape)})
+    direc = tmp_path/'bm4351'
+    os.makedirs(str(direc))
+    mask = rng.uniform(size=spectra.shape) < 0.1
+    # Pixels with too few stars are left out of the EMPCA data
+    mask[:,:100] = True
+    np.save(str(direc/'mask.npy'),mask)
+    np.save(str(direc/'residuals.npy'),rng.normal(0,0.01,spectra.shape))
+    np.save(str(direc/'fitspectra.npy'),spectra)
+    return str(direc)
+
+@pytest.mark.parametrize('denom,kwargs',[(nc.consth,{}),
+                                         (nc.consth,{'scale':0.1}),
+                                         (nc.pessimh,{}),
+                                         (nc.pessimh,{'cvc':2}),
+                                         (0.01,{}),
+                                         ([0.01,0.02,0.5,0.03,0.04],{})])
+def test_ncells_match_products(modeldir,denom,kwargs):
+    eigval = np.array([2e-3,1e-3,5e-4,1e-4,1e-5])
+    model = eigModel(eigval)
+    Ncells = nc.calculate_Ncells(modeldir,model,'test',denom=denom,
+                                 generate=True,**kwargs)
+    N,D = model.data.shape
+    assert N < D
+    expected = old_Ncells(model,denom,N,D,**kwargs)
+    assert np.allclose(Ncells(np.arange(1,6)),expected,rtol=1e-10)
+    # Fewer stars than pixels as well as the other way round
+    for N,D in [(30,7114),(7114,30)]:
+        denomarr = nc.cell_sizes(denom,model,N,D,**kwargs)
+        assert np.allclose(np.exp(nc.log_Ncells(eigval,denomarr,N,D)),
+                           old_Ncells(model,denom,N,D,**kwargs),rtol=1e-10)
+
+def test_ncells_table(modeldir):
+    eigval = np.array([2e-3,1e-3,5e-4,1e-4,1e-5])
+    model = eigModel(eigval)
+    scales = [1,0.1]
+    denoms = [nc.consth,nc.pessimh]
+    table = nc.calculate_Ncells_table(modeldir,model,scales=scales,
+                                      denoms=denoms)
+    N,D = model.data.shape
+    assert table.shape == (4,5)
+    for i,denom in enumerate(denoms):
+        for j,scale in enumerate(scales):
+            expected = old_Ncells(model,nc.cell_sizes(denom,model,N,D,
+                                                      scale=scale).tolist(),N,D)
+            assert np.allclose(table[i*len(scales)+j],expected,rtol=1e-10)
+    logtable = nc.calculate_Ncells_table(modeldir,model,scales=scales,
+                                         denoms=denoms,log=True)
+    assert np.allclose(np.exp(logtable),table)
+
+def test_log_ncells_does_not_overflow():
+    eigval = np.full(400,1e3)
+    denom = np.full(400,1e-3)
+    old = np.prod(np.sqrt(30*eigval))/np.prod(denom)
+    assert np.isinf(old)
+    logN = nc.log_Ncells(eigval,denom,30,7214)
+    assert np.all(np.isfinite(logN))
+    assert np.isclose(logN[-1],400*(0.5*np.log(30e3)-np.log(1e-3)))
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+from spectralspace.sample.sample_store import writeStore,sampleStore
+from spectralspace.examples.synthetic_sample import sample_columns,open_sample,fit_sample
+
+def test_reopen_store_at_compact_precision(tmp_path):
+    columns = sample_columns(npix=50)
+    writeStore(os.path.join(str(tmp_path),'sample.store'),columns)
+    sample = open_sample(tmp_path,precision='compact')
+    assert sample.spectra.dtype == np.float32
+    assert sample._bitmasks.dtype == np.uint16
+    assert np.allclose(sample.spectra,columns['spectra'],rtol=1e-6)
+    assert np.array_equal(sample._bitmasks,columns['bitmasks'])
+    assert np.array_equal(sample.teff,columns['teff'])
+    # The rewritten store is read back at compact precision
+    store = sampleStore(os.path.join(str(tmp_path),'sample.store'))
+    assert store['spectra'].dtype == np.float32
+    assert sample.store['spectra'].dtype == np.float32
+
+def fit_R2(model):
+    """
+    Returns the weighted fraction of the variance of the spectra at each
+    pixel that is explained by the fit.
+    """
+    weights = ~model.masked/np.ma.getdata(model.spectra_errs).astype(float)**2
+    spectra = np.ma.getdata(model.spectra).astype(float)
+    mean = np.sum(weights*spectra,axis=0)/np.sum(weights,axis=0)
+    total = np.sum(weights*(spectra-mean)**2,axis=0)
+    residual = np.sum(weights*np.ma.getdata(model.residuals)**2,axis=0)
+    return 1-residual/total
+
+def test_compact_precision_fit_agrees(tmp_path):
+    pytest.importorskip('empca')
+    columns = sample_columns()
+    paths = [os.path.join(str(tmp_path),precision)
+             for precision in ['double','compact']]
+    for path in paths:
+        os.makedirs(path)
+        writeStore(os.path.join(path,'sample.store'),columns)
+    double = fit_sample(paths[0],'double')
+    compact = fit_sample(paths[1],'compact')
+    assert compact.spectra.dtype == np.float32
+    # Masks depend on bitmasks and SNR, which are kept at compact precision
+    assert np.array_equal(double.masked,compact.masked)
+    fit = ~np.ma.getmaskarray(double.fitCoeffs)
+    assert np.array_equal(fit,~np.ma.getmaskarray(compact.fitCoeffs))
+    # Coefficients change by a small fraction of their uncertainties
+    change = np.fabs(double.fitCoeffs.data-compact.fitCoeffs.data)[fit]
+    assert np.max(change/double.fitCoeffErrs.data[fit]) < 1e-3
+    assert np.allclose(double.fitCoeffErrs.data[fit],
+                       compact.fitCoeffErrs.data[fit],rtol=1e-5)
+    good = np.all(fit,axis=1)
+    assert np.max(np.fabs(fit_R2(double)-fit_R2(compact))[good]) < 1e-5
+
+def test_compact_bitmasks_widen_for_high_bits(tmp_path):
+    from spectralspace.sample.star_sample import compactBitmasks
+    bitmasks = np.array([[0,2**12],[2**15,2**15+1]],dtype=np.int64)
+    assert compactBitmasks(bitmasks).dtype == np.uint16
+    assert compactBitmasks(np.zeros((0,3),dtype=np.int64)).dtype == np.uint16
+    bitmasks[0,0] = 2**16+2**3
+    compact = compactBitmasks(bitmasks)
+    assert compact.dtype == np.uint32
+    assert np.array_equal(compact,bitmasks)
+    # Samples flagged with bit 16 keep the flag at compact precision
+    columns = sample_columns(npix=50)
+    columns['bitmasks'][3,7] = 2**16
+    writeStore(os.path.join(str(tmp_path),'sample.store'),columns)
+    sample = open_sample(tmp_path,precision='compact')
+    assert sample._bitmasks.dtype == np.uint32
+    assert np.array_equal(sample._bitmasks,columns['bitmasks'])
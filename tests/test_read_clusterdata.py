@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+
+pytest.importorskip('apogee')
+import spectralspace.sample.read_clusterdata as rc
+
+def allstar():
+    """
+    Returns allStar and allVisit columns for four entries of three stars,
+    with padded byte IDs as in the raw catalog.
+    """
+    alldata = {'APOGEE_ID':np.array([b'2M0003  ',b'2M0001  ',b'2M0002  ',
+                                     b'2M0002  ']),
+               'LOCATION_ID':np.array([4102,4230,4102,4103]),
+               'NVISITS':np.array([1,2,1,1]),
+               'VISIT_PK':np.array([[0,-1,-1],[1,2,-1],[3,-1,-1],[4,-1,-1]])}
+    allvdata = {'FIBERID':np.array([10,20,30,40,50])}
+    return alldata,allvdata
+
+def test_match_single_star_cluster():
+    alldata,allvdata = allstar()
+    data = Table({'CLUSTER':['M13'],'ID':['2M0001']})
+    good,first,count,fibers = rc._match_allstar(data,alldata,allvdata,3)
+    assert np.array_equal(good,[True])
+    assert np.array_equal(first,[1])
+    assert np.array_equal(count,[1])
+    assert np.array_equal(fibers,[[20,30,-1]])
+
+def test_id_index():
+    alldata,allvdata = allstar()
+    index = rc.idIndex(alldata['APOGEE_ID'])
+    first,count = index.match(['2M0002','2M0004',b'2M0003'])
+    assert np.array_equal(first,[2,-1,0])
+    assert np.array_equal(count,[2,0,1])
+    assert np.array_equal(index.varies(alldata['LOCATION_ID'],
+                                       ['2M0001','2M0002']),[False,True])
+    data = Table({'CLUSTER':['M13'],'ID':['2M0002']})
+    with pytest.raises(ValueError):
+        rc._match_allstar(data,alldata,allvdata,3)
+
+def test_read_single_star_cluster(tmp_path,monkeypatch):
+    monkeypatch.setenv('SPECTRALSPACE_CACHE',str(tmp_path))
+    data = np.array([(4230,'2M0001',4500.)],
+                    dtype=[('LOCATION_ID',int),('ID','U18'),('TEFF',float)])
+    monkeypatch.setattr(rc,'_select_cluster',
+                        lambda cluster,teffmin,teffmax: data)
+    star = (np.linspace(0.9,1.1,7214),np.full(7214,0.01))
+    monkeypatch.setattr(rc,'_normalize_star',
+                        lambda locid,apogeeid,cont_type,cont_deg: star)
+    read,spec,specerr = rc.read_spectra('M13',numcores=2)
+    assert np.array_equal(read,data)
+    assert np.array_equal(spec,[star[0]])
+    assert np.array_equal(specerr,[star[1]])
+    # A second read comes from the cache without normalizing again
+    monkeypatch.setattr(rc,'_normalize_star',None)
+    read,spec,specerr = rc.read_spectra('M13')
+    assert np.array_equal(read,data)
+    assert np.array_equal(spec,[star[0]])
+    assert np.array_equal(specerr,[star[1]])
+
+def test_match_cluster_members():
+    alldata,allvdata = allstar()
+    data = Table({'CLUSTER':['M13','Pleiades','M13','M13'],
+                  'ID':['2M0003','2M9999','2M0001','2M0003']})
+    good,first,count,fibers = rc._match_allstar(data,alldata,allvdata,3)
+    # Pleiades members are not looked up
+    assert np.array_equal(good,[True,False,True,True])
+    assert np.array_equal(first[good],[0,1,0])
+    assert np.array_equal(fibers,[[10,-1,-1],[-1,-1,-1],[20,30,-1],
+                                  [10,-1,-1]])
+    # Only the requested number of visits is kept
+    good,first,count,fibers = rc._match_allstar(data,alldata,allvdata,1)
+    assert np.array_equal(fibers[:,0],[10,-1,20,10])
+    data = Table({'CLUSTER':['M13'],'ID':['2M9999']})
+    with pytest.raises(ValueError):
+        rc._match_allstar(data,alldata,allvdata,3)
+
+def test_match_same_location():
+    alldata,allvdata = allstar()
+    # Repeated entries at one location are a single star
+    alldata['LOCATION_ID'][3] = 4102
+    data = Table({'CLUSTER':['M13'],'ID':['2M0002']})
+    good,first,count,fibers = rc._match_allstar(data,alldata,allvdata,3)
+    assert np.array_equal(first,[2])
+    assert np.array_equal(count,[2])
+    assert np.array_equal(fibers,[[40,-1,-1]])
+
+def test_good4CN(monkeypatch):
+    apokasc = {'APOGEE_ID':np.array([b'2M0002',b'2M0001',b'2M0003']),
+               'SEISMO EVOL':np.array([b'CLUMP ',b'RGB   ',b'CLUMP '])}
+    monkeypatch.setattr(rc.apread,'apokasc',lambda: apokasc,raising=False)
+    data = Table({'ID':['2M0001','2M0002','2M0004','2M0005'],
+                  'TEFF':[4500.,4500.,4500.,4780.],
+                  'LOGG':[2.5,2.5,2.5,2.5]})
+    assert np.array_equal(rc.good4CN('N6819',data),[True,False,True,False])
+    assert np.array_equal(rc.good4CN('M13',data),[True]*4)
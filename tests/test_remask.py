@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+pytest.importorskip('empca')
+from spectralspace.sample.mask_data import maskFilter
+from spectralspace.examples.synthetic_sample import write_sample,mask_sample
+
+def masked_sample(path,minSNR,weights=None):
+    """
+    Returns a masked synthetic sample set up to be remasked, restricted to
+    a subsample if weights are given.
+    """
+    model = mask_sample(path,minSNR=minSNR)
+    model.maskMaker = maskFilter
+    model.minSNR = minSNR
+    model.badcombpixmask = 4351
+    model._maskDir = '/bm4351'
+    model.name = os.path.join(str(path),'bm4351')
+    if weights is not None:
+        model.setSubsample(weights)
+    return model
+
+@pytest.mark.parametrize('subsample',[False,True])
+def test_remask_matches_refit(tmp_path,subsample):
+    write_sample(tmp_path,nstars=40)
+    weights = None
+    if subsample:
+        weights = np.ones(40,dtype=int)
+        weights[::3] = 0
+    model = masked_sample(tmp_path,50,weights=weights)
+    model.findResiduals(save=False)
+    refit = model.remask(minSNR=50.5,save=False)
+    assert model.name == os.path.join(str(tmp_path),'bm4351_minSNR50.5')
+    full = masked_sample(tmp_path,50.5,weights=weights)
+    full.findResiduals(save=False)
+    # Only pixels whose stars changed were refit
+    changed = np.any(model.masked != masked_sample(tmp_path,50,weights=weights).masked,axis=0)
+    assert 0 < refit < len(changed)
+    assert refit == np.sum(changed)
+    assert np.array_equal(model.masked,full.masked)
+    assert np.array_equal(np.ma.getmaskarray(model.fitCoeffs),
+                          np.ma.getmaskarray(full.fitCoeffs))
+    fit = ~np.ma.getmaskarray(full.fitCoeffs)
+    assert np.allclose(model.fitCoeffs.data[fit],full.fitCoeffs.data[fit])
+    assert np.allclose(model.fitCoeffErrs.data[fit],full.fitCoeffErrs.data[fit])
+    assert np.array_equal(model.residuals.mask,full.residuals.mask)
+    assert np.allclose(model.residuals.data[~full.residuals.mask],
+                       full.residuals.data[~full.residuals.mask])
@@ -0,0 +1,50 @@
+import tracemalloc
+import numpy as np
+import pytest
+
+pytest.importorskip('galpy')
+from spectralspace.analysis.residual_covariance import residualCovariance,residualVariance
+
+def masked_residuals(nstars=60,npix=50,seed=3):
+    """
+    Returns masked residuals and their uncertainties, with a few masked stars
+    at each pixel.
+    """
+    rng = np.random.RandomState(seed)
+    errs = rng.uniform(0.5,2.,(nstars,npix))
+    residuals = np.ma.masked_array(errs*rng.normal(size=(nstars,npix)),
+                                   mask=rng.uniform(size=(nstars,npix)) < 0.1)
+    return residuals,errs
+
+def test_diagonal_computes_only_diagonal_tiles(tmp_path):
+    residuals,errs = masked_residuals()
+    covariance = residualCovariance(residuals,errs,str(tmp_path/'cov.dat'),
+                                    tilesize=16,chunksize=7,numcores=1)
+    diagonal = covariance.diagonal()
+    assert np.array_equal(covariance._done,np.eye(covariance.ntiles,dtype=bool))
+    expected = np.ma.cov(residuals/errs,rowvar=False)
+    assert np.allclose(diagonal,np.ma.diag(expected))
+    assert np.allclose(covariance.matrix(),expected)
+
+def test_variance_with_star_weights(tmp_path):
+    residuals,errs = masked_residuals()
+    starWeights = np.random.RandomState(4).randint(0,3,residuals.shape[0])
+    variance = residualVariance(residuals,errs,starWeights=starWeights,
+                                chunksize=7)
+    # Bootstrap multiplicities count each star as many times as it is drawn
+    repeated = np.repeat(np.arange(residuals.shape[0]),starWeights)
+    expected = np.ma.var(residuals[repeated]/errs[repeated],axis=0,ddof=1)
+    assert np.allclose(variance,expected)
+    covariance = residualCovariance(residuals,errs,str(tmp_path/'cov.dat'),
+                                    starWeights=starWeights,tilesize=16,
+                                    chunksize=7,numcores=1)
+    assert np.allclose(covariance.diagonal(),expected)
+
+def test_variance_memory_is_blockwise():
+    residuals,errs = masked_residuals(nstars=50000,npix=200)
+    tracemalloc.start()
+    residualVariance(residuals,errs,chunksize=1024)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # A full array of weights alone would take nstars*npix*8 bytes
+    assert peak < residuals.size*8/4
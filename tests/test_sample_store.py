@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import pytest
+from spectralspace.sample.sample_store import writeStore,openStore,sampleStore,compressedStore
+
+def columns(nstars=300,npix=20,seed=2):
+    """
+    Returns a dictionary of arrays to store.
+    """
+    rng = np.random.RandomState(seed)
+    bitmasks = np.zeros((nstars,npix),dtype=np.int64)
+    bitmasks[rng.uniform(size=(nstars,npix)) < 0.05] = 2**12
+    return {'teff':rng.uniform(4000,5000,nstars),
+            'spectra':rng.normal(1,0.01,(nstars,npix)),
+            'bitmasks':bitmasks,
+            'missing':np.array([],dtype=int)}
+
+@pytest.mark.parametrize('codec',['zlib','lzma'])
+def test_rewrite_mapped_store_with_codec(tmp_path,codec):
+    fname = os.path.join(str(tmp_path),'sample.store')
+    data = columns()
+    writeStore(fname,data)
+    store = openStore(fname)
+    views = dict([(name,store[name]) for name in store.columns()])
+    # Rewrite the store from arrays that view the file being replaced
+    newstore = writeStore(fname,views,codec=codec,blockstars=64)
+    for name in data:
+        assert np.array_equal(views[name],data[name])
+        assert np.array_equal(newstore[name],data[name])
+    reopened = openStore(fname)
+    assert isinstance(reopened,compressedStore)
+    assert reopened.codec == codec
+    assert np.array_equal(reopened.readRows('spectra',100,200),
+                          data['spectra'][100:200])
+    assert not os.path.isfile(fname+'.tmp')
+
+def test_reopen_sample_with_codec(tmp_path):
+    pytest.importorskip('apogee')
+    from spectralspace.sample.star_sample import subStarSample,storeColumns
+    fname = os.path.join(str(tmp_path),'sample.store')
+    data = columns()
+    for name in ['logg','fe_h','c_h','n_h','o_h','fib']:
+        data[name] = data['teff']/1000.
+    data['spectra_errs'] = 0.01*data['spectra']
+    writeStore(fname,data)
+    for codec in ['zlib','lzma',None]:
+        sample = subStarSample.__new__(subStarSample)
+        sample.name = str(tmp_path)
+        sample.precision = 'double'
+        sample.codec = codec
+        sample.checkArrays()
+        for column in storeColumns:
+            assert np.array_equal(np.ma.getdata(getattr(sample,storeColumns[column])),
+                                  data[column])
+        store = openStore(fname)
+        if codec:
+            assert isinstance(store,compressedStore)
+            assert store.codec == codec
+        elif not codec:
+            assert isinstance(store,sampleStore)
+
+def test_store_columns_view_the_file(tmp_path):
+    fname = os.path.join(str(tmp_path),'sample.store')
+    data = columns()
+    writeStore(fname,data)
+    store = openStore(fname)
+    assert isinstance(store,sampleStore)
+    assert sorted(store.columns()) == sorted(data.keys())
+    for name in data:
+        assert np.array_equal(store[name],data[name])
+        assert store[name].dtype == data[name].dtype
+        assert store.index[name]['offset'] % 64 == 0
+    # Columns view the memory map rather than copies of it
+    spectra = store['spectra']
+    assert np.shares_memory(spectra,store['spectra'])
+    # The map is copy-on-write, so changing a view leaves the file alone
+    spectra[0] = 0.
+    assert np.array_equal(openStore(fname)['spectra'],data['spectra'])
+
+def test_store_write_replaces_column(tmp_path):
+    fname = os.path.join(str(tmp_path),'sample.store')
+    data = columns()
+    writeStore(fname,data)
+    store = openStore(fname)
+    store.write('teff',np.arange(10,dtype=np.int32))
+    store.write('logg',np.ma.masked_array(np.ones(5),mask=[1,0,0,0,0]))
+    reopened = openStore(fname)
+    assert np.array_equal(reopened['teff'],np.arange(10))
+    assert reopened['teff'].dtype == np.int32
+    assert np.array_equal(reopened['logg'],np.ones(5))
+    for name in ['spectra','bitmasks','missing']:
+        assert np.array_equal(reopened[name],data[name])
+
+def test_open_rejects_other_files(tmp_path):
+    fname = os.path.join(str(tmp_path),'sample.store')
+    with open(fname,'wb') as f:
+        f.write(b'not a sample store at all')
+    with pytest.raises(IOError):
+        sampleStore(fname)
+
+def test_arrays_move_to_store(tmp_path):
+    pytest.importorskip('apogee')
+    from spectralspace.sample.star_sample import subStarSample,storeColumns
+    data = columns()
+    for name in ['logg','fe_h','c_h','n_h','o_h','fib']:
+        data[name] = data['teff']/1000.
+    data['spectra_errs'] = 0.01*data['spectra']
+    # Save arrays as separate files the way older samples did
+    for column in storeColumns:
+        if column != 'missing':
+            np.save(os.path.join(str(tmp_path),'{0}.npy'.format(column)),
+                    data[column])
+    sample = subStarSample.__new__(subStarSample)
+    sample.name = str(tmp_path)
+    sample.precision = 'double'
+    sample.codec = None
+    sample.checkArrays()
+    store = openStore(os.path.join(str(tmp_path),'sample.store'))
+    for column in storeColumns:
+        assert np.array_equal(store[column],data[column])
+    assert len(sample.missingStars) == 0
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+pytest.importorskip('empca')
+from spectralspace.analysis import empca_residuals as er
+
+def test_unknown_method_raises():
+    diag = np.ma.masked_array(np.ones(er.aspcappix))
+    with pytest.raises(ValueError):
+        er.smoothMedian(diag,numpix=10,method='mean')
+
+def test_smooth_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(er,'_smoothCache',{})
+    monkeypatch.setattr(er,'_smoothCacheSize',3)
+    rng = np.random.RandomState(2)
+    diags = [np.ma.masked_array(rng.uniform(0.9,1.1,er.aspcappix))
+             for i in range(5)]
+    smoothed = [er.smoothMedian(diag,numpix=20,method='median',numcores=1)
+                for diag in diags]
+    assert len(er._smoothCache) == 3
+    # The most recent arrays are still cached and return the same result
+    assert np.array_equal(er.smoothMedian(diags[-1],numpix=20,
+                                          method='median',numcores=1),
+                          smoothed[-1])
+    assert len(er._smoothCache) == 3
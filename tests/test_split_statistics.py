@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+pytest.importorskip('empca')
+from spectralspace.analysis.empca_residuals import empca_residuals,meanMed
+
+def crossvec(samplenum,v,name):
+    """
+    Crossover point reported for a subsample and variance function.
+    """
+    return samplenum+0.5*v
+
+def make_model(path,crossvec=crossvec,nstars=20,nvecs=3):
+    """
+    Returns an empca_residuals object whose subsample fits are replaced by
+    fixed statistics, so that only the splitting and statistics code runs.
+
+    path:       directory in which to save results
+    crossvec:   function of the subsample number, variance function index
+                and subsample directory giving the crossover point
+    nstars:     number of stars in the sample
+    nvecs:      number of eigenvectors
+
+    """
+    model = empca_residuals.__new__(empca_residuals)
+    model.name = str(path)
+    model.nvecs = nvecs
+    model.matchingData = np.zeros(nstars)
+    model._starWeights = None
+    model.setSubsample = lambda weights=None: None
+    def subsample_wrapper(weights,name,samplenum):
+        if not os.path.isdir(name):
+            os.makedirs(name)
+        nfuncs = len(model.varfuncs)
+        R2As = np.tile(np.linspace(0,1,nvecs+1),(nfuncs,1))
+        R2ns = 0.5*np.ones(nfuncs)
+        cvcs = np.array([crossvec(samplenum,v,name) for v in range(nfuncs)])
+        labs = np.array(['subsamp {0}, {1} stars, func {2} - {3} vec'.format(samplenum,int(np.sum(weights)),model.varfuncs[v].__name__,cvcs[v])
+                         for v in range(nfuncs)],dtype='S100')
+        return (R2As.T,R2ns,cvcs,labs)
+    model.subsample_wrapper = subsample_wrapper
+    return model
+
+def test_bootstrap_samplesplit_writes_interval(tmp_path):
+    model = make_model(tmp_path)
+    model.samplesplit(seed=3,subsamples=3,varfuncs=[np.ma.var,meanMed],
+                      bootstrap=True,percentiles=[2.5,97.5])
+    for v in range(2):
+        numeigvec = np.fromfile(model.numeigvecName(v))
+        # Only the resampled subsamples, not the full sample, are used
+        cvec = np.array([crossvec(i,v,'') for i in range(1,4)])
+        expected = np.concatenate(([np.median(cvec)],
+                                   np.percentile(cvec,[2.5,97.5])))
+        assert np.allclose(numeigvec,expected)
+    # The full sample was moved to the parent directory
+    assert not os.path.isdir(os.path.join(model.name,'seed3_bootstrap4of3'))
+
+def test_multiseedsplit_pools_crossing_seeds(tmp_path):
+    def seedcrossvec(samplenum,v,name):
+        # The second variance function never crosses for seed 2
+        if v == 1 and 'seed2_' in name:
+            return -1
+        return samplenum+0.5*v+0.25*('seed2_' in name)
+    model = make_model(tmp_path,crossvec=seedcrossvec)
+    seeds = [1,2]
+    model.multiseedsplit(seeds,division=True,subsamples=2,
+                         varfuncs=[np.ma.var,meanMed])
+    expected = np.zeros((len(seeds),2,2))
+    for s in range(len(seeds)):
+        for v in range(2):
+            name = 'seed{0}_'.format(seeds[s])
+            cvec = np.array([seedcrossvec(i,v,name) for i in range(1,3)])
+            cvec = cvec[cvec!=-1]
+            if cvec.size:
+                expected[s,v] = [np.median(cvec),np.std(cvec)]
+            elif not cvec.size:
+                expected[s,v] = [-1,-1]
+            model.seed = seeds[s]
+            assert np.allclose(np.fromfile(model.numeigvecName(v)),
+                               expected[s,v])
+    assert np.allclose(model.numeigvecs,expected)
+    # Seeds without a crossing are left out of the pooled result
+    pooled = [np.mean(expected[:,0],axis=0),expected[0,1]]
+    for v in range(2):
+        assert np.allclose(np.fromfile(model.numeigvecName(v,seed='1-2',
+                                                           prefix='pooled_')),
+                           pooled[v])
+
+class fakeModel(object):
+    """
+    EMPCA model with fixed R^2 statistics.
+    """
+    def __init__(self,nvecs):
+        self.R2Array = np.linspace(0,1,nvecs+1)
+        self.R2noise = 0.5
+
+@pytest.mark.parametrize('inmemory',[True,False])
+def test_subsample_files(tmp_path,monkeypatch,inmemory):
+    from spectralspace.examples.synthetic_sample import write_sample,mask_sample
+    import spectralspace.sample.access_spectrum as acs
+    def system(command):
+        raise AssertionError('shell call {0}'.format(command))
+    monkeypatch.setattr(os,'system',system)
+    write_sample(tmp_path,nstars=30)
+    model = mask_sample(tmp_path)
+    model.nvecs = 3
+    model.minSNR = 50
+    model.varfuncs = [np.ma.var,meanMed]
+    model.inmemory = inmemory
+    def pixelEMPCA(varfunc=np.ma.var,nvecs=5,savename=None):
+        model.empcaModelWeight = fakeModel(nvecs)
+        if savename:
+            acs.pklwrite(model.name+'/'+savename,model.empcaModelWeight)
+    model.pixelEMPCA = pixelEMPCA
+    weights = np.ones(30,dtype=int)
+    weights[::3] = 0
+    name = str(tmp_path/'seed1_subsample1of3')
+    R2As,R2ns,cvcs,labs = model.subsample_wrapper(weights,name,1)
+    assert np.allclose(cvcs,1.5)
+    if inmemory:
+        # Only the statistics of the subsample are written
+        assert os.listdir(name) == ['R2stats.npz']
+        stats = np.load(os.path.join(name,'R2stats.npz'))
+        assert np.allclose(stats['crossvecs'],cvcs)
+    elif not inmemory:
+        # Fit arrays are removed, leaving the EMPCA models
+        assert sorted(os.listdir(name)) == ['eig3_minSNR50_corrNone_meanMed.pkl',
+                                            'eig3_minSNR50_corrNone_var.pkl']
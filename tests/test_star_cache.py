@@ -0,0 +1,71 @@
+import threading
+import numpy as np
+import pytest
+pytest.importorskip('apogee')
+from spectralspace.sample.star_cache import starCache,starKey,aspcappix
+
+def stars(values):
+    """
+    Returns spectra, uncertainties and bitmasks with one row per value.
+    """
+    values = np.asarray(values,dtype=float)
+    spectra = np.repeat(values[:,np.newaxis],aspcappix,axis=1)
+    return spectra,0.1*spectra,spectra.astype(int)
+
+def readStars(cache,keys):
+    """
+    Returns the cached spectra and a flag for each key found in the cache.
+    """
+    spectra = np.zeros((len(keys),aspcappix))
+    errs = np.zeros((len(keys),aspcappix))
+    bitmasks = np.zeros((len(keys),aspcappix),dtype=int)
+    found = cache.read(keys,spectra,errs,bitmasks)
+    return spectra[:,0],found
+
+def test_star_key():
+    assert starKey(12,4241,b'2M0001 ') == starKey(12,4241,'2M0001')
+
+def test_evict_least_recently_used(tmp_path):
+    cache = starCache(cachedir=str(tmp_path),maxstars=3)
+    keys = ['12/1/a','12/1/b','12/1/c']
+    cache.write(keys,*stars([1,2,3]))
+    # Using a and c leaves b as the least recently used star
+    readStars(cache,['12/1/a','12/1/c'])
+    cache.write(['12/1/d'],*stars([4]))
+    assert len(cache) == 3
+    values,found = readStars(cache,['12/1/a','12/1/b','12/1/c','12/1/d'])
+    assert np.array_equal(found,[True,False,True,True])
+    assert np.array_equal(values,[1,0,3,4])
+    # d took the row b was evicted from
+    assert max(cache.rows.values()) == 2
+    # A new instance sees the same cache
+    values,found = readStars(starCache(cachedir=str(tmp_path),maxstars=3),
+                             ['12/1/d','12/1/b'])
+    assert np.array_equal(found,[True,False])
+    assert values[0] == 4
+
+def test_write_keeps_given_stars(tmp_path):
+    cache = starCache(cachedir=str(tmp_path),maxstars=2)
+    cache.write(['12/1/a','12/1/b'],*stars([1,2]))
+    # Stars in the same write are never evicted for each other
+    cache.write(['12/1/a','12/1/c'],*stars([5,3]))
+    values,found = readStars(cache,['12/1/a','12/1/b','12/1/c'])
+    assert np.array_equal(found,[True,False,True])
+    assert np.array_equal(values,[5,0,3])
+
+def test_write_waits_for_lock(tmp_path):
+    cache = starCache(cachedir=str(tmp_path),maxstars=3)
+    other = starCache(cachedir=str(tmp_path),maxstars=3)
+    lockfile = cache._lock()
+    writer = threading.Thread(target=other.write,
+                              args=(['12/1/a'],)+stars([1]))
+    writer.start()
+    writer.join(0.5)
+    # The writer blocks while the lock is held elsewhere
+    assert writer.is_alive()
+    assert len(starCache(cachedir=str(tmp_path))) == 0
+    lockfile.close()
+    writer.join(5)
+    assert not writer.is_alive()
+    values,found = readStars(cache,['12/1/a'])
+    assert found[0] and values[0] == 1
@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+pytest.importorskip('empca')
+from spectralspace.sample.sample_store import writeStore
+from spectralspace.examples.synthetic_sample import sample_columns,mask_sample
+
+def write_columns(path,columns,rows=slice(None)):
+    os.makedirs(path)
+    writeStore(os.path.join(path,'sample.store'),
+               dict([(key,value if key == 'missing' else value[rows])
+                     for key,value in columns.items()]))
+
+def test_subsample_matches_sliced_sample(tmp_path):
+    columns = sample_columns(nstars=40)
+    stars = np.sort(np.random.RandomState(7).choice(40,25,replace=False))
+    full = os.path.join(str(tmp_path),'full')
+    sliced = os.path.join(str(tmp_path),'sliced')
+    write_columns(full,columns)
+    write_columns(sliced,columns,rows=stars)
+    model = mask_sample(full)
+    weights = np.zeros(40,dtype=int)
+    weights[stars] = 1
+    model.setSubsample(weights)
+    model.findResiduals(save=False)
+    expected = mask_sample(sliced)
+    expected.findResiduals(save=False)
+    # Fit arrays only hold rows for stars in the subsample
+    assert model.fitSpectra.shape == (len(stars),columns['spectra'].shape[1])
+    assert model.residuals.shape == expected.residuals.shape
+    assert np.array_equal(model.residuals.mask,expected.residuals.mask)
+    assert np.allclose(model.residuals.filled(0),expected.residuals.filled(0))
+    assert np.allclose(model.fitCoeffs.filled(0),expected.fitCoeffs.filled(0))
+    assert np.allclose(model.findCorrection(median=False,
+                                            savename=str(tmp_path/'c.pkl')).filled(0),
+                       expected.findCorrection(median=False,
+                                               savename=str(tmp_path/'e.pkl')).filled(0))
+    assert np.array_equal(model.residualRows(stars[3:6]),[3,4,5])
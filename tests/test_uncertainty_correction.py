@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('apogee')
+import spectralspace.sample.access_spectrum as acs
+from spectralspace.examples.synthetic_sample import write_sample,open_sample,mask_sample
+
+def test_correction_leaves_uncertainties(tmp_path):
+    write_sample(tmp_path,nstars=10,npix=6)
+    sample = open_sample(tmp_path)
+    sample._correctionCache = {}
+    errs = sample.spectra_errs
+    original = np.ma.getdata(errs).copy()
+    variance = original**2
+    correction = np.array([1.,2.,3.,4.,5.,6.])
+    for value,expected in [(2,2*variance),(2.5,2.5*variance),
+                           (list(correction),correction*variance),
+                           (np.ma.masked_array(correction),correction*variance)]:
+        sample.correctUncertainty(correction=value)
+        assert np.allclose(sample.correctedVariance(),expected)
+        assert np.allclose(sample.correctedVariance((slice(2,5),3)),
+                           expected[2:5,3])
+        assert sample.spectra_errs is errs
+        assert np.array_equal(np.ma.getdata(sample.spectra_errs),original)
+    sample.uncorrectUncertainty()
+    assert np.array_equal(sample.correctedVariance(),variance)
+    sample.correctUncertainty(correction=None)
+    assert np.array_equal(sample.correctedVariance(),variance)
+
+def test_pickled_correction_is_cached(tmp_path,monkeypatch):
+    write_sample(tmp_path,nstars=10,npix=6)
+    sample = open_sample(tmp_path)
+    sample._correctionCache = {}
+    fname = str(tmp_path/'correction.pkl')
+    acs.pklwrite(fname,np.full(6,2.))
+    reads = []
+    pklread = acs.pklread
+    monkeypatch.setattr(acs,'pklread',lambda f: reads.append(f) or pklread(f))
+    variance = np.ma.getdata(sample.spectra_errs)**2
+    for _ in range(3):
+        sample.correctUncertainty(correction=fname)
+        assert np.allclose(sample.correctedVariance(),2*variance)
+    assert len(reads) == 1
+    # A changed file is read again
+    acs.pklwrite(fname,np.full(6,3.))
+    os.utime(fname,(0,0))
+    sample.correctUncertainty(correction=fname)
+    assert np.allclose(sample.correctedVariance(),3*variance)
+    assert len(reads) == 2
+
+def test_pixel_weights_use_correction(tmp_path):
+    pytest.importorskip('empca')
+    write_sample(tmp_path,nstars=20,npix=30)
+    model = mask_sample(tmp_path)
+    model._correctionCache = {}
+    weights = np.ones(20,dtype=int)
+    weights[3] = 0
+    weights[4] = 2
+    model.setSubsample(weights)
+    model.correctUncertainty(correction=np.linspace(1,2,30))
+    variance = np.ma.getdata(model.spectra_errs)**2*np.linspace(1,2,30)
+    for pixel in range(30):
+        expected = weights*model.unmaskedStars(pixel)/variance[:,pixel]
+        assert np.allclose(model.pixelWeights(pixel),expected)